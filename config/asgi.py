@@ -19,12 +19,14 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
 # is populated before importing code that may import ORM models.
 django_asgi_application = get_asgi_application()
 
+from core import lifespan  # noqa: E402
 from core.middlewares import JWTAuthMiddleware  # noqa: E402
 from core.routing import websocket_urlpatterns  # noqa: E402
 
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_application,
+        "lifespan": lifespan.application,
         "websocket": AllowedHostsOriginValidator(
             JWTAuthMiddleware(AuthMiddlewareStack(URLRouter(websocket_urlpatterns)))
         ),
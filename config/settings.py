@@ -105,6 +105,28 @@ DATABASES = {
     )
 }
 
+# Connection pool (PostgreSQL, with psycopg 3)
+# Each process (Daphne or Celery worker) keeps between DATABASE_POOL_MIN_SIZE and
+# DATABASE_POOL_MAX_SIZE connections open, instead of opening a connection for each
+# thread, request and task. Requests wait up to DATABASE_POOL_TIMEOUT seconds for a
+# connection; idle connections are closed after DATABASE_POOL_MAX_IDLE seconds and
+# all of them are replaced after DATABASE_POOL_MAX_LIFETIME seconds.
+DATABASE_POOL_ENABLED = env.bool("DATABASE_POOL_ENABLED", default=True)
+
+if (
+    DATABASE_POOL_ENABLED
+    and DATABASES["default"]["ENGINE"] == "django.db.backends.postgresql"
+):
+    DATABASES["default"].setdefault("OPTIONS", {})["pool"] = {
+        "min_size": env.int("DATABASE_POOL_MIN_SIZE", default=2),
+        "max_size": env.int("DATABASE_POOL_MAX_SIZE", default=10),
+        "timeout": env.float("DATABASE_POOL_TIMEOUT", default=10),
+        "max_idle": env.float("DATABASE_POOL_MAX_IDLE", default=600),
+        "max_lifetime": env.float("DATABASE_POOL_MAX_LIFETIME", default=3600),
+    }
+    # Connections are returned to the pool instead of being kept by each thread
+    DATABASES["default"]["CONN_MAX_AGE"] = 0
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -194,6 +216,8 @@ SPECTACULAR_SETTINGS = {
 # https://docs.celeryproject.org/en/stable/userguide/configuration.html
 CELERY_BROKER_URL = env.str("CELERY_BROKER_URL", default="redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = "django-db"
+# The moderation tasks only autoretry on database errors, they reschedule the
+# messages whose model request failed themselves (see core.tasks)
 CELERY_TASK_ANNOTATIONS = {
     "*": {
         "max_retries": 6,
@@ -201,22 +225,72 @@ CELERY_TASK_ANNOTATIONS = {
         "autoretry_for": (Exception,),
     }
 }
+CELERY_BEAT_SCHEDULE = {}
+
+# Redis
+REDIS_HOST = env.str("REDIS_HOST", default="localhost")
+REDIS_PORT = env.int("REDIS_PORT", default=6379)
+REDIS_URL = env.str("REDIS_URL", default=f"redis://{REDIS_HOST}:{REDIS_PORT}/0")
+
+# Cache
+# Used for the lookups of the WebSocket handshake (users and room memberships),
+# kept for LOOKUP_CACHE_TTL seconds and dropped by signals when they change.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": REDIS_URL,
+        "KEY_PREFIX": "cache",
+    },
+}
+LOOKUP_CACHE_TTL = env.int("LOOKUP_CACHE_TTL", default=60)
 
 # Channels
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [
-                (
-                    env.str("REDIS_HOST", default="localhost"),
-                    env.int("REDIS_PORT", default=6379),
-                ),
-            ]
+            "hosts": [(REDIS_HOST, REDIS_PORT)],
         },
     },
 }
 
+# Presence
+# Online members are tracked in Redis. The RoomMember.is_online column is only a
+# periodic snapshot of it, refreshed every PRESENCE_SNAPSHOT_INTERVAL seconds
+# (0 disables the snapshot).
+PRESENCE_SNAPSHOT_INTERVAL = env.int("PRESENCE_SNAPSHOT_INTERVAL", default=60)
+# Connections expire PRESENCE_TTL seconds after their last heartbeat and are
+# removed by the reaper, which runs every PRESENCE_REAP_INTERVAL seconds.
+PRESENCE_TTL = env.int("PRESENCE_TTL", default=90)
+PRESENCE_REAP_INTERVAL = env.int("PRESENCE_REAP_INTERVAL", default=30)
+# Members joining or leaving a room within this window (in milliseconds) are sent
+# to the room in a single frame.
+PRESENCE_COALESCE_WINDOW = env.int("PRESENCE_COALESCE_WINDOW", default=250)
+# Typing indicators are sent at most once every TYPING_THROTTLE seconds per user
+# and room, and the users typing in a room within TYPING_COALESCE_WINDOW (in
+# milliseconds) are sent to it in a single frame, see core.typing_indicators.
+TYPING_THROTTLE = env.int("TYPING_THROTTLE", default=3)
+TYPING_COALESCE_WINDOW = env.int("TYPING_COALESCE_WINDOW", default=250)
+
+CELERY_BEAT_SCHEDULE["reap-expired-presence"] = {
+    "task": "core.tasks.reap_expired_presence",
+    "schedule": PRESENCE_REAP_INTERVAL,
+}
+
+if PRESENCE_SNAPSHOT_INTERVAL:
+    CELERY_BEAT_SCHEDULE["snapshot-online-status"] = {
+        "task": "core.tasks.snapshot_online_status",
+        "schedule": PRESENCE_SNAPSHOT_INTERVAL,
+    }
+
+# Message write buffer
+# When enabled, the messages received by each ASGI process are saved in bulk and
+# sent to moderation in a single task every MESSAGE_WRITE_BUFFER_SIZE messages or
+# MESSAGE_WRITE_BUFFER_INTERVAL milliseconds, whichever comes first.
+MESSAGE_WRITE_BUFFER_ENABLED = env.bool("MESSAGE_WRITE_BUFFER_ENABLED", default=False)
+MESSAGE_WRITE_BUFFER_SIZE = env.int("MESSAGE_WRITE_BUFFER_SIZE", default=50)
+MESSAGE_WRITE_BUFFER_INTERVAL = env.int("MESSAGE_WRITE_BUFFER_INTERVAL", default=100)
+
 # Logging
 LOGGING = {
     "version": 1,
@@ -248,3 +322,145 @@ LOGGING = {
 # AI
 AI_API_KEY = env.str("AI_API_KEY", default="")
 AI_MODEL = env.str("AI_MODEL", default="gemini-2.0-flash-lite")
+AI_REQUEST_TIMEOUT = env.float("AI_REQUEST_TIMEOUT", default=30)
+
+# Moderation
+# When disabled, received messages are saved pending without being sent to
+# moderation, e.g. by the benchmark_sockets command.
+MODERATION_ENABLED = env.bool("MODERATION_ENABLED", default=True)
+# Batches of pending messages are classified with a single model request. When
+# MODERATION_BATCH_INTERVAL is set (in seconds), pending messages are also swept
+# periodically, e.g. the ones left behind by failed tasks.
+MODERATION_BATCH_SIZE = env.int("MODERATION_BATCH_SIZE", default=20)
+MODERATION_BATCH_INTERVAL = env.int("MODERATION_BATCH_INTERVAL", default=0)
+# Messages are claimed by the task moderating them, so no other task moderates them
+# meanwhile, for up to MODERATION_CLAIM_TIMEOUT seconds, after which they can be
+# moderated again, e.g. if their worker died.
+MODERATION_CLAIM_TIMEOUT = env.int("MODERATION_CLAIM_TIMEOUT", default=300)
+# When enabled, batches are classified with up to MODERATION_CONCURRENCY concurrent
+# model requests, one per content, on the worker's event loop, and saved and sent
+# once all their verdicts arrive.
+MODERATION_ASYNC_ENABLED = env.bool("MODERATION_ASYNC_ENABLED", default=False)
+MODERATION_CONCURRENCY = env.int("MODERATION_CONCURRENCY", default=20)
+# Messages whose model request failed are moderated again after
+# MODERATION_RETRY_BACKOFF seconds, doubled on each retry, up to
+# MODERATION_MAX_RETRIES times.
+MODERATION_RETRY_BACKOFF = env.float("MODERATION_RETRY_BACKOFF", default=2)
+MODERATION_MAX_RETRIES = env.int("MODERATION_MAX_RETRIES", default=6)
+
+if MODERATION_BATCH_INTERVAL:
+    CELERY_BEAT_SCHEDULE["moderate-pending-messages"] = {
+        "task": (
+            "core.tasks.moderate_messages_async"
+            if MODERATION_ASYNC_ENABLED
+            else "core.tasks.moderate_messages_batch"
+        ),
+        "schedule": MODERATION_BATCH_INTERVAL,
+    }
+
+# Requests to the model provider go through a circuit breaker, opened after
+# MODERATION_BREAKER_THRESHOLD consecutive failures for MODERATION_BREAKER_COOLDOWN
+# seconds, and an adaptive concurrency limit, lowered while requests fail or are
+# slower than MODERATION_LATENCY_TARGET seconds. While the breaker is open,
+# messages are handled by MODERATION_BREAKER_FALLBACK: "hold" (moderated once the
+# provider is back), "fail_open_trusted" (approved if the author is staff, held
+# otherwise) or "fail_closed" (rejected).
+MODERATION_BREAKER_THRESHOLD = env.int("MODERATION_BREAKER_THRESHOLD", default=5)
+MODERATION_BREAKER_COOLDOWN = env.int("MODERATION_BREAKER_COOLDOWN", default=30)
+MODERATION_BREAKER_FALLBACK = env.str("MODERATION_BREAKER_FALLBACK", default="hold")
+MODERATION_LATENCY_TARGET = env.float("MODERATION_LATENCY_TARGET", default=5)
+
+# Verdicts are cached by the hash of the normalized content, in an LRU local to
+# each worker (up to MODERATION_CACHE_SIZE entries) and in Redis (for
+# MODERATION_CACHE_TTL seconds).
+MODERATION_CACHE_ENABLED = env.bool("MODERATION_CACHE_ENABLED", default=True)
+MODERATION_CACHE_SIZE = env.int("MODERATION_CACHE_SIZE", default=10000)
+MODERATION_CACHE_TTL = env.int("MODERATION_CACHE_TTL", default=60 * 60 * 24)
+
+# Contents decided by the local prefilters (dotted paths, tried in order) never
+# reach the model: the ones containing a word or phrase of MODERATION_BLOCKLIST are
+# rejected, and the ones in MODERATION_ALLOWLIST or made only of emojis approved.
+MODERATION_PREFILTERS = env.list(
+    "MODERATION_PREFILTERS",
+    default=[
+        "core.prefilter.BlocklistPrefilter",
+        "core.prefilter.AllowlistPrefilter",
+    ],
+)
+MODERATION_BLOCKLIST = env.list("MODERATION_BLOCKLIST", default=[])
+MODERATION_ALLOWLIST = env.list(
+    "MODERATION_ALLOWLIST",
+    default=[
+        "ok",
+        "okay",
+        "k",
+        "yes",
+        "no",
+        "hi",
+        "hello",
+        "hey",
+        "bye",
+        "lol",
+        "haha",
+        "thanks",
+        "thank you",
+        "good morning",
+        "good night",
+    ],
+)
+
+# Fair moderation queue
+# When enabled, messages wait for moderation in per-room queues, grouped in lanes
+# by the number of members of the room (the first lane whose max_members fits).
+# Rooms of a lane are drained round-robin, and lanes by weight.
+MODERATION_FAIR_QUEUE_ENABLED = env.bool("MODERATION_FAIR_QUEUE_ENABLED", default=False)
+MODERATION_QUEUE_BACKEND = "core.moderation_queue.RedisQueueBackend"
+MODERATION_LANES = [
+    {"name": "direct", "max_members": 2, "weight": 4},
+    {"name": "small", "max_members": 20, "weight": 2},
+    {"name": "broadcast", "max_members": None, "weight": 1},
+]
+# Dequeued messages stay claimed until moderated, and are queued again once their
+# claim expires (see MODERATION_CLAIM_TIMEOUT), the queue being drained as often.
+
+if MODERATION_FAIR_QUEUE_ENABLED:
+    CELERY_BEAT_SCHEDULE["drain-moderation-queue"] = {
+        "task": "core.tasks.drain_moderation_queue",
+        "schedule": MODERATION_CLAIM_TIMEOUT,
+    }
+
+# Tracing
+# TRACING_SAMPLE_RATE of the received messages are traced up to their delivery.
+# The latency histograms of each process are merged in Redis every
+# TRACING_FLUSH_INTERVAL seconds.
+TRACING_SAMPLE_RATE = env.float("TRACING_SAMPLE_RATE", default=0.01)
+TRACING_FLUSH_INTERVAL = env.int("TRACING_FLUSH_INTERVAL", default=10)
+
+# History
+# The latest HISTORY_BUFFER_SIZE approved messages of each room are kept in Redis,
+# to serve the first page of the history without querying the database.
+HISTORY_BUFFER_SIZE = env.int("HISTORY_BUFFER_SIZE", default=100)
+# Sockets resuming a connection with the sequence number of the last message they
+# received are sent the messages they missed, up to HISTORY_REPLAY_LIMIT. Beyond
+# that they are told to resync, fetching the history again.
+HISTORY_REPLAY_LIMIT = env.int("HISTORY_REPLAY_LIMIT", default=500)
+
+# WebSocket
+# Sockets of ws/rooms/ are subscribed to up to WEBSOCKET_MAX_SUBSCRIPTIONS rooms.
+WEBSOCKET_MAX_SUBSCRIPTIONS = env.int("WEBSOCKET_MAX_SUBSCRIPTIONS", default=100)
+# Frames wait to be written in a queue of up to WEBSOCKET_SEND_QUEUE_SIZE frames per
+# socket. When it is full, WEBSOCKET_SEND_QUEUE_POLICY (drop_presence,
+# collapse_presence or disconnect) decides what gives way, see core.outbound.
+WEBSOCKET_SEND_QUEUE_SIZE = env.int("WEBSOCKET_SEND_QUEUE_SIZE", default=256)
+WEBSOCKET_SEND_QUEUE_POLICY = env.str(
+    "WEBSOCKET_SEND_QUEUE_POLICY", default="collapse_presence"
+)
+# Messages sent through the sockets are rate limited with token buckets, per user
+# in each room and per room, holding up to their burst of messages and refilled at
+# their rate, in messages per minute. Rooms can override these defaults, see
+# core.rate_limit.
+MESSAGE_RATE_LIMIT_ENABLED = env.bool("MESSAGE_RATE_LIMIT_ENABLED", default=True)
+MESSAGE_USER_RATE = env.int("MESSAGE_USER_RATE", default=30)
+MESSAGE_USER_BURST = env.int("MESSAGE_USER_BURST", default=10)
+MESSAGE_ROOM_RATE = env.int("MESSAGE_ROOM_RATE", default=600)
+MESSAGE_ROOM_BURST = env.int("MESSAGE_ROOM_BURST", default=100)
@@ -5,9 +5,9 @@ from core.models import Message, Room, RoomMember
 
 @admin.register(Room)
 class RoomAdmin(admin.ModelAdmin):
-    list_display = ("name", "owner", "is_private", "created_at")
+    list_display = ("name", "owner", "is_private", "optimistic_delivery", "created_at")
     search_fields = ("name", "description")
-    list_filter = ("is_private", "created_at")
+    list_filter = ("is_private", "optimistic_delivery", "created_at")
     ordering = ("-created_at",)
 
 
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError
+
+from core import moderation_queue, tracing
+from core.loop_local import LoopLocal
+from core.models import Message, Room
+from core.tasks import (
+    broadcast_message,
+    moderate_messages_async,
+    moderate_messages_batch,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriteBuffer:
+    """
+    Buffers the messages received by the consumers of the process and saves them
+    with a single bulk insert, then sends them to moderation in a single task.
+    Messages of rooms with optimistic delivery are sent to the rooms right after
+    being saved.
+
+    The buffer is flushed when it reaches MESSAGE_WRITE_BUFFER_SIZE messages or
+    MESSAGE_WRITE_BUFFER_INTERVAL milliseconds after the first buffered message,
+    which bounds the delay added to a message. It is also flushed when a consumer
+    disconnects and when the server shuts down (see core.lifespan), so messages are
+    not lost on shutdown.
+
+    If the bulk insert fails, e.g. because a room was deleted meanwhile, the
+    messages are saved one by one, so only the invalid ones are lost.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.traces = []
+        self.timer = None
+
+    async def add(self, message, trace=None):
+        self.messages.append(message)
+        self.traces.append(trace)
+
+        if len(self.messages) >= settings.MESSAGE_WRITE_BUFFER_SIZE:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(settings.MESSAGE_WRITE_BUFFER_INTERVAL / 1000)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        Saves the buffered messages and sends them to moderation.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        messages, self.messages = self.messages, []
+        traces, self.traces = self.traces, []
+
+        if not messages:
+            return
+
+        try:
+            await database_sync_to_async(self.save)(messages, traces)
+        except Exception:
+            logger.exception(f"Failed to flush a batch of {len(messages)} messages.")
+            return
+
+        logger.debug(f"Saved a batch of {len(messages)} messages.")
+
+    def save(self, messages, traces=None):
+        buffered = messages
+
+        try:
+            messages = Message.objects.bulk_create(messages)
+        except DatabaseError:
+            logger.warning(
+                f"Failed to save a batch of {len(messages)} messages, saving them one "
+                "by one.",
+                exc_info=True,
+            )
+            messages = self.save_one_by_one(messages)
+
+        if not messages:
+            return
+
+        # Messages that failed to be saved are left without id
+        traces = {
+            message.id: trace
+            for message, trace in zip(buffered, traces or [])
+            if trace and message.id is not None
+        }
+
+        for trace in traces.values():
+            tracing.mark(trace, "saved")
+
+        optimistic_room_ids = set(
+            Room.objects.filter(
+                id__in={message.room_id for message in messages},
+                optimistic_delivery=True,
+            ).values_list("id", flat=True)
+        )
+
+        for message in messages:
+            if message.room_id in optimistic_room_ids:
+                broadcast_message(message)
+
+        if not settings.MODERATION_ENABLED:
+            return
+
+        if settings.MODERATION_FAIR_QUEUE_ENABLED:
+            moderation_queue.enqueue(messages)
+            return
+
+        message_ids = [message.id for message in messages]
+        # The traces are passed along with the ids, see core.tasks.get_traces
+        options = (
+            {"traces": [traces.get(message_id) for message_id in message_ids]}
+            if traces
+            else {}
+        )
+
+        if settings.MODERATION_ASYNC_ENABLED:
+            moderate_messages_async.delay(message_ids, **options)
+        else:
+            moderate_messages_batch.delay(message_ids, **options)
+
+    @staticmethod
+    def save_one_by_one(messages):
+        """
+        Saves the messages one by one and returns the ones that were saved.
+        """
+        saved = []
+
+        for message in messages:
+            # The ids returned by the failed insert were rolled back
+            message.pk = None
+            message._state.adding = True
+
+            try:
+                message.save()
+            except DatabaseError:
+                logger.exception(
+                    f"Failed to save a message of user {message.author_id} to room "
+                    f"{message.room_id}."
+                )
+            else:
+                saved.append(message)
+
+        return saved
+
+
+_buffers = LoopLocal(MessageWriteBuffer)
+
+
+def get_write_buffer():
+    """
+    Returns the message write buffer of the running event loop.
+    """
+    return _buffers.get()
+
+
+async def flush_write_buffer():
+    """
+    Flushes the message write buffer of the running event loop, if it has one.
+    """
+    buffer = _buffers.peek()
+
+    if buffer is not None:
+        await buffer.flush()
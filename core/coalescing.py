@@ -0,0 +1,73 @@
+"""
+Coalescing of the ephemeral events of the rooms (presence deltas, typing users):
+the changes of each room are buffered for a short window, then merged into a
+single frame, so a burst of changes costs a single group send per room.
+"""
+
+import asyncio
+import logging
+
+import channels.layers
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class RoomCoalescer:
+    """
+    Buffers the changes of each room and sends them to the room in a single
+    `event_type` event once the coalesce window is over, the `window_setting`
+    setting in milliseconds (sent at once if 0).
+
+    Subclasses merge each change into the pending ones of the room (`merge`) and
+    encode them as the frame carried by the event (`encode`). Pending changes that
+    cancel out, leaving them empty, aren't sent.
+    """
+
+    event_type = None
+    window_setting = None
+
+    def __init__(self):
+        self.pending = {}
+        self.timers = {}
+
+    def merge(self, pending, change):
+        raise NotImplementedError
+
+    def encode(self, pending):
+        raise NotImplementedError
+
+    async def add(self, room_id, change):
+        window = getattr(settings, self.window_setting) / 1000
+        self.pending[room_id] = self.merge(self.pending.get(room_id), change)
+
+        if not window:
+            await self.flush(room_id)
+        elif room_id not in self.timers:
+            self.timers[room_id] = asyncio.create_task(
+                self.flush_later(room_id, window)
+            )
+
+    async def flush_later(self, room_id, window):
+        await asyncio.sleep(window)
+        del self.timers[room_id]
+        await self.flush(room_id)
+
+    async def flush(self, room_id):
+        pending = self.pending.pop(room_id, None)
+
+        if not pending:
+            return
+
+        try:
+            channel_layer = channels.layers.get_channel_layer()
+            await channel_layer.group_send(
+                f"room_{room_id}",
+                {
+                    "type": self.event_type,
+                    "room_id": room_id,
+                    "text": self.encode(pending),
+                },
+            )
+        except Exception:
+            logger.exception(f"Failed to send {self.event_type} to room {room_id}.")
@@ -1,19 +1,304 @@
+import functools
 import json
 import logging
+from urllib.parse import parse_qs
 
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
 
-from core.models import Message, Room, RoomMember
-from core.tasks import moderate_message
+from core import (
+    lookups,
+    moderation_queue,
+    presence,
+    rate_limit,
+    tracing,
+    typing_indicators,
+)
+from core.batching import get_write_buffer
+from core.models import Message, Room
+from core.outbound import OutboundQueue
+from core.serializers import ChatMessageSerializer
+from core.tasks import encode_chat_message, moderate_message
+from core.utils import release_connections
 
 logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
 
-class RoomConsumer(AsyncWebsocketConsumer):
+def releases_connections(handler):
+    """
+    Releases the database connections of the async ORM queries of the handler
+    once it returns (see core.utils.release_connections). Only the handlers
+    querying the database are wrapped, so the other frames (pings, typing) don't
+    pay the thread hop.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await handler(*args, **kwargs)
+        finally:
+            await release_connections()
+
+    return wrapper
+
+
+class BaseRoomConsumer(AsyncWebsocketConsumer):
+    """
+    Room features shared by the sockets of a single room and the multiplexed ones.
+    The frames of a room are sent with send_room_frame, which tags them with the
+    room on multiplexed sockets, so the events sent to the room groups must carry
+    their "room_id".
+
+    Once accepted, the frames and the close of the socket go through its bounded
+    outbound queue, see core.outbound.
+    """
+
+    outbound = None
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        self.outbound = OutboundQueue(self)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if self.outbound is None:
+            await super().send(text_data, bytes_data, close)
+            return
+
+        self.outbound.put(text_data)
+
+        if close:
+            await self.close(close)
+
+    async def close(self, code=None, reason=None):
+        if self.outbound is None:
+            await super().close(code, reason)
+        else:
+            self.outbound.put_close(code)
+
+    async def write(self, text):
+        await AsyncWebsocketConsumer.send(self, text_data=text)
+
+    async def write_close(self, code, reason=None):
+        await AsyncWebsocketConsumer.close(self, code, reason)
+
+    async def websocket_disconnect(self, message):
+        try:
+            await super().websocket_disconnect(message)
+        finally:
+            if self.outbound is not None:
+                self.outbound.stop()
+
+    async def websocket_connect(self, message):
+        try:
+            await super().websocket_connect(message)
+        finally:
+            await release_connections()
+
+    async def send_room_frame(self, room_id, text, presence=False, ephemeral=False):
+        """
+        Queues the encoded frame of the room. Presence frames can be dropped or
+        collapsed into a snapshot when the client falls behind, ephemeral ones are
+        dropped first.
+        """
+        self.outbound.put(
+            self.encode_room_frame(room_id, text), room_id, presence, ephemeral
+        )
+
+    def encode_room_frame(self, room_id, text):
+        return text
+
+    async def encode_members_snapshot(self, room_id):
+        members = await presence.aget_online_members(room_id)
+        return self.encode_room_frame(
+            room_id, json.dumps({"type": "update_members", "members": members})
+        )
+
+    async def join_room(self, room_id):
+        """
+        Adds the socket to the room group and to the room's online members.
+        """
+        await self.channel_layer.group_add(f"room_{room_id}", self.channel_name)
+        await self.refresh_presence(room_id)
+
+        # Sends the full list of online members only to the connected socket, the
+        # others receive just the delta
+        self.outbound.put(
+            await self.encode_members_snapshot(room_id), room_id, presence=True
+        )
+
+    async def leave_room(self, room_id):
+        """
+        Removes the socket from the room group and from the room's online members.
+        """
+        await self.channel_layer.group_discard(f"room_{room_id}", self.channel_name)
+
+        if await presence.leave(room_id, self.channel_name):
+            await presence.publish_change(room_id, self.scope["user"].username, False)
+
+    async def refresh_presence(self, room_id):
+        """
+        Registers the socket as connected to the room. Sockets must send a ping more
+        often than PRESENCE_TTL or they are considered offline by the reaper.
+        """
+        username = self.scope["user"].username
+
+        # The connection is registered again if it was reaped in the meantime
+        if await presence.join(room_id, self.channel_name, username):
+            await presence.publish_change(room_id, username, True)
+
+    async def flush_write_buffer(self):
+        if settings.MESSAGE_WRITE_BUFFER_ENABLED:
+            # Doesn't hold the messages of a closing connection, which may be the
+            # last one before the server shuts down
+            await get_write_buffer().flush()
+
+    @releases_connections
+    async def send_message(self, room_id, message_content):
+        """
+        Saves the message sent by the user to the room and sends it to moderation,
+        unless it exceeds the rate limits of the room.
+        """
+        if settings.MESSAGE_RATE_LIMIT_ENABLED:
+            retry_after = await rate_limit.take(
+                await lookups.aget_room(room_id), self.scope["user"].id
+            )
+
+            if retry_after:
+                await self.send_room_frame(
+                    room_id,
+                    json.dumps({"type": "rate_limited", "retry_after": retry_after}),
+                )
+                return
+
+        # The fair moderation queue doesn't carry traces
+        trace = None if settings.MODERATION_FAIR_QUEUE_ENABLED else tracing.start()
+
+        if settings.MESSAGE_WRITE_BUFFER_ENABLED:
+            await get_write_buffer().add(
+                Message(
+                    room_id=room_id,
+                    author=self.scope["user"],
+                    content=message_content,
+                ),
+                trace,
+            )
+            return
+
+        message = await self.save_message(room_id, message_content)
+        tracing.mark(trace, "saved")
+
+        if message.room.optimistic_delivery:
+            # Sent before moderation, which confirms or retracts it afterwards
+            await self.channel_layer.group_send(
+                f"room_{room_id}",
+                {
+                    "type": "chat_message",
+                    "room_id": room_id,
+                    "text": encode_chat_message(message),
+                },
+            )
+
+        if settings.MODERATION_ENABLED:
+            if settings.MODERATION_FAIR_QUEUE_ENABLED:
+                await database_sync_to_async(moderation_queue.enqueue)([message])
+            else:
+                moderate_message.delay(message.id, trace=trace)
+
+        await tracing.aflush()
+
+    @releases_connections
+    async def replay(self, room_id, last_seq):
+        """
+        Sends the approved messages following last_seq in a single frame, or tells
+        the socket to resync if it missed too many of them.
+        """
+        frame = await self.get_replay_frame(room_id, last_seq)
+        await self.send_room_frame(room_id, json.dumps(frame))
+
+    async def chat_message(self, event):
+        """
+        Handles the chat message event sent from the group. The event comes from
+        Celery moderation task, or from the consumer that received the message in
+        rooms with optimistic delivery, and carries the already encoded frame.
+        """
+        await self.send_room_frame(event["room_id"], event["text"])
+
+        if "trace" in event:
+            tracing.mark(event["trace"], "delivered")
+            await tracing.aflush()
+
+    async def message_confirmed(self, event):
+        """
+        Handles the confirmation of a message sent to a room with optimistic
+        delivery, after it was approved by the Celery moderation task.
+        """
+        await self.send_room_frame(event["room_id"], event["text"])
+
+    async def message_retracted(self, event):
+        """
+        Handles the retraction of a message sent to a room with optimistic delivery,
+        after it was rejected by the Celery moderation task.
+        """
+        await self.send_room_frame(event["room_id"], event["text"])
+
+    async def members_delta(self, event):
+        """
+        Handles the members delta event sent from the group, with the members that
+        joined or left the room. The event comes from the presence coalescer and
+        carries the already encoded frame.
+        """
+        await self.send_room_frame(event["room_id"], event["text"], presence=True)
+
+    async def typing(self, event):
+        """
+        Handles the typing event sent from the group, with the users typing in the
+        room. The event comes from the typing coalescer and carries the already
+        encoded frame.
+        """
+        await self.send_room_frame(event["room_id"], event["text"], ephemeral=True)
+
+    async def get_replay_frame(self, room_id, last_seq):
+        room_last_seq = await Room.objects.values_list("last_seq", flat=True).aget(
+            id=room_id
+        )
+
+        # A sequence number ahead of the room's doesn't come from this room
+        if not 0 <= room_last_seq - last_seq <= settings.HISTORY_REPLAY_LIMIT:
+            return {"type": "resync", "last_seq": room_last_seq}
+
+        messages = ChatMessageSerializer(
+            [
+                message
+                async for message in Message.objects.filter(
+                    room_id=room_id,
+                    status=Message.Status.APPROVED,
+                    seq__gt=last_seq,
+                )
+                .select_related("author")
+                .order_by("seq")
+            ],
+            many=True,
+        ).data
+
+        # Messages approved after the room was read are sent too
+        if messages:
+            room_last_seq = max(room_last_seq, messages[-1]["seq"])
+
+        return {"type": "replay", "last_seq": room_last_seq, "messages": messages}
+
+    async def save_message(self, room_id, content):
+        return await Message.objects.acreate(
+            room=await lookups.aget_room(room_id),
+            author=self.scope["user"],
+            content=content,
+        )
+
+
+class RoomConsumer(BaseRoomConsumer):
     async def connect(self):
         if self.scope["user"].is_anonymous:
             logger.debug("User is anonymous, closing connection.")
@@ -39,12 +324,15 @@ class RoomConsumer(AsyncWebsocketConsumer):
             await self.close()
             return
 
-        # Adds the user to the group
-        self.room_group_name = f"room_{self.room_id}"
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.join_room(self.room_id)
+
+        # Reconnecting sockets pass the sequence number of the last message they
+        # received, to get only the ones they missed
+        query_params = parse_qs(self.scope["query_string"].decode())
+        last_seq = parse_int(query_params.get("last_seq", [None])[0])
 
-        await self.update_online_status(True)
-        await self.broadcast_members_online()
+        if last_seq is not None:
+            await self.replay(self.room_id, last_seq)
 
         logger.debug(f"User {self.scope['user'].id} connected to room {self.room_id}.")
 
@@ -55,11 +343,8 @@ class RoomConsumer(AsyncWebsocketConsumer):
         if self.scope["user"].is_anonymous or not self.is_room_member:
             return
 
-        # Removes the user from the group
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-
-        await self.update_online_status(False)
-        await self.broadcast_members_online()
+        await self.flush_write_buffer()
+        await self.leave_room(self.room_id)
 
         logger.debug(
             f"User {self.scope['user'].id} disconnected from room {self.room_id}."
@@ -68,99 +353,184 @@ class RoomConsumer(AsyncWebsocketConsumer):
     async def receive(self, text_data):
         logger.debug(f"Received message from user {self.scope['user'].id}: {text_data}")
         data = json.loads(text_data)
-        message_content = data["message"]
-        message = await self.save_message(message_content)
-        moderate_message.delay(message.id)
 
-    async def chat_message(self, event):
+        if data.get("type") == "ping":
+            await self.heartbeat()
+            return
+
+        if data.get("type") == "resume":
+            last_seq = parse_int(data.get("last_seq"))
+
+            if last_seq is not None:
+                await self.replay(self.room_id, last_seq)
+
+            return
+
+        if data.get("type") == "typing":
+            await typing_indicators.publish(self.room_id, self.scope["user"])
+            return
+
+        await self.send_message(self.room_id, data["message"])
+
+    async def heartbeat(self):
         """
-        Handles the chat message event sent from the group. The event comes from
-        Celery moderation task.
+        Keeps the connection presence alive.
+        """
+        await self.refresh_presence(self.room_id)
+        await self.send(text_data=json.dumps({"type": "pong"}))
+
+    async def user_is_room_member(self):
+        """
+        Checks if the user is a member of the room.
+        Returns True if the user is a member, False otherwise.
         """
-        message = await self.get_message(event["message_id"])
+        return await lookups.ais_member(self.scope["user"].id, self.room_id)
+
+
+class MultiplexConsumer(BaseRoomConsumer):
+    """
+    Socket subscribed to any number of the user's rooms, so following many rooms
+    takes a single connection, authentication and membership query. The frames of
+    the rooms are tagged with a "room" key.
+
+    Frames sent by the client:
+
+    - {"type": "subscribe", "rooms": [ids], "last_seq": {id: seq}}: subscribes to
+      the rooms the user is a member of, up to WEBSOCKET_MAX_SUBSCRIPTIONS, and
+      replays the messages missed in the ones with a sequence number;
+    - {"type": "unsubscribe", "rooms": [ids]};
+    - {"type": "message", "room": id, "message": content};
+    - {"type": "resume", "room": id, "last_seq": seq};
+    - {"type": "typing", "room": id}, while the user types;
+    - {"type": "ping"}, keeping the presence alive in all the rooms.
+    """
+
+    async def connect(self):
+        if self.scope["user"].is_anonymous:
+            logger.debug("User is anonymous, closing connection.")
+            await self.close()
+            return
+
+        self.room_ids = set()
+        await self.accept()
+
+        logger.debug(f"User {self.scope['user'].id} connected to the rooms socket.")
+
+    async def disconnect(self, close_code):
+        if self.scope["user"].is_anonymous:
+            return
+
+        await self.flush_write_buffer()
+
+        for room_id in self.room_ids:
+            await self.leave_room(room_id)
+
+        logger.debug(
+            f"User {self.scope['user'].id} disconnected from {len(self.room_ids)} "
+            "room(s)."
+        )
+
+    async def receive(self, text_data):
+        logger.debug(f"Received message from user {self.scope['user'].id}: {text_data}")
+        data = json.loads(text_data)
+        frame_type = data.get("type")
+
+        if frame_type == "ping":
+            for room_id in self.room_ids:
+                await self.refresh_presence(room_id)
+
+            await self.send(text_data=json.dumps({"type": "pong"}))
+            return
+
+        if frame_type == "subscribe":
+            await self.subscribe(data.get("rooms", []), data.get("last_seq") or {})
+            return
+
+        if frame_type == "unsubscribe":
+            await self.unsubscribe(data.get("rooms", []))
+            return
+
+        room_id = parse_int(data.get("room"))
+
+        if room_id not in self.room_ids:
+            await self.send(
+                text_data=json.dumps({"type": "user_not_member", "room": room_id})
+            )
+            return
+
+        if frame_type == "resume":
+            last_seq = parse_int(data.get("last_seq"))
+
+            if last_seq is not None:
+                await self.replay(room_id, last_seq)
+        elif frame_type == "message":
+            await self.send_message(room_id, data["message"])
+        elif frame_type == "typing":
+            await typing_indicators.publish(room_id, self.scope["user"])
+
+    @releases_connections
+    async def subscribe(self, room_ids, last_seqs):
+        room_ids = {parse_int(room_id) for room_id in room_ids} - {None}
+        room_ids -= self.room_ids
+        available = settings.WEBSOCKET_MAX_SUBSCRIPTIONS - len(self.room_ids)
+        allowed = (
+            sorted(await self.get_member_room_ids(room_ids))[:available]
+            if room_ids
+            else []
+        )
 
         await self.send(
             text_data=json.dumps(
                 {
-                    "type": "chat_message",
-                    "id": message.id,
-                    "content": message.content,
-                    "created_at": message.created_at.isoformat(),
-                    "author": {
-                        "id": message.author.id,
-                        "username": message.author.username,
-                    },
+                    "type": "subscribed",
+                    "rooms": allowed,
+                    "denied": sorted(room_ids.difference(allowed)),
                 }
             )
         )
 
-    async def update_members(self, event):
-        """
-        Handles the update members event sent from the group. The event comes from
-        the broadcast_members_online method.
-        """
+        for room_id in allowed:
+            self.room_ids.add(room_id)
+            await self.join_room(room_id)
+            last_seq = parse_int(last_seqs.get(str(room_id)))
+
+            if last_seq is not None:
+                await self.replay(room_id, last_seq)
+
+    async def unsubscribe(self, room_ids):
+        room_ids = {parse_int(room_id) for room_id in room_ids} & self.room_ids
+
+        for room_id in room_ids:
+            self.room_ids.discard(room_id)
+            await self.leave_room(room_id)
+
         await self.send(
-            text_data=json.dumps(
-                {"type": "update_members", "members": event["members"]}
-            )
+            text_data=json.dumps({"type": "unsubscribed", "rooms": sorted(room_ids)})
         )
 
-    async def broadcast_members_online(self):
-        """
-        Broadcasts the updated list of online members to all users in the room. Called
-        when a user connects or disconnects from the room.
-        """
-        members = await self.get_online_members()
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {"type": "update_members", "members": members},
-        )
+    def encode_room_frame(self, room_id, text):
+        # Frames are encoded once for all the sockets of the room, so the room is
+        # spliced into the encoded object instead of decoding it again
+        if text == "{}":
+            return f'{{"room": {room_id}}}'
 
-    @database_sync_to_async
-    def user_is_room_member(self):
-        """
-        Checks if the user is a member of the room.
-        Returns True if the user is a member, False otherwise.
-        """
-        try:
-            user = self.scope["user"]
-            room = Room.objects.get(id=self.room_id)
-            return room.memberships.filter(user=user).exists()
-        except Room.DoesNotExist:
-            return False
-        except RoomMember.DoesNotExist:
-            return False
+        return f'{{"room": {room_id}, {text[1:]}'
 
-    @database_sync_to_async
-    def update_online_status(self, is_online):
+    async def get_member_room_ids(self, room_ids):
         """
-        Updates the online status of the user in the room.
+        Returns the ids of the rooms the user is a member of, with a single query
+        for the ones not cached.
         """
-        user = self.scope["user"]
-        member = RoomMember.objects.get(user=user.id, room=self.room_id)
-        member.is_online = is_online
-        member.save()
+        return await lookups.aget_member_room_ids(self.scope["user"].id, room_ids)
 
-    @database_sync_to_async
-    def get_online_members(self):
-        """
-        Retrieves the list of online members in the room.
-        Returns a list of usernames of online members.
-        """
-        room = Room.objects.get(id=self.room_id)
-        members = room.memberships.filter(is_online=True).values_list(
-            "user__username", flat=True
-        )
-        return list(members)
 
-    @database_sync_to_async
-    def save_message(self, content):
-        room = Room.objects.get(id=self.room_id)
-        message = Message.objects.create(
-            room=room, author=self.scope["user"], content=content
-        )
-        return message
+def parse_int(value):
+    """
+    Returns the id or sequence number sent by a socket, or None if it isn't valid.
+    """
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
 
-    @database_sync_to_async
-    def get_message(self, message_id):
-        return Message.objects.filter(id=message_id).prefetch_related("author").first()
+    return number if number >= 0 else None
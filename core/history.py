@@ -0,0 +1,135 @@
+"""
+Latest approved messages of each room, kept in Redis so the first page of the
+history is served without querying the database.
+
+Each room has a sorted set of up to HISTORY_BUFFER_SIZE messages, already
+serialized as the messages endpoint returns them, ordered by (created_at, id) like
+its pages. Approved messages are added by the moderation tasks, which approve them
+in any order; deleting or editing a message drops the buffer of its room. A missing buffer (never built, dropped or lost with a Redis
+restart) is rebuilt from the database on the next read.
+
+Each change bumps a version key, so a rebuild racing with a change is discarded
+instead of caching a stale snapshot.
+"""
+
+import json
+import logging
+
+from django.conf import settings
+from redis.exceptions import WatchError
+
+from core.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# KEYS: buffer, version
+# ARGV: score, member, size
+# Adds the member to the buffer, if it is built, keeping its last entries.
+APPEND_SCRIPT = """
+redis.call("INCR", KEYS[2])
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("ZADD", KEYS[1], ARGV[1], ARGV[2])
+    redis.call("ZREMRANGEBYRANK", KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+end
+"""
+
+
+def buffer_key(room_id):
+    return f"history:room:{room_id}:latest"
+
+
+def version_key(room_id):
+    return f"history:room:{room_id}:version"
+
+
+def encode_entry(message):
+    from core.serializers import MessageSerializer
+
+    return json.dumps(MessageSerializer(message).data)
+
+
+def encode_member(message):
+    """
+    Returns the (score, member) of the message in the buffer. The score is its
+    creation time in microseconds, exact in a double, and members of equal score
+    are sorted lexicographically, so by the zero-padded id they start with.
+    """
+    created_at = message.created_at
+    score = int(created_at.timestamp()) * 1_000_000 + created_at.microsecond
+    return score, f"{message.id:020d}:{encode_entry(message)}"
+
+
+def decode_member(member):
+    return json.loads(member.split(":", 1)[1])
+
+
+def append(messages):
+    """
+    Adds the approved messages to the buffers of their rooms.
+    """
+    with get_redis().pipeline(transaction=False) as pipe:
+        for message in messages:
+            pipe.eval(
+                APPEND_SCRIPT,
+                2,
+                buffer_key(message.room_id),
+                version_key(message.room_id),
+                *encode_member(message),
+                settings.HISTORY_BUFFER_SIZE,
+            )
+        pipe.execute()
+
+
+def invalidate(room_id):
+    """
+    Drops the buffer of the room, to be rebuilt on the next read.
+    """
+    with get_redis().pipeline(transaction=False) as pipe:
+        pipe.incr(version_key(room_id))
+        pipe.delete(buffer_key(room_id))
+        pipe.execute()
+
+
+def get_latest(room_id):
+    """
+    Returns the latest approved messages of the room, serialized and in
+    chronological order, rebuilding the buffer if needed.
+    """
+    members = get_redis().zrange(buffer_key(room_id), 0, -1)
+
+    if members:
+        return [decode_member(member) for member in members]
+
+    return rebuild(room_id)
+
+
+def rebuild(room_id):
+    """
+    Builds the buffer of the room from the database and returns its messages.
+    The buffer isn't stored if the room changed meanwhile.
+    """
+    from core.models import Message
+
+    with get_redis().pipeline() as pipe:
+        pipe.watch(version_key(room_id))
+        messages = list(
+            Message.objects.filter(room_id=room_id, status=Message.Status.APPROVED)
+            .select_related("author")
+            .order_by("-created_at", "-id")[: settings.HISTORY_BUFFER_SIZE]
+        )[::-1]
+        members = dict(encode_member(message)[::-1] for message in messages)
+
+        if members:
+            try:
+                pipe.multi()
+                pipe.delete(buffer_key(room_id))
+                pipe.zadd(buffer_key(room_id), members)
+                pipe.execute()
+            except WatchError:
+                logger.debug(f"Room {room_id} changed, its history buffer is dropped.")
+
+    return [decode_member(member) for member in members]
+
+
+def clear(room_id):
+    get_redis().delete(buffer_key(room_id), version_key(room_id))
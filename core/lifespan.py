@@ -0,0 +1,29 @@
+"""
+ASGI lifespan handler, flushing the message write buffer of the process when the
+server shuts down, after its connections are closed.
+
+Servers without lifespan support, such as Daphne, only rely on the consumers
+flushing it when they disconnect.
+"""
+
+import logging
+
+from core.batching import flush_write_buffer
+
+logger = logging.getLogger(__name__)
+
+
+async def application(scope, receive, send):
+    while True:
+        event = await receive()
+
+        if event["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif event["type"] == "lifespan.shutdown":
+            try:
+                await flush_write_buffer()
+            except Exception:
+                logger.exception("Failed to flush the message write buffer.")
+
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,161 @@
+"""
+Cached lookups of the WebSocket handshake and messages: the user of a token, the
+room memberships of the users, the rooms and their member counts.
+
+Entries are kept for LOOKUP_CACHE_TTL seconds in the default cache and dropped by
+the signals in core.signals when users, memberships or rooms change, so warm
+connections don't query the database at all. Users are cached without their
+password hash, only with the fields the sockets use.
+"""
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db.models import Count
+
+User = get_user_model()
+
+# Fields of the cached users
+USER_FIELDS = ["id", "username", "is_staff", "is_active"]
+
+
+def user_key(user_id):
+    return f"lookups:user_fields:{user_id}"
+
+
+def membership_key(user_id, room_id):
+    return f"lookups:membership:{user_id}:{room_id}"
+
+
+def room_key(room_id):
+    return f"lookups:room:{room_id}"
+
+
+def member_count_key(room_id):
+    return f"lookups:member_count:{room_id}"
+
+
+async def aget_user(user_id):
+    """
+    Returns the user with the id, or None if it doesn't exist. Only USER_FIELDS are
+    cached, the other fields of the user are loaded when accessed.
+    """
+    fields = await cache.aget(user_key(user_id))
+
+    if fields is None:
+        user = await User.objects.only(*USER_FIELDS).filter(id=user_id).afirst()
+
+        if user is None:
+            return None
+
+        fields = {field: getattr(user, field) for field in USER_FIELDS}
+        await cache.aset(user_key(user_id), fields, settings.LOOKUP_CACHE_TTL)
+
+    return User.from_db(
+        None,
+        list(fields),
+        [
+            fields[field.attname]
+            for field in User._meta.concrete_fields
+            if field.attname in fields
+        ],
+    )
+
+
+async def ais_member(user_id, room_id):
+    """
+    Returns True if the user is a member of the room.
+    """
+    return room_id in await aget_member_room_ids(user_id, [room_id])
+
+
+async def aget_member_room_ids(user_id, room_ids):
+    """
+    Returns the ids of the rooms the user is a member of, among the given ones,
+    querying the uncached ones at once.
+    """
+    keys = {membership_key(user_id, room_id): room_id for room_id in room_ids}
+    cached = await cache.aget_many(keys)
+    missing = [room_id for key, room_id in keys.items() if key not in cached]
+
+    if missing:
+        from core.models import RoomMember
+
+        member_room_ids = {
+            room_id
+            async for room_id in RoomMember.objects.filter(
+                user_id=user_id, room_id__in=missing
+            ).values_list("room_id", flat=True)
+        }
+        fetched = {
+            membership_key(user_id, room_id): room_id in member_room_ids
+            for room_id in missing
+        }
+        await cache.aset_many(fetched, settings.LOOKUP_CACHE_TTL)
+        cached.update(fetched)
+
+    return {room_id for key, room_id in keys.items() if cached[key]}
+
+
+async def aget_room(room_id):
+    """
+    Returns the room with the id. Raises Room.DoesNotExist if it doesn't exist.
+    """
+    from core.models import Room
+
+    room = await cache.aget(room_key(room_id))
+
+    if room is None:
+        room = await Room.objects.aget(id=room_id)
+        await cache.aset(room_key(room_id), room, settings.LOOKUP_CACHE_TTL)
+
+    return room
+
+
+def get_member_counts(room_ids):
+    """
+    Returns the member count of each of the rooms, querying the uncached ones at
+    once.
+    """
+    keys = {member_count_key(room_id): room_id for room_id in room_ids}
+    cached = cache.get_many(keys)
+    missing = [room_id for key, room_id in keys.items() if key not in cached]
+
+    if missing:
+        from core.models import RoomMember
+
+        counts = dict(
+            RoomMember.objects.filter(room_id__in=missing)
+            .values("room_id")
+            .annotate(count=Count("id"))
+            .values_list("room_id", "count")
+        )
+        fetched = {
+            member_count_key(room_id): counts.get(room_id, 0) for room_id in missing
+        }
+        cache.set_many(fetched, settings.LOOKUP_CACHE_TTL)
+        cached.update(fetched)
+
+    return {room_id: cached[key] for key, room_id in keys.items()}
+
+
+def invalidate_user(user_id):
+    cache.delete(user_key(user_id))
+
+
+def invalidate_memberships(user_ids, room_ids):
+    keys = [
+        membership_key(user_id, room_id) for user_id in user_ids for room_id in room_ids
+    ]
+
+    if keys:
+        cache.delete_many(keys)
+
+
+def invalidate_room(room_id):
+    cache.delete(room_key(room_id))
+
+
+def invalidate_member_counts(room_ids):
+    if room_ids:
+        cache.delete_many([member_count_key(room_id) for room_id in room_ids])
@@ -0,0 +1,32 @@
+import asyncio
+import weakref
+
+
+class LoopLocal:
+    """
+    Holds an instance of the factory per event loop, created on first use in the
+    loop and dropped along with it. Used for the objects bound to their loop, e.g.
+    asyncio Redis clients or those running tasks (coalescers, write buffers).
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.instances = weakref.WeakKeyDictionary()
+
+    def get(self):
+        """
+        Returns the instance of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        instance = self.instances.get(loop)
+
+        if instance is None:
+            instance = self.instances[loop] = self.factory()
+
+        return instance
+
+    def peek(self):
+        """
+        Returns the instance of the running event loop, or None if it has none yet.
+        """
+        return self.instances.get(asyncio.get_running_loop())
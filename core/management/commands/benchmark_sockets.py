@@ -0,0 +1,131 @@
+import asyncio
+import random
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from config.asgi import application
+from core import presence
+from core.models import Message, Room, RoomMember
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the connect and message throughput of the room sockets, in "
+        "process, against a throwaway copy of the configured database, dropped "
+        "afterwards, and the configured Redis and channel layer. Messages aren't "
+        "sent to moderation nor rate limited."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=100)
+        parser.add_argument("--messages", type=int, default=1000)
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=20,
+            help="Connections opened at the same time.",
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=60,
+            help="Seconds to wait for the messages to be saved.",
+        )
+
+    def handle(self, *args, **options):
+        # The benchmark database is created like the test one, test_ prefixed
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+
+        try:
+            # Ids far beyond the real ones, as Redis and the channel layer are shared
+            user = User.objects.create_user(
+                id=random.randrange(1 << 30, 1 << 31),
+                username=f"benchmark-{uuid.uuid4().hex[:8]}",
+            )
+            room = Room.objects.create(
+                id=random.randrange(1 << 52, 1 << 53), name="Benchmark", owner=user
+            )
+            RoomMember.objects.create(user=user, room=room)
+
+            try:
+                with override_settings(
+                    MESSAGE_RATE_LIMIT_ENABLED=False, MODERATION_ENABLED=False
+                ):
+                    async_to_sync(self.run)(user, room, **options)
+            finally:
+                presence.clear(room.id)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    async def run(
+        self, user, room, connections, messages, concurrency, timeout, **options
+    ):
+        url = f"/ws/rooms/{room.id}/?token={AccessToken.for_user(user)}"
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def connect():
+            async with semaphore:
+                started_at = time.perf_counter()
+                communicator = WebsocketCommunicator(application, url)
+                connected, _ = await communicator.connect()
+
+                if not connected:
+                    raise RuntimeError("The benchmark socket was refused.")
+
+                # The handshake is over once the online members are received
+                await communicator.receive_from(timeout=10)
+                latencies.append(time.perf_counter() - started_at)
+                return communicator
+
+        started_at = time.perf_counter()
+        communicators = await asyncio.gather(*[connect() for _ in range(connections)])
+        self.report("connect", connections, time.perf_counter() - started_at)
+        latencies.sort()
+        self.stdout.write(
+            f"  latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+            f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms"
+        )
+
+        started_at = time.perf_counter()
+
+        try:
+            for i in range(messages):
+                await communicators[i % connections].send_json_to({"message": f"{i}"})
+
+            # Messages are handled once they are saved
+            while True:
+                saved = await Message.objects.filter(room=room).acount()
+
+                if saved >= messages:
+                    break
+
+                if time.perf_counter() - started_at > timeout:
+                    raise CommandError(
+                        f"Only {saved} of the {messages} messages were saved in "
+                        f"{timeout:g} s."
+                    )
+
+                await asyncio.sleep(0.01)
+
+            self.report("message", messages, time.perf_counter() - started_at)
+        finally:
+            for communicator in communicators:
+                await communicator.disconnect()
+
+    def report(self, name, count, seconds):
+        self.stdout.write(
+            f"{count} {name}(s) in {seconds:.2f} s: {count / seconds:.0f} {name}(s)/s"
+        )
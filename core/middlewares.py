@@ -1,13 +1,11 @@
 from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
-from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
-from django.db import close_old_connections
 from rest_framework_simplejwt.tokens import AccessToken
 
-User = get_user_model()
+from core import lookups
+from core.utils import release_connections
 
 
 class JWTAuthMiddleware(BaseMiddleware):
@@ -16,8 +14,6 @@ class JWTAuthMiddleware(BaseMiddleware):
     """
 
     async def __call__(self, scope, receive, send):
-        close_old_connections()
-
         if "user" not in scope or isinstance(scope["user"], AnonymousUser):
             # Extract the token from the query string
             query_string = scope["query_string"].decode()
@@ -32,6 +28,7 @@ class JWTAuthMiddleware(BaseMiddleware):
 
                     # Get the user object
                     scope["user"] = await self.get_user(user_id)
+                    await release_connections()
                 except Exception:
                     scope["user"] = AnonymousUser()
             else:
@@ -39,9 +36,5 @@ class JWTAuthMiddleware(BaseMiddleware):
 
         return await self.inner(scope, receive, send)
 
-    @database_sync_to_async
-    def get_user(self, user_id):
-        try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return AnonymousUser()
+    async def get_user(self, user_id):
+        return await lookups.aget_user(user_id) or AnonymousUser()
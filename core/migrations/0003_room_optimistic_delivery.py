@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 11:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0002_alter_room_members_alter_roommember_room_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="optimistic_delivery",
+            field=models.BooleanField(default=False),
+        ),
+    ]
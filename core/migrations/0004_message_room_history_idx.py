@@ -0,0 +1,21 @@
+# Generated by Django 5.2 on 2026-10-18 11:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0003_room_optimistic_delivery"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["room", "status", "created_at", "id"],
+                name="message_room_history_idx",
+            ),
+        ),
+    ]
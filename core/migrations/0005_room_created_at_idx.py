@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 11:45
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0004_message_room_history_idx"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="room",
+            index=models.Index(fields=["created_at", "id"], name="room_created_at_idx"),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-18 11:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0005_room_created_at_idx"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="seq",
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="last_seq",
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddConstraint(
+            model_name="message",
+            constraint=models.UniqueConstraint(
+                fields=("room", "seq"), name="message_room_seq_unique"
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0006_message_seq"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="message_burst",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="message_rate",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="user_message_burst",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="room",
+            name="user_message_rate",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
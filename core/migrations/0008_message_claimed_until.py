@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0007_room_message_rate_limits"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="claimed_until",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2 on 2026-10-18 13:22
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+
+def number_approved_messages(apps, schema_editor):
+    """
+    Numbers the approved messages of each room in (created_at, id) order, as the
+    ones approved before the seq column existed have none. The seqs assigned since
+    are renumbered too, so the whole room follows the same order.
+    """
+    Message = apps.get_model("core", "Message")
+    Room = apps.get_model("core", "Room")
+
+    for room_id in Room.objects.values_list("id", flat=True).iterator():
+        # Locked like assign_seqs does, so approvals wait for the numbering
+        Room.objects.select_for_update().filter(id=room_id).exists()
+
+        # Cleared first, so the new seqs can't collide with the old ones
+        Message.objects.filter(room_id=room_id).update(seq=None)
+        message_ids = (
+            Message.objects.filter(room_id=room_id, status="approved")
+            .order_by("created_at", "id")
+            .values_list("id", flat=True)
+            .iterator()
+        )
+        messages = [
+            Message(id=message_id, seq=seq)
+            for seq, message_id in enumerate(message_ids, start=1)
+        ]
+        Message.objects.bulk_update(messages, ["seq"], batch_size=BATCH_SIZE)
+        Room.objects.filter(id=room_id).update(last_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0008_message_claimed_until"),
+    ]
+
+    operations = [
+        migrations.RunPython(number_approved_messages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2 on 2026-10-18 13:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0009_number_approved_messages"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["room", "created_at", "id", "status"],
+                name="message_room_visible_idx",
+            ),
+        ),
+    ]
@@ -5,6 +5,18 @@ class Room(models.Model):
     name = models.CharField(max_length=100)
     description = models.TextField(null=True, blank=True)
     is_private = models.BooleanField(default=True)
+    # Sends messages to the room as soon as they are received, retracting the ones
+    # rejected by moderation afterwards, instead of holding them until approved
+    optimistic_delivery = models.BooleanField(default=False)
+    # Rate limits of the messages, in messages per minute for each user and for the
+    # whole room, with their bursts. Empty ones take the defaults of the settings,
+    # see core.rate_limit
+    user_message_rate = models.PositiveIntegerField(null=True, blank=True)
+    user_message_burst = models.PositiveIntegerField(null=True, blank=True)
+    message_rate = models.PositiveIntegerField(null=True, blank=True)
+    message_burst = models.PositiveIntegerField(null=True, blank=True)
+    # Sequence number of the last approved message, see Message.seq
+    last_seq = models.PositiveBigIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     owner = models.ForeignKey(
@@ -17,6 +29,12 @@ class Room(models.Model):
         related_name="room_members",
     )
 
+    class Meta:
+        indexes = [
+            # Pages of the room list, see KeysetPagination
+            models.Index(fields=["created_at", "id"], name="room_created_at_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -44,6 +62,11 @@ class Message(models.Model):
     status = models.CharField(
         max_length=10, choices=Status.choices, default=Status.PENDING
     )
+    # Position of the message in the room, assigned on approval. Sockets resuming
+    # a connection receive the approved messages after the last one they had
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+    # Pending messages are claimed until then by the task moderating them
+    claimed_until = models.DateTimeField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     room = models.ForeignKey(Room, related_name="messages", on_delete=models.CASCADE)
@@ -51,5 +74,25 @@ class Message(models.Model):
         "auth.User", related_name="messages", on_delete=models.CASCADE
     )
 
+    class Meta:
+        indexes = [
+            # Pages of the room history, see KeysetPagination
+            models.Index(
+                fields=["room", "status", "created_at", "id"],
+                name="message_room_history_idx",
+            ),
+            # Pages of the history of rooms with optimistic delivery, which list
+            # the messages of two statuses
+            models.Index(
+                fields=["room", "created_at", "id", "status"],
+                name="message_room_visible_idx",
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["room", "seq"], name="message_room_seq_unique"
+            ),
+        ]
+
     def __str__(self):
         return f"{self.author.username} ({self.status}): {self.content[:20]}"
@@ -0,0 +1,459 @@
+"""
+Fair scheduling of the messages waiting for moderation.
+
+Messages are queued per room, and rooms are grouped in lanes by their number of
+members (MODERATION_LANES), e.g. direct messages and small rooms before broadcast
+rooms. Each lane is drained round-robin across its rooms, one message per room at
+a time, so a busy room can't delay the others. Lanes are drained by weight: in
+each round, a lane gives up to its weight in messages before the next one.
+
+Dequeued messages stay claimed until they are moderated (ack). The claims of a
+failed batch are released, putting the messages back at the head of their rooms,
+and so are the ones older than MODERATION_CLAIM_TIMEOUT, e.g. of a worker that
+died, so no message is left pending.
+
+Queuing messages starts a drain task only if none is pending, as each drain task
+moderates the queue until it is empty. The pending drain task holds a lease,
+refreshed each time it dequeues and dropped once it is done; a lease left for
+MODERATION_CLAIM_TIMEOUT seconds, e.g. by a worker that died, lets another drain
+task start.
+
+The queue is kept in Redis. LocalQueueBackend is an in-process stand-in, for tests
+and single-process development.
+"""
+
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from core import lookups
+from core.redis_client import get_redis
+
+KEY_PREFIX = "moderation:queue:"
+STATS_KEY = "moderation:queue:stats"
+CLAIMS_KEY = "moderation:queue:claims"
+CLAIMED_AT_KEY = "moderation:queue:claimed_at"
+DRAIN_KEY = "moderation:queue:drain"
+
+# KEYS: room queue, lane ring, stats hash
+# ARGV: entry, room id, lane
+# Queues the entry in the room, adding the room to the lane ring if it was idle.
+PUSH_SCRIPT = """
+if redis.call("RPUSH", KEYS[1], ARGV[1]) == 1 then
+    redis.call("RPUSH", KEYS[2], ARGV[2])
+end
+redis.call("HINCRBY", KEYS[3], ARGV[3] .. ":depth", 1)
+"""
+
+# KEYS: lane ring, stats hash, claims hash, claim times
+# ARGV: lane, room queues key prefix, current time
+# Pops the next entry of the room at the head of the lane ring, moving the room to
+# the tail while it has entries left, and claims it.
+POP_SCRIPT = """
+local room_id = redis.call("LPOP", KEYS[1])
+if not room_id then
+    return false
+end
+local room_key = ARGV[2] .. room_id
+local entry = redis.call("LPOP", room_key)
+if redis.call("LLEN", room_key) > 0 then
+    redis.call("RPUSH", KEYS[1], room_id)
+end
+if entry then
+    local message_id = string.match(entry, "^[^:]+")
+    redis.call("HINCRBY", KEYS[2], ARGV[1] .. ":depth", -1)
+    redis.call("HINCRBY", KEYS[2], ARGV[1] .. ":claimed", 1)
+    redis.call("HSET", KEYS[3], message_id, ARGV[1] .. ":" .. room_id .. ":" .. entry)
+    redis.call("ZADD", KEYS[4], ARGV[3], message_id)
+end
+return entry
+"""
+
+# KEYS: claims hash, claim times, stats hash
+# ARGV: queue key prefix, "1" to queue the entries again or "0", message ids
+# Drops the claims of the messages, queuing their entries again at the head of
+# their rooms, in the same order, if asked to.
+UNCLAIM_SCRIPT = """
+for i = #ARGV, 3, -1 do
+    local claim = redis.call("HGET", KEYS[1], ARGV[i])
+    if claim then
+        local lane, room_id, entry = string.match(claim, "^([^:]+):([^:]+):(.+)$")
+        redis.call("HINCRBY", KEYS[3], lane .. ":claimed", -1)
+        if ARGV[2] == "1" then
+            local room_key = ARGV[1] .. lane .. ":room:" .. room_id
+            if redis.call("LPUSH", room_key, entry) == 1 then
+                redis.call("RPUSH", ARGV[1] .. lane .. ":rooms", room_id)
+            end
+            redis.call("HINCRBY", KEYS[3], lane .. ":depth", 1)
+        end
+        redis.call("HDEL", KEYS[1], ARGV[i])
+        redis.call("ZREM", KEYS[2], ARGV[i])
+    end
+end
+"""
+
+
+class RedisQueueBackend:
+    """
+    Queue shared by all the processes, kept in Redis.
+    """
+
+    @staticmethod
+    def ring_key(lane):
+        return f"{KEY_PREFIX}{lane}:rooms"
+
+    @staticmethod
+    def room_key_prefix(lane):
+        return f"{KEY_PREFIX}{lane}:room:"
+
+    def push(self, lane, room_id, message_id, enqueued_at):
+        get_redis().eval(
+            PUSH_SCRIPT,
+            3,
+            f"{self.room_key_prefix(lane)}{room_id}",
+            self.ring_key(lane),
+            STATS_KEY,
+            f"{message_id}:{enqueued_at}",
+            room_id,
+            lane,
+        )
+
+    def pop(self, lane):
+        entry = get_redis().eval(
+            POP_SCRIPT,
+            4,
+            self.ring_key(lane),
+            STATS_KEY,
+            CLAIMS_KEY,
+            CLAIMED_AT_KEY,
+            lane,
+            self.room_key_prefix(lane),
+            time.time(),
+        )
+
+        if entry is None:
+            return None
+
+        message_id, enqueued_at = entry.split(":")
+        return int(message_id), float(enqueued_at)
+
+    def unclaim(self, message_ids, requeue):
+        if message_ids:
+            get_redis().eval(
+                UNCLAIM_SCRIPT,
+                3,
+                CLAIMS_KEY,
+                CLAIMED_AT_KEY,
+                STATS_KEY,
+                KEY_PREFIX,
+                "1" if requeue else "0",
+                *message_ids,
+            )
+
+    def get_expired_claims(self, claimed_before):
+        return [
+            int(message_id)
+            for message_id in get_redis().zrangebyscore(
+                CLAIMED_AT_KEY, "-inf", claimed_before
+            )
+        ]
+
+    def start_drain(self):
+        return bool(
+            get_redis().set(DRAIN_KEY, 1, nx=True, ex=settings.MODERATION_CLAIM_TIMEOUT)
+        )
+
+    def refresh_drain(self):
+        get_redis().set(DRAIN_KEY, 1, ex=settings.MODERATION_CLAIM_TIMEOUT)
+
+    def end_drain(self):
+        get_redis().delete(DRAIN_KEY)
+
+    def record(self, lane, dequeued, wait_ms):
+        with get_redis().pipeline(transaction=False) as pipe:
+            pipe.hincrby(STATS_KEY, f"{lane}:dequeued", dequeued)
+            pipe.hincrby(STATS_KEY, f"{lane}:wait_ms", wait_ms)
+            pipe.execute()
+
+    def get_stats(self):
+        return {
+            field: int(value) for field, value in get_redis().hgetall(STATS_KEY).items()
+        }
+
+    def clear(self):
+        redis = get_redis()
+        keys = list(redis.scan_iter(match=f"{KEY_PREFIX}*", count=1000))
+
+        if keys:
+            redis.delete(*keys)
+
+
+class LocalQueueBackend:
+    """
+    Queue local to the process, with the same behaviour as RedisQueueBackend.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rings = defaultdict(deque)
+        self.rooms = defaultdict(deque)
+        self.stats = defaultdict(int)
+        self.claims = {}
+        self.drain_started_at = None
+
+    def push(self, lane, room_id, message_id, enqueued_at):
+        with self.lock:
+            room = self.rooms[lane, room_id]
+
+            if not room:
+                self.rings[lane].append(room_id)
+
+            room.append((message_id, enqueued_at))
+            self.stats[f"{lane}:depth"] += 1
+
+    def pop(self, lane):
+        with self.lock:
+            ring = self.rings[lane]
+
+            if not ring:
+                return None
+
+            room_id = ring.popleft()
+            room = self.rooms[lane, room_id]
+            entry = room.popleft()
+
+            if room:
+                ring.append(room_id)
+
+            self.stats[f"{lane}:depth"] -= 1
+            self.stats[f"{lane}:claimed"] += 1
+            self.claims[entry[0]] = (lane, room_id, entry, time.time())
+            return entry
+
+    def unclaim(self, message_ids, requeue):
+        with self.lock:
+            for message_id in reversed(message_ids):
+                if message_id not in self.claims:
+                    continue
+
+                lane, room_id, entry, _ = self.claims.pop(message_id)
+                self.stats[f"{lane}:claimed"] -= 1
+
+                if requeue:
+                    room = self.rooms[lane, room_id]
+
+                    if not room:
+                        self.rings[lane].append(room_id)
+
+                    room.appendleft(entry)
+                    self.stats[f"{lane}:depth"] += 1
+
+    def get_expired_claims(self, claimed_before):
+        with self.lock:
+            return [
+                message_id
+                for message_id, (*_, claimed_at) in self.claims.items()
+                if claimed_at <= claimed_before
+            ]
+
+    def start_drain(self):
+        with self.lock:
+            now = time.time()
+
+            if (
+                self.drain_started_at
+                and now - self.drain_started_at < settings.MODERATION_CLAIM_TIMEOUT
+            ):
+                return False
+
+            self.drain_started_at = now
+            return True
+
+    def refresh_drain(self):
+        with self.lock:
+            self.drain_started_at = time.time()
+
+    def end_drain(self):
+        with self.lock:
+            self.drain_started_at = None
+
+    def record(self, lane, dequeued, wait_ms):
+        with self.lock:
+            self.stats[f"{lane}:dequeued"] += dequeued
+            self.stats[f"{lane}:wait_ms"] += wait_ms
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def clear(self):
+        with self.lock:
+            self.rings.clear()
+            self.rooms.clear()
+            self.stats.clear()
+            self.claims.clear()
+            self.drain_started_at = None
+
+
+_backend = None
+
+
+def get_backend():
+    """
+    Returns the backend of MODERATION_QUEUE_BACKEND, building it on the first call.
+    """
+    global _backend
+
+    if _backend is None:
+        _backend = import_string(settings.MODERATION_QUEUE_BACKEND)()
+
+    return _backend
+
+
+@receiver(setting_changed)
+def reset_backend(*, setting, **kwargs):
+    global _backend
+
+    if setting == "MODERATION_QUEUE_BACKEND":
+        _backend = None
+
+
+def get_lane(member_count):
+    """
+    Returns the name of the first lane accepting rooms with that many members.
+    """
+    for lane in settings.MODERATION_LANES:
+        if lane["max_members"] is None or member_count <= lane["max_members"]:
+            return lane["name"]
+
+    return settings.MODERATION_LANES[-1]["name"]
+
+
+def enqueue(messages):
+    """
+    Queues the messages for moderation, in the lanes of their rooms, and starts a
+    task to drain the queue unless one is pending.
+    """
+    from core.tasks import drain_moderation_queue
+
+    member_counts = lookups.get_member_counts({message.room_id for message in messages})
+    backend = get_backend()
+    now = time.time()
+
+    for message in messages:
+        lane = get_lane(member_counts.get(message.room_id, 0))
+        backend.push(lane, message.room_id, message.id, now)
+
+    if backend.start_drain():
+        drain_moderation_queue.delay()
+
+
+def dequeue(count):
+    """
+    Returns the ids of up to `count` queued messages, taken from the lanes by
+    weight and from the rooms of each lane round-robin.
+    """
+    backend = get_backend()
+    lanes = list(settings.MODERATION_LANES)
+    message_ids = []
+    now = time.time()
+
+    while lanes and len(message_ids) < count:
+        for lane in list(lanes):
+            wait_ms = 0
+            dequeued = 0
+
+            for _ in range(min(lane["weight"], count - len(message_ids))):
+                entry = backend.pop(lane["name"])
+
+                if entry is None:
+                    # The lane is empty
+                    lanes.remove(lane)
+                    break
+
+                message_id, enqueued_at = entry
+                message_ids.append(message_id)
+                wait_ms += int((now - enqueued_at) * 1000)
+                dequeued += 1
+
+            if dequeued:
+                backend.record(lane["name"], dequeued, wait_ms)
+
+            if len(message_ids) >= count:
+                break
+
+    return message_ids
+
+
+def ack(message_ids):
+    """
+    Drops the claims of the dequeued messages, once they are moderated.
+    """
+    get_backend().unclaim(message_ids, requeue=False)
+
+
+def release(message_ids):
+    """
+    Queues the dequeued messages again, at the head of their rooms, e.g. when their
+    moderation failed.
+    """
+    get_backend().unclaim(message_ids, requeue=True)
+
+
+def release_expired():
+    """
+    Queues again the messages claimed more than MODERATION_CLAIM_TIMEOUT seconds
+    ago, whose worker presumably died.
+    """
+    backend = get_backend()
+    message_ids = backend.get_expired_claims(
+        time.time() - settings.MODERATION_CLAIM_TIMEOUT
+    )
+    backend.unclaim(message_ids, requeue=True)
+    return message_ids
+
+
+def refresh_drain():
+    """
+    Keeps the lease of the pending drain task, called by the drain task each time
+    it dequeues so the messages queued meanwhile don't start another one.
+    """
+    get_backend().refresh_drain()
+
+
+def end_drain():
+    """
+    Lets the messages queued from now on start a drain task. Called by a drain task
+    that found the queue empty, which must dequeue once more afterwards, as
+    messages may have been queued in between, and by a failed drain task.
+    """
+    get_backend().end_drain()
+
+
+def get_stats():
+    """
+    Returns the depth of each lane, the number of its messages being moderated, the
+    number of messages taken from it and their average wait in the queue, in
+    milliseconds.
+    """
+    stats = get_backend().get_stats()
+    lanes = {}
+
+    for lane in settings.MODERATION_LANES:
+        name = lane["name"]
+        dequeued = stats.get(f"{name}:dequeued", 0)
+        lanes[name] = {
+            "depth": stats.get(f"{name}:depth", 0),
+            "claimed": stats.get(f"{name}:claimed", 0),
+            "dequeued": dequeued,
+            "average_wait_ms": (
+                stats.get(f"{name}:wait_ms", 0) / dequeued if dequeued else 0
+            ),
+        }
+
+    return lanes
@@ -0,0 +1,260 @@
+"""
+Bounded outbound queues of the sockets, so a client that stops reading can't
+make its node buffer frames without limit.
+
+Each socket queues up to WEBSOCKET_SEND_QUEUE_SIZE frames, written in order by a
+task of its own, so the consumer keeps reading its channel layer inbox (instead of
+letting it fill up and drop events silently) whatever the pace of the client.
+When the queue is full, the oldest ephemeral frame (typing indicators) is dropped
+first. Without any, WEBSOCKET_SEND_QUEUE_POLICY decides what gives way:
+
+- drop_presence: the oldest presence frame (members lists and deltas) is dropped;
+- collapse_presence: the presence frames of each room are collapsed into a single
+  snapshot of its online members, fetched when it is written;
+- disconnect: nothing is dropped.
+
+When no frame can give way, the queue is discarded and the socket is closed with
+SLOW_CONSUMER_CLOSE_CODE, without waiting for the frame being written, so it
+reconnects and resumes from the last message it received (see RoomConsumer).
+
+The queue only fills up if writing a frame waits for the client to read it, which
+depends on the ASGI server. Uvicorn, with its websockets implementation, waits
+while the transport buffer is above its high-water mark, and aborts a connection
+closed while the client doesn't read. Daphne (runserver) writes the frames to the
+transport without waiting, so they pile up in its buffer instead, unbounded.
+
+The queue depths and the counts of dropped and collapsed frames and disconnected
+sockets of each process are published to Redis for the metrics.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import weakref
+from collections import deque
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from core.redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY_PREFIX = "outbound:process:"
+STATS_INTERVAL = 10
+SLOW_CONSUMER_CLOSE_CODE = 4008
+INTERNAL_ERROR_CLOSE_CODE = 1011
+
+FRAME = "frame"
+PRESENCE = "presence"
+EPHEMERAL = "ephemeral"
+SNAPSHOT = "snapshot"
+CLOSE = "close"
+
+
+class OutboundQueue:
+    """
+    Queue of the frames to write to a socket, see the module docstring. The consumer
+    provides the write and write_close coroutines and encode_members_snapshot,
+    returning the encoded snapshot frame of a room.
+    """
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.items = deque()
+        self.ready = asyncio.Event()
+        self.closing = False
+        self.task = asyncio.create_task(self.drain())
+        stats.queues.add(self)
+
+    def put(self, text, room_id=None, presence=False, ephemeral=False):
+        kind = PRESENCE if presence else EPHEMERAL if ephemeral else FRAME
+        self.add((kind, room_id, text))
+
+    def put_close(self, code=None):
+        self.add((CLOSE, None, code))
+        self.closing = True
+
+    def add(self, item):
+        if self.closing:
+            return
+
+        if (
+            len(self.items) >= settings.WEBSOCKET_SEND_QUEUE_SIZE
+            and not self.make_room()
+        ):
+            self.disconnect()
+            return
+
+        self.items.append(item)
+        stats.max_depth = max(stats.max_depth, len(self.items))
+        self.ready.set()
+
+    def make_room(self):
+        """
+        Frees a slot applying the policy. Returns False if none could be freed.
+        """
+        policy = settings.WEBSOCKET_SEND_QUEUE_POLICY
+        ephemeral_items = [item for item in self.items if item[0] == EPHEMERAL]
+
+        if ephemeral_items:
+            self.items.remove(ephemeral_items[0])
+            stats.dropped += 1
+            return True
+
+        presence_items = [
+            item for item in self.items if item[0] in [PRESENCE, SNAPSHOT]
+        ]
+
+        if policy == "drop_presence" and presence_items:
+            self.items.remove(presence_items[0])
+            stats.dropped += 1
+            return True
+
+        if policy == "collapse_presence":
+            room_ids = {room_id for _, room_id, _ in presence_items}
+
+            if len(presence_items) > len(room_ids):
+                collapsed = deque()
+
+                # Each room's snapshot takes the place of its first presence frame
+                for item in self.items:
+                    if item[0] not in [PRESENCE, SNAPSHOT]:
+                        collapsed.append(item)
+                    elif item[1] in room_ids:
+                        collapsed.append((SNAPSHOT, item[1], None))
+                        room_ids.discard(item[1])
+
+                stats.collapsed += len(self.items) - len(collapsed)
+                self.items = collapsed
+                return True
+
+        return False
+
+    def disconnect(self):
+        logger.warning(
+            f"Socket {self.consumer.channel_name} isn't reading its frames, "
+            "disconnecting it."
+        )
+        stats.disconnected += 1
+        self.items.clear()
+        self.closing = True
+
+        # The frame being written waits for the client, which isn't reading
+        self.task.cancel()
+        self.task = asyncio.create_task(
+            self.close(SLOW_CONSUMER_CLOSE_CODE, "slow_consumer")
+        )
+
+    async def drain(self):
+        try:
+            while True:
+                if not self.items:
+                    self.ready.clear()
+                    await self.ready.wait()
+
+                kind, room_id, payload = self.items.popleft()
+
+                if kind == CLOSE:
+                    await self.consumer.write_close(payload)
+                    return
+
+                if kind == SNAPSHOT:
+                    payload = await self.consumer.encode_members_snapshot(room_id)
+
+                await self.consumer.write(payload)
+                await stats.apublish()
+        except OSError:
+            # The client is gone, its disconnection is handled by the consumer
+            logger.debug(f"Socket {self.consumer.channel_name} closed while writing.")
+        except Exception:
+            logger.exception(
+                f"Failed to write to socket {self.consumer.channel_name}, closing it."
+            )
+            self.items.clear()
+            self.closing = True
+            await self.close(INTERNAL_ERROR_CLOSE_CODE)
+
+    async def close(self, code, reason=None):
+        try:
+            await self.consumer.write_close(code, reason)
+        except Exception:
+            logger.debug(f"Failed to close socket {self.consumer.channel_name}.")
+
+    def stop(self):
+        self.task.cancel()
+        stats.queues.discard(self)
+
+
+class OutboundStats:
+    """
+    Outbound queue counters of the process, published to Redis every
+    STATS_INTERVAL seconds while frames are written.
+    """
+
+    def __init__(self):
+        self.queues = weakref.WeakSet()
+        self.max_depth = 0
+        self.dropped = 0
+        self.collapsed = 0
+        self.disconnected = 0
+        self.published_at = 0
+        self.key = f"{STATS_KEY_PREFIX}{socket.gethostname()}:{os.getpid()}"
+
+    def snapshot(self):
+        depths = [len(queue.items) for queue in self.queues]
+
+        return {
+            "sockets": len(depths),
+            "depth": sum(depths),
+            "max_depth": self.max_depth,
+            "dropped": self.dropped,
+            "collapsed": self.collapsed,
+            "disconnected": self.disconnected,
+        }
+
+    async def apublish(self, force=False):
+        if not force and time.monotonic() - self.published_at < STATS_INTERVAL:
+            return
+
+        self.published_at = time.monotonic()
+
+        try:
+            async with get_async_redis().pipeline(transaction=False) as pipe:
+                pipe.hset(self.key, mapping=self.snapshot())
+                pipe.expire(self.key, STATS_INTERVAL * 6)
+                await pipe.execute()
+        except RedisError:
+            logger.warning("Failed to publish the outbound queue stats.")
+
+
+stats = OutboundStats()
+
+
+def get_stats():
+    """
+    Returns the outbound queue counters summed over the processes that published
+    them recently, and the ones of each process.
+    """
+    redis = get_redis()
+    processes = {}
+
+    for key in redis.scan_iter(match=f"{STATS_KEY_PREFIX}*", count=1000):
+        values = redis.hgetall(key)
+
+        if values:
+            processes[key.removeprefix(STATS_KEY_PREFIX)] = {
+                name: int(value) for name, value in values.items()
+            }
+
+    totals = {
+        name: sum(process[name] for process in processes.values())
+        for name in ["sockets", "depth", "dropped", "collapsed", "disconnected"]
+    }
+    totals["max_depth"] = max(
+        (process["max_depth"] for process in processes.values()), default=0
+    )
+
+    return {**totals, "processes": processes}
@@ -0,0 +1,155 @@
+import base64
+import binascii
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginates the objects by (created_at, id), so each page costs an index seek
+    whatever the size of the history, unlike offsets.
+
+    Without cursor, returns the latest objects. With `before`, the objects
+    preceding the cursor (infinite scroll), and with `after`, the objects following
+    it (catch up). Objects of a page are always in chronological order; `previous`
+    and `next` are the links to the adjacent pages, if any.
+    """
+
+    page_size = 50
+    max_page_size = 100
+    page_size_query_param = "page_size"
+    before_query_param = "before"
+    after_query_param = "after"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        if after is not None:
+            created_at, pk = after
+            # The first condition bounds the index range scan
+            queryset = queryset.filter(created_at__gte=created_at).filter(
+                Q(created_at__gt=created_at) | Q(id__gt=pk)
+            )
+            objects = list(queryset.order_by("created_at", "id")[: page_size + 1])
+            self.has_previous = True
+            self.has_next = len(objects) > page_size
+            return self.set_page(objects[:page_size])
+
+        if before is not None:
+            created_at, pk = before
+            queryset = queryset.filter(created_at__lte=created_at).filter(
+                Q(created_at__lt=created_at) | Q(id__lt=pk)
+            )
+
+        objects = list(queryset.order_by("-created_at", "-id")[: page_size + 1])
+        self.has_previous = len(objects) > page_size
+        # Without cursor the latest objects are returned, there is nothing after
+        self.has_next = before is not None
+        return self.set_page(objects[:page_size][::-1])
+
+    def paginate_serialized(self, data, request, complete):
+        """
+        Paginates the latest objects, already serialized (e.g. cached) in
+        chronological order, as paginate_queryset does without cursor. `data` must
+        hold at least a page of objects, unless `complete` (it holds all of them).
+        """
+        self.request = request
+        page = data[-self.get_page_size(request) :]
+        self.has_previous = len(data) > len(page) or not complete
+        self.has_next = False
+        self.positions = [
+            (parse_datetime(item["created_at"]), item["id"])
+            for item in page[:1] + page[-1:]
+        ]
+        return page
+
+    def set_page(self, objects):
+        # Positions of the first and last objects, for the links
+        self.positions = (
+            [
+                (objects[0].created_at, objects[0].id),
+                (objects[-1].created_at, objects[-1].id),
+            ]
+            if objects
+            else []
+        )
+        return objects
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_paginated_response(self, data):
+        return Response(
+            OrderedDict(
+                [
+                    ("previous", self.get_previous_link()),
+                    ("next", self.get_next_link()),
+                    ("results", data),
+                ]
+            )
+        )
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.positions:
+            return None
+
+        return self.build_link(self.before_query_param, self.positions[0])
+
+    def get_next_link(self):
+        if not self.has_next or not self.positions:
+            return None
+
+        return self.build_link(self.after_query_param, self.positions[-1])
+
+    def build_link(self, query_param, position):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, query_param, self.encode_cursor(*position))
+
+    @staticmethod
+    def encode_cursor(created_at, pk):
+        position = f"{created_at.isoformat()}|{pk}"
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        if cursor is None:
+            return None
+
+        try:
+            created_at, pk = base64.urlsafe_b64decode(cursor).decode().split("|")
+            created_at = parse_datetime(created_at)
+            pk = int(pk)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+        if created_at is None:
+            raise NotFound(self.invalid_cursor_message)
+
+        return created_at, pk
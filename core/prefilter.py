@@ -0,0 +1,213 @@
+"""
+Local prefilters, deciding the obvious contents before they reach the model.
+
+Each prefilter has a `classify(content)` method returning False (unsafe), True
+(safe) or None when it can't tell. The prefilters listed in MODERATION_PREFILTERS
+are tried in order and the first decision wins; contents left undecided are sent
+to the model.
+"""
+
+import string
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from core.utils import normalize_content
+
+# Code points with the Emoji property (Unicode 15.1 emoji-data.txt), without the
+# digits, "#" and "*": pictographs, regional indicators (flags) and skin tone
+# modifiers. Other symbols, e.g. arrows, box drawing or religious symbols, are left
+# to the model.
+EMOJI_RANGES = """
+    00A9 00AE 203C 2049 2122 2139 2194-2199 21A9-21AA 231A-231B 2328 23CF
+    23E9-23F3 23F8-23FA 24C2 25AA-25AB 25B6 25C0 25FB-25FE 2600-2604 260E 2611
+    2614-2615 2618 261D 2620 2622-2623 2626 262A 262E-262F 2638-263A 2640 2642
+    2648-2653 265F-2660 2663 2665-2666 2668 267B 267E-267F 2692-2697 2699
+    269B-269C 26A0-26A1 26A7 26AA-26AB 26B0-26B1 26BD-26BE 26C4-26C5 26C8
+    26CE-26CF 26D1 26D3-26D4 26E9-26EA 26F0-26F5 26F7-26FA 26FD 2702 2705
+    2708-270D 270F 2712 2714 2716 271D 2721 2728 2733-2734 2744 2747 274C 274E
+    2753-2755 2757 2763-2764 2795-2797 27A1 27B0 27BF 2934-2935 2B05-2B07
+    2B1B-2B1C 2B50 2B55 3030 303D 3297 3299 1F004 1F0CF 1F170-1F171 1F17E-1F17F
+    1F18E 1F191-1F19A 1F1E6-1F1FF 1F201-1F202 1F21A 1F22F 1F232-1F23A 1F250-1F251
+    1F300-1F321 1F324-1F393 1F396-1F397 1F399-1F39B 1F39E-1F3F0 1F3F3-1F3F5
+    1F3F7-1F4FD 1F4FF-1F53D 1F549-1F54E 1F550-1F567 1F56F-1F570 1F573-1F57A 1F587
+    1F58A-1F58D 1F590 1F595-1F596 1F5A4-1F5A5 1F5A8 1F5B1-1F5B2 1F5BC 1F5C2-1F5C4
+    1F5D1-1F5D3 1F5DC-1F5DE 1F5E1 1F5E3 1F5E8 1F5EF 1F5F3 1F5FA-1F64F 1F680-1F6C5
+    1F6CB-1F6D2 1F6D5-1F6D7 1F6DC-1F6E5 1F6E9 1F6EB-1F6EC 1F6F0 1F6F3-1F6FC
+    1F7E0-1F7EB 1F7F0 1F90C-1F93A 1F93C-1F945 1F947-1F9FF 1FA70-1FA7C 1FA80-1FA88
+    1FA90-1FABD 1FABF-1FAC5 1FACE-1FADB 1FAE0-1FAE8 1FAF0-1FAF8
+"""
+EMOJI_CHARS = frozenset(
+    chr(code_point)
+    for start, _, end in (bounds.partition("-") for bounds in EMOJI_RANGES.split())
+    for code_point in range(int(start, 16), int(end or start, 16) + 1)
+)
+# The emoji variation selector and the zero width joiner of ZWJ sequences, but no
+# other combining or invisible formatting character
+EMOJI_JOINERS = {"\ufe0f", "\u200d"}
+# Code points of the longest emoji-only content, a few ZWJ sequences long
+EMOJI_MAX_LENGTH = 32
+
+
+class AhoCorasick:
+    """
+    Multi-pattern matcher, finding the occurrences of all the patterns in a single
+    pass over the text, whatever their number.
+    """
+
+    def __init__(self, patterns):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+        for pattern in patterns:
+            self.add(pattern)
+
+        self.build()
+
+    def add(self, pattern):
+        if not pattern:
+            return
+
+        state = 0
+
+        for char in pattern:
+            if char not in self.transitions[state]:
+                self.transitions.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.transitions[state][char] = len(self.transitions) - 1
+
+            state = self.transitions[state][char]
+
+        self.outputs[state].append(len(pattern))
+
+    def build(self):
+        queue = deque(self.transitions[0].values())
+
+        while queue:
+            state = queue.popleft()
+
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+
+                self.fail[next_state] = self.transitions[fail].get(char, 0)
+                self.outputs[next_state] += self.outputs[self.fail[next_state]]
+
+    def finditer(self, text):
+        """
+        Yields the (start, end) positions of the patterns found in the text.
+        """
+        state = 0
+
+        for i, char in enumerate(text):
+            while state and char not in self.transitions[state]:
+                state = self.fail[state]
+
+            state = self.transitions[state].get(char, 0)
+
+            for length in self.outputs[state]:
+                yield i + 1 - length, i + 1
+
+
+class BlocklistPrefilter:
+    """
+    Rejects the contents containing a word or phrase of MODERATION_BLOCKLIST.
+
+    Matches must start and end at word boundaries, so blocked words inside
+    harmless ones are not rejected.
+    """
+
+    def __init__(self):
+        self.matcher = AhoCorasick(
+            normalize_content(pattern) for pattern in settings.MODERATION_BLOCKLIST
+        )
+
+    def classify(self, content):
+        text = normalize_content(content)
+
+        for start, end in self.matcher.finditer(text):
+            if (start == 0 or not text[start - 1].isalnum()) and (
+                end == len(text) or not text[end].isalnum()
+            ):
+                return False
+
+        return None
+
+
+class AllowlistPrefilter:
+    """
+    Approves the contents in MODERATION_ALLOWLIST, ignoring the punctuation around
+    them, and the ones made only of emojis.
+    """
+
+    def __init__(self):
+        self.allowlist = {
+            normalize_content(content) for content in settings.MODERATION_ALLOWLIST
+        }
+
+    @staticmethod
+    def is_emoji_only(content):
+        content = content.strip()
+
+        return (
+            len(content) <= EMOJI_MAX_LENGTH
+            and any(char in EMOJI_CHARS for char in content)
+            and all(
+                char in EMOJI_CHARS or char in EMOJI_JOINERS or char.isspace()
+                for char in content
+            )
+        )
+
+    def classify(self, content):
+        text = normalize_content(content).strip(string.punctuation + " ")
+
+        if text in self.allowlist or self.is_emoji_only(content):
+            return True
+
+        return None
+
+
+_prefilters = None
+
+
+def get_prefilters():
+    """
+    Returns the prefilters of MODERATION_PREFILTERS, building them on the first
+    call.
+    """
+    global _prefilters
+
+    if _prefilters is None:
+        _prefilters = [import_string(path)() for path in settings.MODERATION_PREFILTERS]
+
+    return _prefilters
+
+
+@receiver(setting_changed)
+def reset_prefilters(*, setting, **kwargs):
+    global _prefilters
+
+    if setting.startswith("MODERATION_"):
+        _prefilters = None
+
+
+def classify(content):
+    """
+    Returns the verdict of the first prefilter able to decide on the content, or
+    None if the content must be sent to the model.
+    """
+    for prefilter in get_prefilters():
+        verdict = prefilter.classify(content)
+
+        if verdict is not None:
+            return verdict
+
+    return None
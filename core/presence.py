@@ -0,0 +1,254 @@
+"""
+Online members of the rooms, tracked in Redis.
+
+Presence is kept per connection, so a user with many tabs or devices stays online
+until the last of them is closed. Each room has:
+
+- a sorted set with its connections (channel names), scored by the time they
+  expire unless the socket sends a heartbeat before;
+- a hash with the username of each connection;
+- a hash counting the open connections of each online member.
+
+The ids of the rooms with online members are kept in another set, used by the
+reaper to drop expired connections (e.g. after a server crash) and to snapshot
+the presence into the database.
+
+Rooms receive presence changes as deltas (members_delta frames), coalesced per
+room within PRESENCE_COALESCE_WINDOW. The full list of online members is only sent
+to a socket when it connects.
+"""
+
+import json
+import time
+
+from django.conf import settings
+
+from core.coalescing import RoomCoalescer
+from core.loop_local import LoopLocal
+from core.redis_client import get_async_redis, get_redis
+
+ROOMS_KEY = "presence:rooms"
+
+# KEYS: connections zset, owners hash, members hash, rooms set
+# ARGV: channel name, username, expiration time, room id
+# Registers the connection or extends its expiration if it is already registered.
+# Returns 1 if the user came online, 0 otherwise.
+JOIN_SCRIPT = """
+if redis.call("ZADD", KEYS[1], ARGV[3], ARGV[1]) == 0 then
+    return 0
+end
+redis.call("HSET", KEYS[2], ARGV[1], ARGV[2])
+redis.call("SADD", KEYS[4], ARGV[4])
+if redis.call("HINCRBY", KEYS[3], ARGV[2], 1) == 1 then
+    return 1
+end
+return 0
+"""
+
+# KEYS: connections zset, owners hash, members hash, rooms set
+# ARGV: room id
+# Unregisters the given connections. Returns the usernames that went offline.
+UNREGISTER_FUNCTION = """
+local function unregister(channel_names)
+    local offline = {}
+    for _, channel_name in ipairs(channel_names) do
+        if redis.call("ZREM", KEYS[1], channel_name) == 1 then
+            local username = redis.call("HGET", KEYS[2], channel_name)
+            redis.call("HDEL", KEYS[2], channel_name)
+            if username and redis.call("HINCRBY", KEYS[3], username, -1) <= 0 then
+                redis.call("HDEL", KEYS[3], username)
+                table.insert(offline, username)
+            end
+        end
+    end
+    if redis.call("HLEN", KEYS[3]) == 0 then
+        redis.call("SREM", KEYS[4], ARGV[1])
+    end
+    return offline
+end
+"""
+
+# ARGV: room id, channel name
+LEAVE_SCRIPT = UNREGISTER_FUNCTION + "return unregister({ARGV[2]})"
+
+# ARGV: room id, current time
+# Unregisters up to 1000 expired connections at a time.
+REAP_SCRIPT = UNREGISTER_FUNCTION + (
+    'return unregister(redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", ARGV[2], '
+    '"LIMIT", 0, 1000))'
+)
+
+
+def connections_key(room_id):
+    return f"presence:room:{room_id}:connections"
+
+
+def owners_key(room_id):
+    return f"presence:room:{room_id}:owners"
+
+
+def members_key(room_id):
+    return f"presence:room:{room_id}:members"
+
+
+def room_keys(room_id):
+    return [
+        connections_key(room_id),
+        owners_key(room_id),
+        members_key(room_id),
+        ROOMS_KEY,
+    ]
+
+
+async def join(room_id, channel_name, username):
+    """
+    Registers the connection of the user to the room, or extends its expiration
+    when called again for the same connection (heartbeat).
+    Returns True if the user came online, False if they were already online.
+    """
+    redis = get_async_redis()
+    expires_at = time.time() + settings.PRESENCE_TTL
+    came_online = await redis.eval(
+        JOIN_SCRIPT, 4, *room_keys(room_id), channel_name, username, expires_at, room_id
+    )
+    return bool(came_online)
+
+
+async def leave(room_id, channel_name):
+    """
+    Unregisters the connection from the room.
+    Returns True if its user went offline, False if they are still connected.
+    """
+    redis = get_async_redis()
+    offline = await redis.eval(
+        LEAVE_SCRIPT, 4, *room_keys(room_id), room_id, channel_name
+    )
+    return bool(offline)
+
+
+async def aget_online_members(room_id):
+    """
+    Returns the sorted usernames of the online members of the room.
+    """
+    redis = get_async_redis()
+    return sorted(await redis.hkeys(members_key(room_id)))
+
+
+def get_online_members(room_id):
+    """
+    Returns the sorted usernames of the online members of the room.
+    """
+    return sorted(get_redis().hkeys(members_key(room_id)))
+
+
+def count_online_members(room_ids):
+    """
+    Returns a dict mapping the id of each room to its number of online members,
+    with a single round trip to Redis.
+    """
+    with get_redis().pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.hlen(members_key(room_id))
+        counts = pipe.execute()
+
+    return dict(zip(room_ids, counts))
+
+
+def get_online_rooms():
+    """
+    Returns a dict mapping the id of each room with online members to their
+    usernames.
+    """
+    redis = get_redis()
+    room_ids = [int(room_id) for room_id in redis.smembers(ROOMS_KEY)]
+
+    with redis.pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.hkeys(members_key(room_id))
+        members = pipe.execute()
+
+    return {room_id: set(usernames) for room_id, usernames in zip(room_ids, members)}
+
+
+def reap_expired_connections():
+    """
+    Unregisters the connections that stopped sending heartbeats, in all rooms.
+    Returns a dict mapping the id of each room to the usernames that went offline.
+    """
+    redis = get_redis()
+    now = time.time()
+    offline = {}
+
+    for room_id in redis.smembers(ROOMS_KEY):
+        usernames = redis.eval(REAP_SCRIPT, 4, *room_keys(room_id), room_id, now)
+
+        if usernames:
+            offline[int(room_id)] = usernames
+
+    return offline
+
+
+def clear(room_id):
+    """
+    Removes all the presence data of the room.
+    """
+    redis = get_redis()
+    redis.delete(*room_keys(room_id)[:3])
+    redis.srem(ROOMS_KEY, room_id)
+
+
+def encode_members_delta(joined, left):
+    """
+    Encodes the frame sent to the room with the members that joined and left it.
+    """
+    return json.dumps(
+        {"type": "members_delta", "joined": sorted(joined), "left": sorted(left)}
+    )
+
+
+class PresenceCoalescer(RoomCoalescer):
+    """
+    Buffers the members joining and leaving each room and sends them to the room
+    in a single members_delta frame once the coalesce window is over.
+
+    A member who joins and leaves within the same window cancels out and is not
+    sent at all.
+    """
+
+    event_type = "members_delta"
+    window_setting = "PRESENCE_COALESCE_WINDOW"
+
+    def merge(self, changes, change):
+        changes = changes or {}
+        username, is_online = change
+
+        if changes.get(username) == (not is_online):
+            # The member is back to the state the room already knows
+            del changes[username]
+        else:
+            changes[username] = is_online
+
+        return changes
+
+    def encode(self, changes):
+        return encode_members_delta(
+            [username for username, is_online in changes.items() if is_online],
+            [username for username, is_online in changes.items() if not is_online],
+        )
+
+
+_coalescers = LoopLocal(PresenceCoalescer)
+
+
+def get_coalescer():
+    """
+    Returns the presence coalescer of the running event loop.
+    """
+    return _coalescers.get()
+
+
+async def publish_change(room_id, username, is_online):
+    """
+    Queues a member joining or leaving the room to be sent to it.
+    """
+    await get_coalescer().add(room_id, (username, is_online))
@@ -0,0 +1,102 @@
+"""
+Rate limits of the messages sent through the sockets, so a single client can't
+flood the database and the moderation model.
+
+Each message takes a token from two buckets kept in Redis, so the limits hold
+across the nodes: the bucket of the user in the room and the one of the whole room.
+Buckets hold up to their burst of tokens and refill at their rate, in messages per
+minute. The limits of a room default to the MESSAGE_USER_RATE, MESSAGE_USER_BURST,
+MESSAGE_ROOM_RATE and MESSAGE_ROOM_BURST settings.
+"""
+
+from django.conf import settings
+
+from core.redis_client import get_async_redis, get_redis
+
+# KEYS: buckets
+# ARGV: rate (tokens per second) and burst of each bucket
+# Takes a token from each bucket if all of them have one, using the Redis clock so
+# the nodes agree on the refills. Returns 0, or the milliseconds to wait for the
+# buckets to have a token.
+TAKE_SCRIPT = """
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = {}
+local wait = 0
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    local bucket = redis.call("HMGET", key, "tokens", "updated_at")
+    local available = burst
+    if bucket[1] then
+        available = math.min(
+            burst, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate
+        )
+    end
+    tokens[i] = available
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+end
+if wait > 0 then
+    return math.ceil(wait * 1000)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2 - 1])
+    local burst = tonumber(ARGV[i * 2])
+    redis.call("HSET", key, "tokens", tokens[i] - 1, "updated_at", now)
+    -- A bucket refilled to its burst is the same as a missing one
+    redis.call("PEXPIRE", key, math.ceil(burst / rate * 1000))
+end
+return 0
+"""
+
+
+def user_bucket_key(room_id, user_id):
+    return f"ratelimit:room:{room_id}:user:{user_id}"
+
+
+def room_bucket_key(room_id):
+    return f"ratelimit:room:{room_id}"
+
+
+def get_limits(room):
+    """
+    Returns the (rate, burst) of the user and room buckets of the room.
+    """
+    return [
+        (
+            room.user_message_rate or settings.MESSAGE_USER_RATE,
+            room.user_message_burst or settings.MESSAGE_USER_BURST,
+        ),
+        (
+            room.message_rate or settings.MESSAGE_ROOM_RATE,
+            room.message_burst or settings.MESSAGE_ROOM_BURST,
+        ),
+    ]
+
+
+async def take(room, user_id):
+    """
+    Takes a token for a message of the user to the room.
+    Returns 0 if the message is allowed, or the seconds to wait before sending it.
+    """
+    args = []
+
+    for rate, burst in get_limits(room):
+        args += [rate / 60, burst]
+
+    wait = await get_async_redis().eval(
+        TAKE_SCRIPT,
+        2,
+        user_bucket_key(room.id, user_id),
+        room_bucket_key(room.id),
+        *args,
+    )
+    return wait / 1000
+
+
+def clear(room_id):
+    redis = get_redis()
+    keys = list(redis.scan_iter(match=user_bucket_key(room_id, "*"), count=1000))
+    redis.delete(room_bucket_key(room_id), *keys)
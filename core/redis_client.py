@@ -0,0 +1,34 @@
+import redis
+import redis.asyncio
+from django.conf import settings
+
+from core.loop_local import LoopLocal
+
+_client = None
+_async_clients = LoopLocal(
+    lambda: redis.asyncio.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+)
+
+
+def get_redis():
+    """
+    Returns the process-wide Redis client, used by synchronous code (views and
+    Celery tasks).
+    """
+    global _client
+
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+
+    return _client
+
+
+def get_async_redis():
+    """
+    Returns the asyncio Redis client bound to the running event loop, used by the
+    WebSocket consumers.
+
+    Connections of an asyncio client can't be shared between event loops, so one
+    client is kept per loop.
+    """
+    return _async_clients.get()
@@ -0,0 +1,194 @@
+"""
+Protection of the moderation model provider during slowdowns and outages.
+
+- The circuit breaker, shared by all the workers through Redis, opens after
+  MODERATION_BREAKER_THRESHOLD consecutive failed requests. While open, requests
+  fail fast with ModerationUnavailable and the messages are handled by the
+  MODERATION_BREAKER_FALLBACK policy. After MODERATION_BREAKER_COOLDOWN seconds a
+  single probe request is let through, closing the breaker if it succeeds.
+- The adaptive limiter bounds the concurrent requests of each process, AIMD
+  style: the limit grows by one per limit-worth of fast successful requests, up to
+  MODERATION_CONCURRENCY, and is halved on each failed request or request slower
+  than MODERATION_LATENCY_TARGET.
+"""
+
+import asyncio
+import contextlib
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+
+from core.redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+BREAKER_KEY = "moderation:breaker"
+PROBE_KEY = "moderation:breaker:probe"
+LIMITER_KEY_PREFIX = "moderation:limiter:"
+
+# KEYS: breaker hash, probe key
+# ARGV: threshold, current time
+# Counts a failed request, opening the breaker after too many consecutive ones or
+# when the probe of a half-open breaker fails. Returns 1 if the breaker opened.
+FAILURE_SCRIPT = """
+local failures = redis.call("HINCRBY", KEYS[1], "failures", 1)
+redis.call("HINCRBY", KEYS[1], "calls", 1)
+redis.call("HINCRBY", KEYS[1], "failed_calls", 1)
+if failures >= tonumber(ARGV[1]) or redis.call("HGET", KEYS[1], "state") == "open" then
+    redis.call("HSET", KEYS[1], "state", "open", "opened_at", ARGV[2])
+    redis.call("DEL", KEYS[2])
+    return 1
+end
+return 0
+"""
+
+
+class ModerationUnavailable(Exception):
+    """
+    Raised instead of calling the model provider while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    async def allow(self):
+        """
+        Returns True if a request can be sent to the model provider.
+        """
+        redis = get_async_redis()
+        state, opened_at = await redis.hmget(BREAKER_KEY, "state", "opened_at")
+
+        if state != "open":
+            return True
+
+        cooldown = settings.MODERATION_BREAKER_COOLDOWN
+
+        # Half-open: a single worker sends a probe request
+        if time.time() >= float(opened_at) + cooldown and await redis.set(
+            PROBE_KEY, 1, nx=True, ex=max(1, cooldown)
+        ):
+            return True
+
+        await redis.hincrby(BREAKER_KEY, "short_circuited", 1)
+        return False
+
+    async def record_success(self):
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            pipe.hset(BREAKER_KEY, mapping={"state": "closed", "failures": 0})
+            pipe.hincrby(BREAKER_KEY, "calls", 1)
+            pipe.delete(PROBE_KEY)
+            await pipe.execute()
+
+    async def record_failure(self):
+        opened = await get_async_redis().eval(
+            FAILURE_SCRIPT,
+            2,
+            BREAKER_KEY,
+            PROBE_KEY,
+            settings.MODERATION_BREAKER_THRESHOLD,
+            time.time(),
+        )
+
+        if opened:
+            logger.warning(
+                "Moderation circuit breaker opened, retrying the model provider in "
+                f"{settings.MODERATION_BREAKER_COOLDOWN} seconds."
+            )
+
+    def retry_after(self):
+        """
+        Returns the seconds left until the breaker lets a probe request through.
+        """
+        opened_at = get_redis().hget(BREAKER_KEY, "opened_at")
+
+        if opened_at is None:
+            return 0
+
+        return max(
+            0, float(opened_at) + settings.MODERATION_BREAKER_COOLDOWN - time.time()
+        )
+
+    def reset(self):
+        get_redis().delete(BREAKER_KEY, PROBE_KEY)
+
+
+breaker = CircuitBreaker()
+
+
+class AdaptiveLimiter:
+    """
+    Limits the concurrent model requests of the process, see the module docstring.
+    The current limit is published to Redis, for the metrics.
+    """
+
+    def __init__(self):
+        self.limit = float(settings.MODERATION_CONCURRENCY)
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.key = f"{LIMITER_KEY_PREFIX}{socket.gethostname()}:{os.getpid()}"
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        started_at = time.monotonic()
+
+        try:
+            yield
+        except Exception:
+            await self.decrease()
+            raise
+        else:
+            if time.monotonic() - started_at > settings.MODERATION_LATENCY_TARGET:
+                await self.decrease()
+            else:
+                await self.increase()
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    async def increase(self):
+        await self.set_limit(
+            min(settings.MODERATION_CONCURRENCY, self.limit + 1 / self.limit)
+        )
+
+    async def decrease(self):
+        await self.set_limit(max(1, self.limit / 2))
+
+    async def set_limit(self, limit):
+        changed = int(limit) != int(self.limit)
+        self.limit = limit
+
+        if changed:
+            logger.info(f"Moderation concurrency limit set to {int(limit)}.")
+            await get_async_redis().set(self.key, int(limit), ex=60 * 60)
+
+
+def get_stats():
+    """
+    Returns the state of the circuit breaker, its counters and the concurrency
+    limits of the worker processes that changed them in the last hour.
+    """
+    redis = get_redis()
+    breaker_stats = redis.hgetall(BREAKER_KEY)
+    limiter_keys = list(redis.scan_iter(match=f"{LIMITER_KEY_PREFIX}*", count=1000))
+    limits = redis.mget(limiter_keys) if limiter_keys else []
+
+    return {
+        "state": breaker_stats.pop("state", "closed"),
+        "retry_after": breaker.retry_after(),
+        **{
+            name: int(breaker_stats.get(name, 0))
+            for name in ["failures", "calls", "failed_calls", "short_circuited"]
+        },
+        "concurrency_limits": {
+            key.removeprefix(LIMITER_KEY_PREFIX): int(limit)
+            for key, limit in zip(limiter_keys, limits)
+            if limit is not None
+        },
+    }
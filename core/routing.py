@@ -3,5 +3,6 @@ from django.urls import re_path
 from core import consumers
 
 websocket_urlpatterns = [
+    re_path(r"ws/rooms/$", consumers.MultiplexConsumer.as_asgi()),
     re_path(r"ws/rooms/(?P<room_id>\w+)/$", consumers.RoomConsumer.as_asgi()),
 ]
@@ -13,9 +13,49 @@ class UserSerializer(serializers.ModelSerializer):
 
 
 class RoomSerializer(serializers.ModelSerializer):
+    """
+    Serializes a room, with the counts and last message annotated by RoomViewSet,
+    when available.
+    """
+
+    member_count = serializers.SerializerMethodField()
+    online_count = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+
     class Meta:
         model = Room
-        fields = ["id", "name", "description", "is_private", "created_at", "updated_at"]
+        fields = [
+            "id",
+            "name",
+            "description",
+            "is_private",
+            "optimistic_delivery",
+            "user_message_rate",
+            "user_message_burst",
+            "message_rate",
+            "message_burst",
+            "created_at",
+            "updated_at",
+            "member_count",
+            "online_count",
+            "last_message",
+        ]
+
+    def get_member_count(self, room) -> int | None:
+        return getattr(room, "member_count", None)
+
+    def get_online_count(self, room) -> int | None:
+        return getattr(room, "online_count", None)
+
+    def get_last_message(self, room) -> dict | None:
+        if getattr(room, "last_message_created_at", None) is None:
+            return None
+
+        return {
+            "content": room.last_message_content,
+            "created_at": room.last_message_created_at,
+            "author": room.last_message_author,
+        }
 
 
 class AuthorMessageSerializer(serializers.ModelSerializer):
@@ -29,12 +69,25 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = "__all__"
+        exclude = ["claimed_until"]
         read_only_fields = [
             "id",
             "status",
+            "seq",
             "created_at",
             "updated_at",
             "room",
             "author",
         ]
+
+
+class ChatMessageSerializer(serializers.ModelSerializer):
+    """
+    Serializes a message into the payload sent to the room via WebSocket.
+    """
+
+    author = AuthorMessageSerializer(read_only=True)
+
+    class Meta:
+        model = Message
+        fields = ["id", "seq", "content", "created_at", "author"]
@@ -0,0 +1,66 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from core import history, lookups
+from core.models import Message, Room, RoomMember
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=Message)
+def invalidate_history_on_save(sender, instance, created, **kwargs):
+    """
+    Drops the history buffer of the room when one of its messages is edited, e.g.
+    retracted from the admin. New messages are added by the moderation tasks.
+    """
+    if not created:
+        history.invalidate(instance.room_id)
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_history_on_delete(sender, instance, **kwargs):
+    """
+    Drops the history buffer of the room when one of its messages is deleted.
+    """
+    history.invalidate(instance.room_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user_lookup(sender, instance, **kwargs):
+    lookups.invalidate_user(instance.id)
+
+
+@receiver(post_save, sender=Room)
+@receiver(post_delete, sender=Room)
+def invalidate_room_lookup(sender, instance, **kwargs):
+    lookups.invalidate_room(instance.id)
+
+
+@receiver(post_save, sender=RoomMember)
+@receiver(post_delete, sender=RoomMember)
+def invalidate_membership_lookup(sender, instance, **kwargs):
+    lookups.invalidate_memberships([instance.user_id], [instance.room_id])
+    lookups.invalidate_member_counts([instance.room_id])
+
+
+@receiver(m2m_changed, sender=RoomMember)
+def invalidate_membership_lookups(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drops the cached memberships and member counts changed through Room.members,
+    which doesn't send the RoomMember signals.
+    """
+    if action == "pre_clear":
+        # The cleared members are only known before the clear
+        related = instance.room_members if reverse else instance.members
+        pk_set = set(related.values_list("id", flat=True))
+    elif action not in ["post_add", "post_remove"]:
+        return
+
+    if reverse:
+        lookups.invalidate_memberships([instance.id], pk_set)
+        lookups.invalidate_member_counts(pk_set)
+    else:
+        lookups.invalidate_memberships(pk_set, [instance.id])
+        lookups.invalidate_member_counts([instance.id])
@@ -1,42 +1,633 @@
+import asyncio
+import json
 import logging
+import random
+from collections import defaultdict
+from datetime import timedelta
 
 import channels.layers
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.utils import timezone
 
 from config.celery import app
-from core.utils import is_safe_content
+from core import history, prefilter, tracing
+from core.resilience import ModerationUnavailable, breaker
+from core.utils import (
+    ais_safe_content,
+    are_safe_contents,
+    get_moderation_client,
+    is_safe_content,
+)
+from core.verdict_cache import verdict_cache
 
 logger = logging.getLogger(__name__)
 
 
-@app.task
-def moderate_message(message_id):
+def encode_chat_message(message):
+    """
+    Encodes the message as the JSON frame sent to the room's sockets.
+    """
+    from core.serializers import ChatMessageSerializer
+
+    return json.dumps({"type": "chat_message", **ChatMessageSerializer(message).data})
+
+
+def send_to_room(room_id, event_type, text, trace=None):
+    """
+    Sends the encoded frame to the room's channel layer group, along with the room
+    id, for the multiplexed sockets, and the trace of the message, if it is traced.
+
+    Frames are encoded once here so the consumers only forward them, without
+    querying the database or serializing them again for each connected socket.
+    """
+    event = {"type": event_type, "room_id": room_id, "text": text}
+
+    if trace:
+        tracing.mark(trace, "sent")
+        event["trace"] = trace
+
+    channel_layer = channels.layers.get_channel_layer()
+    async_to_sync(channel_layer.group_send)(f"room_{room_id}", event)
+
+
+def broadcast_message(message, trace=None):
+    """
+    Sends the message to the room's channel layer group.
+    """
+    send_to_room(message.room_id, "chat_message", encode_chat_message(message), trace)
+
+
+def classify_content(content):
+    """
+    Returns the verdict of the content, asking the model only if the prefilters
+    can't decide on it and it isn't cached.
+    """
+    verdict = prefilter.classify(content)
+
+    if verdict is None:
+        [verdict] = verdict_cache.get_many([content])
+
+    if verdict is None:
+        verdict = is_safe_content(content)
+        verdict_cache.set_many([content], [verdict])
+
+    return verdict
+
+
+def classify_locally(contents):
+    """
+    Returns a dict mapping each distinct content to its verdict from the prefilters
+    or the cache, or None if the model must be asked.
+    """
+    verdicts = dict.fromkeys(contents)
+
+    for content in verdicts:
+        verdicts[content] = prefilter.classify(content)
+
+    undecided = [content for content, verdict in verdicts.items() if verdict is None]
+    verdicts.update(zip(undecided, verdict_cache.get_many(undecided)))
+    return verdicts
+
+
+def classify_contents(contents):
+    """
+    Returns the verdicts of the contents, asking the model in a single request for
+    the distinct ones the prefilters can't decide on and that aren't cached.
+    """
+    verdicts = classify_locally(contents)
+    missing = [content for content, verdict in verdicts.items() if verdict is None]
+
+    if missing:
+        classified = are_safe_contents(missing)
+        verdict_cache.set_many(missing, classified)
+        verdicts.update(zip(missing, classified))
+
+    return [verdicts[content] for content in contents]
+
+
+async def amoderate_messages(messages, retries=0, traces=None):
+    """
+    Classifies the contents of the claimed messages (see claim_messages) with up to
+    MODERATION_CONCURRENCY concurrent model requests, then saves and sends them at
+    once, with their traces (see get_traces). Messages whose request fails are
+    retried later (see retry_messages), unless the circuit breaker is open (see
+    handle_unavailable).
+
+    Must be awaited on the moderation client's event loop, see ModerationClient.run.
+    """
+    traces = traces or {}
+    semaphore = asyncio.Semaphore(settings.MODERATION_CONCURRENCY)
+
+    async def classify(content):
+        async with semaphore:
+            verdict = await ais_safe_content(content)
+
+        await sync_to_async(verdict_cache.set_many)([content], [verdict])
+        return verdict
+
+    # Messages with the same content share a single request
+    contents = list(dict.fromkeys(message.content for message in messages))
+    results = dict(
+        zip(
+            contents,
+            await asyncio.gather(
+                *(classify(content) for content in contents), return_exceptions=True
+            ),
+        )
+    )
+
+    classified = []
+    unavailable = []
+    failed = []
+
+    for message in messages:
+        result = results[message.content]
+
+        if isinstance(result, ModerationUnavailable):
+            unavailable.append(message)
+        elif isinstance(result, Exception):
+            logger.error(f"Failed to moderate message {message.id}.", exc_info=result)
+            failed.append(message)
+        else:
+            tracing.mark(traces.get(message.id), "classified")
+            classified.append(message)
+
+    # The ORM runs in a thread of its own, whose connections are released after
+    # each call
+    if classified:
+        await database_sync_to_async(save_verdicts)(
+            classified, [results[message.content] for message in classified]
+        )
+        mark_traces(classified, traces, "updated")
+        await database_sync_to_async(broadcast_messages)(classified, traces)
+
+    if unavailable:
+        await database_sync_to_async(handle_unavailable)(unavailable)
+
+    if failed:
+        await database_sync_to_async(retry_messages)(failed, retries)
+
+
+def get_traces(message_ids, traces):
+    """
+    Returns the traces passed to a moderation task along with the message ids, as a
+    list aligned with them, as a dict mapping the ids of the traced messages to
+    their traces.
+    """
+    return {
+        message_id: trace
+        for message_id, trace in zip(message_ids or [], traces or [])
+        if trace
+    }
+
+
+def mark_traces(messages, traces, stage):
+    for message in messages:
+        tracing.mark(traces.get(message.id), stage)
+
+
+def claim_messages(messages, limit=None):
+    """
+    Claims up to limit of the pending messages of the queryset that aren't claimed
+    by another task, for MODERATION_CLAIM_TIMEOUT seconds, and returns them.
+
+    The rows are only locked while they are claimed, so the messages are classified
+    without holding any lock or transaction open.
+    """
+    from core.models import Message
+
+    now = timezone.now()
+    claimable = messages.filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+    ).select_for_update(skip_locked=True, of=("self",))
+
+    if limit is not None:
+        claimable = claimable[:limit]
+
+    with transaction.atomic():
+        claimed = list(claimable)
+        Message.objects.filter(id__in=[message.id for message in claimed]).update(
+            claimed_until=now + timedelta(seconds=settings.MODERATION_CLAIM_TIMEOUT)
+        )
+
+    return claimed
+
+
+def release_messages(messages):
+    """
+    Releases the claims of the messages, so they can be moderated again.
+    """
+    from core.models import Message
+
+    Message.objects.filter(id__in=[message.id for message in messages]).update(
+        claimed_until=None
+    )
+
+
+def retry_messages(messages, retries):
+    """
+    Releases the messages whose model request failed and schedules their
+    moderation again, after MODERATION_RETRY_BACKOFF seconds doubled on each retry,
+    with jitter. Past MODERATION_MAX_RETRIES retries, they are left pending.
+    """
+    release_messages(messages)
+
+    if retries >= settings.MODERATION_MAX_RETRIES:
+        logger.error(
+            f"Gave up moderating {len(messages)} messages after {retries} retries."
+        )
+        return
+
+    delay = settings.MODERATION_RETRY_BACKOFF * 2**retries
+    task = (
+        moderate_messages_async
+        if settings.MODERATION_ASYNC_ENABLED
+        else moderate_messages_batch
+    )
+    task.apply_async(
+        ([message.id for message in messages],),
+        {"retries": retries + 1},
+        countdown=random.uniform(delay / 2, delay),
+    )
+
+
+def save_verdicts(messages, verdicts):
+    """
+    Approves or rejects the messages according to their verdicts, with a single
+    update, numbering the approved ones in their rooms and releasing their claims.
+    """
+    from core.models import Message
+
+    now = timezone.now()
+    approved_by_room = defaultdict(list)
+
+    for message, has_safe_content in zip(messages, verdicts):
+        message.updated_at = now
+        message.claimed_until = None
+
+        if has_safe_content:
+            message.status = Message.Status.APPROVED
+
+            if message.seq is None:
+                approved_by_room[message.room_id].append(message)
+        else:
+            message.status = Message.Status.REJECTED
+            logger.info(f"Message {message.id} rejected due to profanity.")
+
+    with transaction.atomic():
+        # Rooms are locked in a fixed order, so concurrent tasks can't deadlock
+        for room_id in sorted(approved_by_room):
+            assign_seqs(room_id, approved_by_room[room_id])
+
+        Message.objects.bulk_update(
+            messages, ["status", "seq", "claimed_until", "updated_at"]
+        )
+
+
+def assign_seqs(room_id, messages):
+    """
+    Assigns the next sequence numbers of the room to the messages, in the order
+    they were sent. Must run in a transaction, the room's row is locked until
+    it commits.
+    """
+    from core.models import Room
+
+    last_seq = (
+        Room.objects.select_for_update()
+        .values_list("last_seq", flat=True)
+        .get(id=room_id)
+    )
+    messages = sorted(messages, key=lambda message: (message.created_at, message.id))
+
+    for seq, message in enumerate(messages, start=last_seq + 1):
+        message.seq = seq
+
+    Room.objects.filter(id=room_id).update(last_seq=last_seq + len(messages))
+
+
+def broadcast_messages(messages, traces=None):
+    """
+    Sends the moderated messages to their rooms, with their traces (a dict mapping
+    the ids of the traced messages to their traces), and adds the approved ones to
+    the history buffers of the rooms.
+
+    Rooms with optimistic delivery received the messages before moderation, so
+    they are only told which ones were confirmed and which ones were retracted.
+    """
+    from core.models import Message
+
+    traces = traces or {}
+    history.append(
+        [message for message in messages if message.status == Message.Status.APPROVED]
+    )
+
+    for message in messages:
+        is_approved = message.status == Message.Status.APPROVED
+        trace = traces.get(message.id)
+
+        if message.room.optimistic_delivery:
+            event_type = "message_confirmed" if is_approved else "message_retracted"
+            send_to_room(
+                message.room_id,
+                event_type,
+                json.dumps({"type": event_type, "id": message.id, "seq": message.seq}),
+                trace,
+            )
+            logger.info(
+                f"Message {message.id} sent to room {message.room_id} as {event_type}."
+            )
+        elif is_approved:
+            broadcast_message(message, trace)
+            logger.info(
+                f"Message {message.id} approved and sent to room {message.room_id}."
+            )
+
+
+def handle_unavailable(messages):
+    """
+    Handles the messages that couldn't be classified because the circuit breaker
+    is open, according to MODERATION_BREAKER_FALLBACK:
+
+    - "hold": they are moderated again once the breaker lets requests through;
+    - "fail_open_trusted": the ones of trusted (staff) authors are approved, and
+      the others held;
+    - "fail_closed": they are rejected.
+    """
+    fallback = settings.MODERATION_BREAKER_FALLBACK
+
+    if fallback == "fail_closed":
+        decided = messages
+    elif fallback == "fail_open_trusted":
+        decided = [message for message in messages if message.author.is_staff]
+    else:
+        decided = []
+
+    held = [message for message in messages if message not in decided]
+
+    if decided:
+        save_verdicts(decided, [fallback != "fail_closed"] * len(decided))
+        broadcast_messages(decided)
+
+    if held:
+        logger.warning(
+            f"Holding {len(held)} messages until the moderation model provider is "
+            "available."
+        )
+        release_messages(held)
+        task = (
+            moderate_messages_async
+            if settings.MODERATION_ASYNC_ENABLED
+            else moderate_messages_batch
+        )
+        # Held messages wait for a whole cooldown at least, spread so they don't
+        # all reach the breaker at once when it lets requests through again
+        delay = max(settings.MODERATION_BREAKER_COOLDOWN, breaker.retry_after())
+        task.apply_async(
+            ([message.id for message in held],),
+            countdown=random.uniform(delay, delay * 1.5),
+        )
+
+
+# The moderation tasks reschedule the messages whose model request failed
+# themselves (see retry_messages and handle_unavailable), only database errors are
+# retried by Celery
+@app.task(autoretry_for=(DatabaseError,))
+def moderate_message(message_id, trace=None):
     """
     Moderates a message by checking its content and updating its status.
+    The trace, if the message is traced, is marked at each stage (see core.tracing).
     """
     from core.models import Message
 
+    tracing.mark(trace, "dequeued")
     logger.info(f"Moderating message {message_id}.")
-    message = Message.objects.get(id=message_id)
-    has_safe_content = is_safe_content(message.content)
+    message = Message.objects.select_related("author", "room").get(id=message_id)
+
+    try:
+        verdict = classify_content(message.content)
+    except ModerationUnavailable:
+        handle_unavailable([message])
+        return
+    except Exception:
+        logger.exception(f"Failed to moderate message {message_id}.")
+        retry_messages([message], 0)
+        return
+
+    tracing.mark(trace, "classified")
+    save_verdicts([message], [verdict])
+    tracing.mark(trace, "updated")
+    broadcast_messages([message], {message.id: trace})
+    tracing.flush()
+
+
+@app.task(autoretry_for=(DatabaseError,))
+def moderate_messages_batch(message_ids=None, retries=0, traces=None):
+    """
+    Moderates messages in batches of up to MODERATION_BATCH_SIZE, classifying each
+    batch with a single model request. Without ids, moderates the oldest pending
+    messages of any room. The traces of the messages, if any, are marked at each
+    stage (see get_traces).
+
+    Messages no longer pending, or claimed by another task, are skipped, so a
+    retried batch doesn't moderate again the messages handled before the failure.
+    Each batch is claimed and saved in short transactions of their own, the model
+    being asked outside of any (see claim_messages).
+    """
+    from core.models import Message
+
+    batch_size = settings.MODERATION_BATCH_SIZE
+    traces = get_traces(message_ids, traces)
+
+    for trace in traces.values():
+        tracing.mark(trace, "dequeued")
+
+    pending = (
+        Message.objects.select_related("author", "room")
+        .filter(status=Message.Status.PENDING)
+        .order_by("id")
+    )
+
+    if message_ids is None:
+        batches = [pending]
+    else:
+        batches = [
+            pending.filter(id__in=message_ids[i : i + batch_size])
+            for i in range(0, len(message_ids), batch_size)
+        ]
+
+    for batch in batches:
+        messages = claim_messages(batch, batch_size)
+
+        if not messages:
+            continue
+
+        logger.info(f"Moderating a batch of {len(messages)} messages.")
+
+        try:
+            verdicts = classify_contents([message.content for message in messages])
+        except ModerationUnavailable:
+            handle_unavailable(messages)
+            continue
+        except Exception:
+            logger.exception(f"Failed to moderate a batch of {len(messages)} messages.")
+            retry_messages(messages, retries)
+            continue
+
+        mark_traces(messages, traces, "classified")
+        save_verdicts(messages, verdicts)
+        mark_traces(messages, traces, "updated")
+        broadcast_messages(messages, traces)
 
-    if has_safe_content:
-        message.status = Message.Status.APPROVED
+    tracing.flush()
 
-        # Sends approved message to the room's channel layer
-        channel_layer = channels.layers.get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f"room_{message.room.id}",
-            {
-                "type": "chat_message",
-                "message_id": message.id,
-            },
+
+@app.task(autoretry_for=(DatabaseError,))
+def moderate_messages_async(message_ids=None, retries=0, traces=None):
+    """
+    Moderates the messages, or the oldest MODERATION_BATCH_SIZE pending messages of
+    any room without ids, sending the contents the prefilters and the cache can't
+    decide on to the model concurrently (see amoderate_messages). The traces of
+    the messages, if any, are marked at each stage (see get_traces).
+
+    A single worker process thus keeps many model requests in flight, instead of
+    blocking on each of them. Messages no longer pending, or claimed by another
+    task, are skipped (see claim_messages).
+    """
+    from core.models import Message
+
+    traces = get_traces(message_ids, traces)
+
+    for trace in traces.values():
+        tracing.mark(trace, "dequeued")
+
+    pending = (
+        Message.objects.select_related("author", "room")
+        .filter(status=Message.Status.PENDING)
+        .order_by("id")
+    )
+
+    if message_ids is None:
+        messages = claim_messages(pending, settings.MODERATION_BATCH_SIZE)
+    else:
+        messages = claim_messages(pending.filter(id__in=message_ids))
+
+    if not messages:
+        return
+
+    logger.info(f"Moderating {len(messages)} messages concurrently.")
+
+    try:
+        verdicts = classify_locally([message.content for message in messages])
+        decided = [
+            message for message in messages if verdicts[message.content] is not None
+        ]
+
+        if decided:
+            mark_traces(decided, traces, "classified")
+            save_verdicts(decided, [verdicts[message.content] for message in decided])
+            mark_traces(decided, traces, "updated")
+            broadcast_messages(decided, traces)
+
+        undecided = [
+            message for message in messages if verdicts[message.content] is None
+        ]
+
+        if undecided:
+            get_moderation_client().run(amoderate_messages(undecided, retries, traces))
+    except Exception:
+        release_messages(messages)
+        raise
+
+    tracing.flush()
+
+
+@app.task
+def drain_moderation_queue():
+    """
+    Moderates the messages of the fair moderation queue, MODERATION_BATCH_SIZE at a
+    time, until it is empty. The messages of a failed batch are queued again before
+    the task is retried.
+    """
+    from core import moderation_queue
+
+    moderate = (
+        moderate_messages_async
+        if settings.MODERATION_ASYNC_ENABLED
+        else moderate_messages_batch
+    )
+    released = moderation_queue.release_expired()
+
+    if released:
+        logger.warning(f"{len(released)} expired moderation claim(s) released.")
+
+    while True:
+        moderation_queue.refresh_drain()
+        message_ids = moderation_queue.dequeue(settings.MODERATION_BATCH_SIZE)
+
+        if not message_ids:
+            # Messages queued from now on start another task, dequeue the ones
+            # queued in between
+            moderation_queue.end_drain()
+            message_ids = moderation_queue.dequeue(settings.MODERATION_BATCH_SIZE)
+
+            if not message_ids:
+                return
+
+        try:
+            moderate(message_ids)
+        except Exception:
+            moderation_queue.release(message_ids)
+            moderation_queue.end_drain()
+            raise
+
+        moderation_queue.ack(message_ids)
+
+
+@app.task
+def reap_expired_presence():
+    """
+    Removes the connections that stopped sending heartbeats, such as the ones of a
+    crashed server, and tells the rooms which members went offline.
+    """
+    from core import presence
+
+    offline = presence.reap_expired_connections()
+
+    for room_id, usernames in offline.items():
+        send_to_room(
+            room_id, "members_delta", presence.encode_members_delta([], usernames)
         )
-        logger.info(
-            f"Message {message.id} approved and sent to room {message.room.id}."
+
+    if offline:
+        logger.info(f"Expired presence reaped in {len(offline)} room(s).")
+
+
+@app.task
+def snapshot_online_status():
+    """
+    Copies the online members tracked in Redis to the RoomMember.is_online column.
+    """
+    from core import presence
+    from core.models import RoomMember
+
+    online_rooms = presence.get_online_rooms()
+
+    # Members of rooms without anyone online
+    RoomMember.objects.filter(is_online=True).exclude(
+        room_id__in=list(online_rooms)
+    ).update(is_online=False)
+
+    for room_id, usernames in online_rooms.items():
+        members = RoomMember.objects.filter(room_id=room_id)
+        members.filter(is_online=True).exclude(user__username__in=usernames).update(
+            is_online=False
+        )
+        members.filter(is_online=False, user__username__in=usernames).update(
+            is_online=True
         )
-    else:
-        message.status = Message.Status.REJECTED
-        logger.info(f"Message {message.id} rejected due to profanity.")
 
-    message.save()
+    logger.info(f"Online status snapshot taken for {len(online_rooms)} room(s).")
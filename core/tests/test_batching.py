@@ -0,0 +1,68 @@
+from unittest.mock import patch
+
+from asgiref.testing import ApplicationCommunicator
+from django.contrib.auth import get_user_model
+from django.test import TransactionTestCase, override_settings
+
+from core import lifespan
+from core.batching import MessageWriteBuffer, get_write_buffer
+from core.models import Message, Room
+
+User = get_user_model()
+
+
+@override_settings(
+    MESSAGE_WRITE_BUFFER_ENABLED=True,
+    MESSAGE_WRITE_BUFFER_SIZE=10,
+    MESSAGE_WRITE_BUFFER_INTERVAL=10000,
+)
+class MessageWriteBufferTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", password="password")
+        self.room = Room.objects.create(name="Test Room", owner=self.user)
+
+    def create_message(self, content, room_id=None):
+        return Message(
+            room_id=room_id or self.room.id, author=self.user, content=content
+        )
+
+    @patch("core.batching.moderate_messages_batch.delay")
+    async def test_messages_are_saved_one_by_one_if_the_batch_fails(
+        self, mock_moderate_batch
+    ):
+        buffer = MessageWriteBuffer()
+        await buffer.add(self.create_message("First"))
+        await buffer.add(self.create_message("Of a deleted room", self.room.id + 1))
+        await buffer.add(self.create_message("Second"))
+
+        with self.assertLogs("core.batching", "WARNING") as logs:
+            await buffer.flush()
+
+        self.assertIn("saving them one by one", logs.output[0])
+        self.assertIn(f"to room {self.room.id + 1}", logs.output[1])
+
+        messages = [message async for message in Message.objects.order_by("id")]
+        self.assertEqual([message.content for message in messages], ["First", "Second"])
+        mock_moderate_batch.assert_called_once_with(
+            [message.id for message in messages]
+        )
+
+    @patch("core.batching.moderate_messages_batch.delay")
+    async def test_buffer_is_flushed_on_shutdown(self, mock_moderate_batch):
+        await get_write_buffer().add(self.create_message("Hello, World!"))
+
+        communicator = ApplicationCommunicator(
+            lifespan.application, {"type": "lifespan"}
+        )
+        await communicator.send_input({"type": "lifespan.startup"})
+        self.assertEqual(
+            await communicator.receive_output(), {"type": "lifespan.startup.complete"}
+        )
+        self.assertEqual(await Message.objects.acount(), 0)
+
+        await communicator.send_input({"type": "lifespan.shutdown"})
+        self.assertEqual(
+            await communicator.receive_output(), {"type": "lifespan.shutdown.complete"}
+        )
+        self.assertEqual(await Message.objects.acount(), 1)
+        mock_moderate_batch.assert_called_once()
@@ -1,18 +1,33 @@
+import json
 from unittest.mock import patch
 
 from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth import get_user_model
-from django.test import TransactionTestCase
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
 
 from config.asgi import application
+from core import presence, rate_limit, typing_indicators
+from core.consumers import MultiplexConsumer
 from core.models import Message, Room, RoomMember
 
 User = get_user_model()
 
+# Cleared before each test, as the ids of the objects are reused between tests
+LOCAL_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
 
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CACHES=LOCAL_CACHES,
+    PRESENCE_COALESCE_WINDOW=0,
+)
 class RoomConsumerTestCase(TransactionTestCase):
     def setUp(self):
+        cache.clear()
+
         # Creates a test user and room
         self.admin_user = User.objects.create_user(
             username="testuser", password="password", is_staff=True
@@ -22,6 +37,13 @@ class RoomConsumerTestCase(TransactionTestCase):
         )
         RoomMember.objects.create(user=self.admin_user, room=self.room, is_online=False)
 
+        presence.clear(self.room.id)
+        self.addCleanup(presence.clear, self.room.id)
+        rate_limit.clear(self.room.id)
+        self.addCleanup(rate_limit.clear, self.room.id)
+        typing_indicators.clear(self.room.id)
+        self.addCleanup(typing_indicators.clear, self.room.id)
+
     async def test_connect_and_disconnect(self):
         # Simulates the connection WebSocket
         communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
@@ -44,6 +66,10 @@ class RoomConsumerTestCase(TransactionTestCase):
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
 
+        # Discards the online members sent on connection, so receive_nothing waits
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
         # Sends a message to the WebSocket
         message_content = {"message": "Hello, World!"}
         await communicator.send_json_to(message_content)
@@ -62,3 +88,478 @@ class RoomConsumerTestCase(TransactionTestCase):
 
         # Simulates disconnection
         await communicator.disconnect()
+
+    @patch("core.consumers.moderate_message.delay")
+    async def test_receive_message_with_optimistic_delivery(
+        self, mock_moderate_message
+    ):
+        self.room.optimistic_delivery = True
+        await database_sync_to_async(self.room.save)()
+
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user
+
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        # Discards the online members sent on connection
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "Hello, World!"})
+
+        # The message is sent to the room before being moderated
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "chat_message")
+        self.assertEqual(frame["content"], "Hello, World!")
+        mock_moderate_message.assert_called_once_with(frame["id"], trace=None)
+
+        await communicator.disconnect()
+
+    async def test_chat_message_forwards_encoded_frame(self):
+        # Simulates the connection WebSocket
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user  # Simulates an authenticated user
+
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        # Discards the online members sent on connection
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        # Sends an already encoded frame to the room group, as the moderation task does
+        text = '{"type": "chat_message", "id": 1, "content": "Hello, World!"}'
+        await get_channel_layer().group_send(
+            f"room_{self.room.id}",
+            {"type": "chat_message", "room_id": self.room.id, "text": text},
+        )
+
+        # The frame must be forwarded as is
+        self.assertEqual(await communicator.receive_from(), text)
+
+        await communicator.disconnect()
+
+    async def receive_frame(self, communicator, frame_type):
+        """
+        Returns the next frame of the type, skipping the presence frames.
+        """
+        while True:
+            frame = await communicator.receive_json_from()
+
+            if frame["type"] == frame_type:
+                return frame
+
+    async def create_approved_messages(self, count):
+        self.room.last_seq = count
+        await self.room.asave()
+
+        for seq in range(1, count + 1):
+            await Message.objects.acreate(
+                content=f"Message {seq}",
+                room=self.room,
+                author=self.admin_user,
+                status=Message.Status.APPROVED,
+                seq=seq,
+            )
+
+    async def test_reconnect_replays_missed_messages(self):
+        await self.create_approved_messages(5)
+
+        communicator = WebsocketCommunicator(
+            application, f"/ws/rooms/{self.room.id}/?last_seq=3"
+        )
+        communicator.scope["user"] = self.admin_user
+        await communicator.connect()
+
+        frame = await self.receive_frame(communicator, "replay")
+        self.assertEqual(frame["last_seq"], 5)
+        self.assertEqual(
+            [(message["seq"], message["content"]) for message in frame["messages"]],
+            [(4, "Message 4"), (5, "Message 5")],
+        )
+
+        # Sockets detecting a gap in the live messages resume the same way
+        await communicator.send_json_to({"type": "resume", "last_seq": 4})
+        frame = await self.receive_frame(communicator, "replay")
+        self.assertEqual([message["seq"] for message in frame["messages"]], [5])
+
+        await communicator.disconnect()
+
+    @override_settings(HISTORY_REPLAY_LIMIT=2)
+    async def test_reconnect_after_too_many_messages_resyncs(self):
+        await self.create_approved_messages(5)
+
+        for last_seq in [2, 6]:
+            with self.subTest(last_seq=last_seq):
+                communicator = WebsocketCommunicator(
+                    application, f"/ws/rooms/{self.room.id}/?last_seq={last_seq}"
+                )
+                communicator.scope["user"] = self.admin_user
+                await communicator.connect()
+
+                self.assertEqual(
+                    await self.receive_frame(communicator, "resync"),
+                    {"type": "resync", "last_seq": 5},
+                )
+
+                await communicator.disconnect()
+
+    async def test_members_receive_presence_deltas(self):
+        regular_user = await database_sync_to_async(User.objects.create_user)(
+            username="regularuser", password="password"
+        )
+        await RoomMember.objects.acreate(user=regular_user, room=self.room)
+
+        admin_communicator = WebsocketCommunicator(
+            application, f"/ws/rooms/{self.room.id}/"
+        )
+        admin_communicator.scope["user"] = self.admin_user
+        await admin_communicator.connect()
+
+        self.assertEqual(
+            await admin_communicator.receive_json_from(),
+            {"type": "update_members", "members": ["testuser"]},
+        )
+        self.assertEqual(
+            await admin_communicator.receive_json_from(),
+            {"type": "members_delta", "joined": ["testuser"], "left": []},
+        )
+
+        # Another member connects and receives the full list of online members
+        user_communicator = WebsocketCommunicator(
+            application, f"/ws/rooms/{self.room.id}/"
+        )
+        user_communicator.scope["user"] = regular_user
+        await user_communicator.connect()
+
+        self.assertEqual(
+            await user_communicator.receive_json_from(),
+            {"type": "update_members", "members": ["regularuser", "testuser"]},
+        )
+
+        # The members already connected only receive the delta
+        self.assertEqual(
+            await admin_communicator.receive_json_from(),
+            {"type": "members_delta", "joined": ["regularuser"], "left": []},
+        )
+
+        await user_communicator.disconnect()
+        self.assertEqual(
+            await admin_communicator.receive_json_from(),
+            {"type": "members_delta", "joined": [], "left": ["regularuser"]},
+        )
+
+        await admin_communicator.disconnect()
+
+    async def test_heartbeat(self):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        # The connection is reaped, as if it had missed the heartbeats
+        presence.clear(self.room.id)
+
+        await communicator.send_json_to({"type": "ping"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "pong"})
+
+        # The heartbeat registers the connection again
+        self.assertEqual(await presence.aget_online_members(self.room.id), ["testuser"])
+
+        await communicator.disconnect()
+
+    @patch("core.consumers.moderate_message.delay")
+    @patch("core.consumers.release_connections")
+    async def test_connections_are_released_after_database_frames(
+        self, mock_release_connections, mock_moderate_message
+    ):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+        mock_release_connections.reset_mock()
+
+        # Pings don't query the database
+        await communicator.send_json_to({"type": "ping"})
+        await communicator.receive_json_from()
+        mock_release_connections.assert_not_called()
+
+        await communicator.send_json_to({"message": "Hello, World!"})
+        await communicator.receive_nothing()
+        mock_release_connections.assert_called_once()
+
+        await communicator.disconnect()
+
+    @override_settings(TYPING_COALESCE_WINDOW=0)
+    async def test_typing(self):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"type": "typing"})
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "typing", "users": ["testuser"]},
+        )
+
+        # Typing again within the throttle isn't sent, and nothing is saved
+        await communicator.send_json_to({"type": "typing"})
+        await communicator.receive_nothing()
+        self.assertEqual(await Message.objects.acount(), 0)
+
+        await communicator.disconnect()
+
+    @override_settings(MODERATION_ENABLED=False)
+    @patch("core.consumers.moderate_message.delay")
+    async def test_messages_are_left_pending_without_moderation(
+        self, mock_moderate_message
+    ):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "Hello, World!"})
+        await communicator.receive_nothing()
+
+        message = await Message.objects.aget()
+        self.assertEqual(message.status, Message.Status.PENDING)
+        mock_moderate_message.assert_not_called()
+
+        await communicator.disconnect()
+
+    @override_settings(MESSAGE_USER_BURST=1)
+    @patch("core.consumers.moderate_message.delay")
+    async def test_messages_are_rate_limited(self, mock_moderate_message):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user
+        await communicator.connect()
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "First"})
+        await communicator.send_json_to({"message": "Second"})
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "rate_limited")
+        self.assertGreater(frame["retry_after"], 0)
+
+        # Only the first message is saved and sent to moderation
+        self.assertEqual(
+            [message.content async for message in Message.objects.all()], ["First"]
+        )
+        mock_moderate_message.assert_called_once()
+
+        await communicator.disconnect()
+
+    @override_settings(
+        MESSAGE_WRITE_BUFFER_ENABLED=True,
+        MESSAGE_WRITE_BUFFER_SIZE=2,
+        MESSAGE_WRITE_BUFFER_INTERVAL=10000,
+    )
+    @patch("core.batching.moderate_messages_batch.delay")
+    async def test_receive_messages_with_write_buffer(self, mock_moderate_batch):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        # Discards the online members sent on connection
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        # The first message is held in the buffer
+        await communicator.send_json_to({"message": "First"})
+        await communicator.receive_nothing()
+        self.assertEqual(await Message.objects.acount(), 0)
+
+        # The second message fills the buffer, which is saved at once
+        await communicator.send_json_to({"message": "Second"})
+        await communicator.receive_nothing()
+
+        message_ids = [message.id async for message in Message.objects.all()]
+        self.assertEqual(len(message_ids), 2)
+        mock_moderate_batch.assert_called_once_with(message_ids)
+
+        await communicator.disconnect()
+
+    @override_settings(
+        MESSAGE_WRITE_BUFFER_ENABLED=True,
+        MESSAGE_WRITE_BUFFER_SIZE=50,
+        MESSAGE_WRITE_BUFFER_INTERVAL=50,
+    )
+    @patch("core.batching.moderate_messages_batch.delay")
+    async def test_write_buffer_is_flushed_after_the_interval(
+        self, mock_moderate_batch
+    ):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.admin_user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        # Discards the online members sent on connection
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "Hello, World!"})
+        await communicator.receive_nothing(timeout=0.5)
+
+        self.assertEqual(await Message.objects.acount(), 1)
+        mock_moderate_batch.assert_called_once()
+
+        await communicator.disconnect()
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CACHES=LOCAL_CACHES,
+    PRESENCE_COALESCE_WINDOW=0,
+)
+class MultiplexConsumerTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.user = User.objects.create_user(username="testuser", password="password")
+        self.owner = User.objects.create_user(username="owner", password="password")
+        self.rooms = [
+            Room.objects.create(name=f"Room {i}", owner=self.owner) for i in range(3)
+        ]
+
+        # The user isn't a member of the last room
+        for room in self.rooms[:2]:
+            RoomMember.objects.create(user=self.user, room=room)
+
+        for room in self.rooms:
+            presence.clear(room.id)
+            self.addCleanup(presence.clear, room.id)
+            rate_limit.clear(room.id)
+            self.addCleanup(rate_limit.clear, room.id)
+
+    async def connect(self):
+        communicator = WebsocketCommunicator(application, "/ws/rooms/")
+        communicator.scope["user"] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_frames(self, communicator, count):
+        return [await communicator.receive_json_from() for _ in range(count)]
+
+    def test_encode_room_frame(self):
+        consumer = MultiplexConsumer()
+
+        for text in ['{"type": "pong"}', "{}"]:
+            with self.subTest(text=text):
+                frame = json.loads(consumer.encode_room_frame(7, text))
+                self.assertEqual(frame, {"room": 7, **json.loads(text)})
+
+    async def test_subscribe_checks_memberships_in_a_single_query(self):
+        communicator = await self.connect()
+        room_ids = [room.id for room in self.rooms]
+
+        with patch.object(
+            RoomMember.objects, "filter", wraps=RoomMember.objects.filter
+        ) as mock_filter:
+            await communicator.send_json_to({"type": "subscribe", "rooms": room_ids})
+            frame = await communicator.receive_json_from()
+
+        mock_filter.assert_called_once()
+
+        self.assertEqual(
+            frame,
+            {"type": "subscribed", "rooms": room_ids[:2], "denied": room_ids[2:]},
+        )
+
+        # Each room frame is tagged with its room
+        frames = await self.receive_frames(communicator, 4)
+        self.assertCountEqual(
+            [(frame["room"], frame["type"]) for frame in frames],
+            [
+                (room_id, frame_type)
+                for room_id in room_ids[:2]
+                for frame_type in ["update_members", "members_delta"]
+            ],
+        )
+
+        await communicator.disconnect()
+
+    @patch("core.consumers.moderate_message.delay")
+    async def test_events_are_tagged_with_their_room(self, mock_moderate_message):
+        communicator = await self.connect()
+        room_id = self.rooms[0].id
+        await communicator.send_json_to({"type": "subscribe", "rooms": [room_id]})
+        await self.receive_frames(communicator, 3)
+
+        await get_channel_layer().group_send(
+            f"room_{room_id}",
+            {
+                "type": "chat_message",
+                "room_id": room_id,
+                "text": '{"type": "chat_message", "id": 1}',
+            },
+        )
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"room": room_id, "type": "chat_message", "id": 1},
+        )
+
+        # Messages are sent to subscribed rooms only
+        await communicator.send_json_to(
+            {"type": "message", "room": self.rooms[2].id, "message": "Hi"}
+        )
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "user_not_member", "room": self.rooms[2].id},
+        )
+
+        await communicator.send_json_to(
+            {"type": "message", "room": room_id, "message": "Hi"}
+        )
+        await communicator.receive_nothing()
+        mock_moderate_message.assert_called_once()
+        self.assertTrue(
+            await Message.objects.filter(room_id=room_id, content="Hi").aexists()
+        )
+
+        await communicator.disconnect()
+
+    async def test_unsubscribe_leaves_the_room(self):
+        communicator = await self.connect()
+        room_id = self.rooms[0].id
+        await communicator.send_json_to({"type": "subscribe", "rooms": [room_id]})
+        await self.receive_frames(communicator, 3)
+
+        await communicator.send_json_to({"type": "unsubscribe", "rooms": [room_id]})
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "unsubscribed", "rooms": [room_id]},
+        )
+        self.assertEqual(await presence.aget_online_members(room_id), [])
+
+        # Events of the room aren't received anymore
+        await get_channel_layer().group_send(
+            f"room_{room_id}",
+            {"type": "chat_message", "room_id": room_id, "text": "{}"},
+        )
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    @override_settings(WEBSOCKET_MAX_SUBSCRIPTIONS=1)
+    async def test_subscriptions_are_limited(self):
+        communicator = await self.connect()
+        room_ids = [room.id for room in self.rooms[:2]]
+
+        await communicator.send_json_to({"type": "subscribe", "rooms": room_ids})
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "subscribed", "rooms": room_ids[:1], "denied": room_ids[1:]},
+        )
+
+        await communicator.disconnect()
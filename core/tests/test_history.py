@@ -0,0 +1,126 @@
+from unittest.mock import AsyncMock, patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core import history
+from core.models import Message, Room
+from core.tasks import moderate_message
+
+User = get_user_model()
+
+
+@override_settings(HISTORY_BUFFER_SIZE=3)
+class HistoryBufferTestCase(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="user", password="password")
+        self.room = Room.objects.create(name="Test Room", owner=self.user)
+        self.room.members.add(self.user)
+
+        history.clear(self.room.id)
+        self.addCleanup(history.clear, self.room.id)
+
+        self.messages = [self.create_message(f"Message {i}") for i in range(4)]
+
+    def create_message(self, content, status=Message.Status.APPROVED):
+        return Message.objects.create(
+            content=content, room=self.room, author=self.user, status=status
+        )
+
+    def contents(self):
+        return [message["content"] for message in history.get_latest(self.room.id)]
+
+    def test_buffer_is_built_lazily_with_the_latest_messages(self):
+        self.create_message("Pending", status=Message.Status.PENDING)
+
+        self.assertEqual(self.contents(), ["Message 1", "Message 2", "Message 3"])
+
+        # Served from Redis afterwards
+        with self.assertNumQueries(0):
+            self.assertEqual(self.contents(), ["Message 1", "Message 2", "Message 3"])
+
+    @patch("channels.layers.get_channel_layer")
+    @patch("core.tasks.is_safe_content", return_value=True)
+    def test_approved_messages_are_appended(
+        self, mock_is_safe_content, mock_channel_layer
+    ):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        history.get_latest(self.room.id)
+
+        message = self.create_message("Is it new?", status=Message.Status.PENDING)
+        moderate_message(message.id)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.contents(), ["Message 2", "Message 3", "Is it new?"])
+
+    def test_messages_approved_out_of_order_are_sorted(self):
+        history.get_latest(self.room.id)
+        first, second, third = [
+            self.create_message(content, status=Message.Status.PENDING)
+            for content in ["First", "Second", "Third"]
+        ]
+        # Messages created at the same time are sorted by id
+        Message.objects.filter(id=third.id).update(created_at=second.created_at)
+        third.refresh_from_db()
+
+        for message in [third, first, second]:
+            message.status = Message.Status.APPROVED
+            history.append([message])
+
+        self.assertEqual(self.contents(), ["First", "Second", "Third"])
+
+        # A message older than the buffered ones doesn't fit in it
+        self.messages[0].content = "Late"
+        history.append([self.messages[0]])
+
+        self.assertEqual(self.contents(), ["First", "Second", "Third"])
+
+    def test_buffer_is_invalidated_on_delete_and_edit(self):
+        history.get_latest(self.room.id)
+
+        self.messages[3].delete()
+        self.assertEqual(self.contents(), ["Message 0", "Message 1", "Message 2"])
+
+        self.messages[2].status = Message.Status.REJECTED
+        self.messages[2].save()
+        self.assertEqual(self.contents(), ["Message 0", "Message 1"])
+
+    def test_rebuild_racing_with_a_change_is_not_stored(self):
+        original_filter = Message.objects.filter
+
+        def filter_and_change(*args, **kwargs):
+            # A message is deleted while the buffer is being rebuilt
+            history.invalidate(self.room.id)
+            return original_filter(*args, **kwargs)
+
+        with patch.object(Message.objects, "filter", side_effect=filter_and_change):
+            self.assertEqual(len(history.get_latest(self.room.id)), 3)
+
+        self.assertEqual(history.get_redis().zcard(history.buffer_key(self.room.id)), 0)
+
+    def test_first_page_is_served_from_the_buffer(self):
+        client = APIClient()
+        client.credentials(
+            HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.user)}"
+        )
+        url = f"/api/rooms/{self.room.id}/messages/"
+        history.get_latest(self.room.id)
+
+        # Authentication, membership and optimistic delivery checks only
+        with self.assertNumQueries(3):
+            response = client.get(url, {"page_size": 2})
+
+        self.assertEqual(
+            [message["content"] for message in response.data["results"]],
+            ["Message 2", "Message 3"],
+        )
+        self.assertIsNone(response.data["next"])
+
+        # Older pages come from the database
+        response = client.get(response.data["previous"])
+        self.assertEqual(
+            [message["content"] for message in response.data["results"]],
+            ["Message 0", "Message 1"],
+        )
@@ -0,0 +1,112 @@
+from contextlib import asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from core import lookups
+from core.models import Room, RoomMember
+
+User = get_user_model()
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class LookupsTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.user = User.objects.create_user(username="user", password="password")
+        self.rooms = [
+            Room.objects.create(name=f"Room {i}", owner=self.user) for i in range(3)
+        ]
+        RoomMember.objects.create(user=self.user, room=self.rooms[0])
+        self.room_ids = [room.id for room in self.rooms]
+
+    @asynccontextmanager
+    async def assertNumQueries(self, num):
+        # The async ORM runs the queries with the connection of the sync thread
+        context = CaptureQueriesContext(connection)
+        await sync_to_async(context.__enter__)()
+
+        try:
+            yield
+        finally:
+            await sync_to_async(context.__exit__)(None, None, None)
+
+        self.assertEqual(await sync_to_async(len)(context), num)
+
+    async def test_user_is_cached_until_changed(self):
+        self.assertEqual(await lookups.aget_user(self.user.id), self.user)
+
+        async with self.assertNumQueries(0):
+            user = await lookups.aget_user(self.user.id)
+            self.assertEqual(user.username, "user")
+            self.assertFalse(user.is_staff)
+
+        self.user.username = "renamed"
+        await self.user.asave()
+        user = await lookups.aget_user(self.user.id)
+        self.assertEqual(user.username, "renamed")
+
+        self.assertIsNone(await lookups.aget_user(0))
+
+    async def test_user_is_cached_without_its_password(self):
+        await lookups.aget_user(self.user.id)
+
+        self.assertEqual(
+            await cache.aget(lookups.user_key(self.user.id)),
+            {
+                "id": self.user.id,
+                "username": "user",
+                "is_staff": False,
+                "is_active": True,
+            },
+        )
+
+    async def test_memberships_are_resolved_in_a_single_query(self):
+        async with self.assertNumQueries(1):
+            self.assertEqual(
+                await lookups.aget_member_room_ids(self.user.id, self.room_ids),
+                {self.room_ids[0]},
+            )
+
+        # Non-memberships are cached too
+        async with self.assertNumQueries(0):
+            self.assertFalse(await lookups.ais_member(self.user.id, self.room_ids[1]))
+            self.assertTrue(await lookups.ais_member(self.user.id, self.room_ids[0]))
+
+    async def test_memberships_are_invalidated_on_change(self):
+        await lookups.aget_member_room_ids(self.user.id, self.room_ids)
+
+        await self.rooms[1].members.aadd(self.user)
+        await RoomMember.objects.acreate(user=self.user, room=self.rooms[2])
+        await (await RoomMember.objects.filter(room=self.rooms[0]).aget()).adelete()
+
+        self.assertEqual(
+            await lookups.aget_member_room_ids(self.user.id, self.room_ids),
+            set(self.room_ids[1:]),
+        )
+
+        await self.user.room_members.aremove(self.rooms[1])
+        await self.rooms[2].members.aclear()
+
+        self.assertEqual(
+            await lookups.aget_member_room_ids(self.user.id, self.room_ids), set()
+        )
+
+    async def test_room_is_cached_until_changed(self):
+        await lookups.aget_room(self.room_ids[0])
+
+        async with self.assertNumQueries(0):
+            room = await lookups.aget_room(self.room_ids[0])
+            self.assertFalse(room.optimistic_delivery)
+
+        self.rooms[0].optimistic_delivery = True
+        await self.rooms[0].asave()
+        room = await lookups.aget_room(self.room_ids[0])
+        self.assertTrue(room.optimistic_delivery)
@@ -0,0 +1,73 @@
+from datetime import timedelta
+
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+
+class NumberApprovedMessagesMigrationTestCase(TransactionTestCase):
+    migrate_from = [("core", "0008_message_claimed_until")]
+    migrate_to = [("core", "0009_number_approved_messages")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_approved_messages_are_numbered_in_order(self):
+        apps = self.migrate(self.migrate_from)
+        User = apps.get_model("auth", "User")
+        Room = apps.get_model("core", "Room")
+        Message = apps.get_model("core", "Message")
+
+        user = User.objects.create(username="user")
+        room = Room.objects.create(name="Room", owner=user)
+        other_room = Room.objects.create(name="Other Room", owner=user)
+        now = timezone.now()
+        messages = [
+            Message.objects.create(
+                content=content, status=status, seq=seq, room=room, author=user
+            )
+            for content, status, seq in [
+                ("Approved later", "approved", 1),
+                ("Rejected", "rejected", None),
+                ("Approved first", "approved", None),
+                ("Approved second", "approved", None),
+                ("Pending", "pending", None),
+            ]
+        ]
+        # Created in another order than the ids, the last two at the same time
+        for message, minutes in zip(messages, [3, 0, 1, 2, 2]):
+            Message.objects.filter(id=message.id).update(
+                created_at=now + timedelta(minutes=minutes)
+            )
+        Message.objects.create(
+            content="Other", status="approved", room=other_room, author=user
+        )
+
+        apps = self.migrate(self.migrate_to)
+        Room = apps.get_model("core", "Room")
+        Message = apps.get_model("core", "Message")
+
+        self.assertEqual(
+            list(
+                Message.objects.filter(room_id=room.id)
+                .order_by("created_at", "id")
+                .values_list("content", "seq")
+            ),
+            [
+                ("Rejected", None),
+                ("Approved first", 1),
+                ("Approved second", 2),
+                ("Pending", None),
+                ("Approved later", 3),
+            ],
+        )
+        self.assertEqual(Room.objects.get(id=room.id).last_seq, 3)
+        self.assertEqual(Message.objects.get(room_id=other_room.id).seq, 1)
+        self.assertEqual(Room.objects.get(id=other_room.id).last_seq, 1)
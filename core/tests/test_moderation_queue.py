@@ -0,0 +1,218 @@
+import time
+from unittest.mock import call, patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from core import moderation_queue
+from core.models import Message, Room
+from core.tasks import drain_moderation_queue
+
+User = get_user_model()
+
+LANES = [
+    {"name": "direct", "max_members": 2, "weight": 2},
+    {"name": "broadcast", "max_members": None, "weight": 1},
+]
+LOCAL_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@override_settings(
+    MODERATION_QUEUE_BACKEND="core.moderation_queue.LocalQueueBackend",
+    MODERATION_LANES=LANES,
+    CACHES=LOCAL_CACHES,
+)
+class LocalModerationQueueTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        moderation_queue.get_backend().clear()
+        self.addCleanup(moderation_queue.get_backend().clear)
+
+        self.owner = User.objects.create_user(username="owner", password="password")
+        self.direct_room = self.create_room("Direct", members=2)
+        self.spammy_room = self.create_room("Spammy", members=3)
+        self.quiet_room = self.create_room("Quiet", members=3)
+
+    def create_room(self, name, members):
+        room = Room.objects.create(name=name, owner=self.owner)
+
+        for i in range(members):
+            user, _ = User.objects.get_or_create(username=f"member{i}")
+            room.members.add(user)
+
+        return room
+
+    def create_messages(self, room, count):
+        return [
+            Message.objects.create(content=f"{i}", room=room, author=self.owner)
+            for i in range(count)
+        ]
+
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_rooms_of_a_lane_are_drained_round_robin(self, mock_drain):
+        spammy_messages = self.create_messages(self.spammy_room, 5)
+        quiet_messages = self.create_messages(self.quiet_room, 1)
+
+        moderation_queue.enqueue(spammy_messages)
+        moderation_queue.enqueue(quiet_messages)
+
+        # The first drain task dequeues the messages of both calls
+        self.assertEqual(mock_drain.call_count, 1)
+        # The quiet room doesn't wait for the spammy room's backlog
+        self.assertEqual(
+            moderation_queue.dequeue(3),
+            [spammy_messages[0].id, quiet_messages[0].id, spammy_messages[1].id],
+        )
+
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_lanes_are_drained_by_weight(self, mock_drain):
+        broadcast_messages = self.create_messages(self.spammy_room, 3)
+        direct_messages = self.create_messages(self.direct_room, 3)
+
+        moderation_queue.enqueue(broadcast_messages + direct_messages)
+
+        self.assertEqual(
+            moderation_queue.dequeue(6),
+            [
+                direct_messages[0].id,
+                direct_messages[1].id,
+                broadcast_messages[0].id,
+                direct_messages[2].id,
+                broadcast_messages[1].id,
+                broadcast_messages[2].id,
+            ],
+        )
+        self.assertEqual(moderation_queue.dequeue(1), [])
+
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_stats(self, mock_drain):
+        moderation_queue.enqueue(self.create_messages(self.spammy_room, 3))
+        moderation_queue.dequeue(2)
+
+        stats = moderation_queue.get_stats()
+        self.assertEqual(stats["broadcast"]["depth"], 1)
+        self.assertEqual(stats["broadcast"]["claimed"], 2)
+        self.assertEqual(stats["broadcast"]["dequeued"], 2)
+        self.assertEqual(stats["direct"]["depth"], 0)
+
+    @patch("core.tasks.moderate_messages_batch")
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_drain_moderates_the_dequeued_messages(self, mock_drain, mock_moderate):
+        messages = self.create_messages(self.direct_room, 2)
+        moderation_queue.enqueue(messages)
+
+        with self.settings(MODERATION_BATCH_SIZE=1):
+            drain_moderation_queue()
+
+        self.assertEqual(
+            mock_moderate.call_args_list,
+            [call([messages[0].id]), call([messages[1].id])],
+        )
+        self.assertEqual(moderation_queue.get_stats()["direct"]["claimed"], 0)
+
+    @patch("core.tasks.moderate_messages_batch", side_effect=ValueError)
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_failed_drain_queues_the_messages_again(self, mock_drain, mock_moderate):
+        messages = self.create_messages(self.direct_room, 2)
+        moderation_queue.enqueue(messages)
+
+        with self.settings(MODERATION_BATCH_SIZE=1), self.assertRaises(ValueError):
+            drain_moderation_queue()
+
+        stats = moderation_queue.get_stats()["direct"]
+        self.assertEqual(stats["depth"], 2)
+        self.assertEqual(stats["claimed"], 0)
+        self.assertEqual(moderation_queue.dequeue(2), [messages[0].id, messages[1].id])
+
+        # The failed task dropped its lease, the messages queued meanwhile start
+        # another one
+        moderation_queue.enqueue(self.create_messages(self.direct_room, 1))
+        self.assertEqual(mock_drain.call_count, 2)
+
+    @override_settings(MODERATION_BATCH_SIZE=1, MODERATION_CLAIM_TIMEOUT=10)
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_running_drain_keeps_its_lease(self, mock_drain):
+        now = time.time()
+        moderation_queue.enqueue(self.create_messages(self.direct_room, 2))
+        batches = []
+
+        def moderate(message_ids):
+            # Each batch outlasts most of the lease, and more messages are queued
+            batches.append(message_ids)
+            clock.return_value += 8
+
+            if len(batches) < 3:
+                moderation_queue.enqueue(self.create_messages(self.quiet_room, 1))
+
+        with (
+            patch("core.moderation_queue.time.time", return_value=now) as clock,
+            patch("core.tasks.moderate_messages_batch", side_effect=moderate),
+        ):
+            drain_moderation_queue()
+
+        self.assertEqual(len(batches), 4)
+        self.assertEqual(mock_drain.call_count, 1)
+
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_expired_claims_are_released(self, mock_drain):
+        messages = self.create_messages(self.direct_room, 2)
+        moderation_queue.enqueue(messages)
+        moderation_queue.dequeue(2)
+
+        self.assertEqual(moderation_queue.release_expired(), [])
+
+        with self.settings(MODERATION_CLAIM_TIMEOUT=0):
+            time.sleep(0.01)
+            released = moderation_queue.release_expired()
+
+        self.assertCountEqual(released, [messages[0].id, messages[1].id])
+        self.assertEqual(moderation_queue.dequeue(2), [messages[0].id, messages[1].id])
+
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_acked_claims_are_not_released(self, mock_drain):
+        messages = self.create_messages(self.direct_room, 2)
+        moderation_queue.enqueue(messages)
+        moderation_queue.ack(moderation_queue.dequeue(2))
+
+        with self.settings(MODERATION_CLAIM_TIMEOUT=0):
+            self.assertEqual(moderation_queue.release_expired(), [])
+
+        self.assertEqual(moderation_queue.dequeue(2), [])
+
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_drain_is_started_again_once_the_queue_is_empty(self, mock_drain):
+        moderation_queue.enqueue(self.create_messages(self.direct_room, 1))
+        moderation_queue.enqueue(self.create_messages(self.direct_room, 1))
+        self.assertEqual(mock_drain.call_count, 1)
+
+        with patch("core.tasks.moderate_messages_batch"):
+            drain_moderation_queue()
+
+        moderation_queue.enqueue(self.create_messages(self.direct_room, 1))
+        self.assertEqual(mock_drain.call_count, 2)
+
+    @patch("core.tasks.drain_moderation_queue.delay")
+    def test_member_counts_are_cached(self, mock_drain):
+        moderation_queue.enqueue(self.create_messages(self.spammy_room, 1))
+
+        message = self.create_messages(self.spammy_room, 1)[0]
+
+        with self.assertNumQueries(0):
+            moderation_queue.enqueue([message])
+
+        self.assertEqual(moderation_queue.get_stats()["broadcast"]["depth"], 2)
+
+        # Members leaving the room move it to another lane
+        self.spammy_room.members.remove(User.objects.get(username="member2"))
+        moderation_queue.enqueue(self.create_messages(self.spammy_room, 1))
+
+        self.assertEqual(moderation_queue.get_stats()["direct"]["depth"], 1)
+
+
+@override_settings(
+    MODERATION_QUEUE_BACKEND="core.moderation_queue.RedisQueueBackend",
+    MODERATION_LANES=LANES,
+)
+class RedisModerationQueueTestCase(LocalModerationQueueTestCase):
+    pass
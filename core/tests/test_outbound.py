@@ -0,0 +1,270 @@
+import asyncio
+import base64
+import json
+import os
+import socket
+import time
+
+from unittest.mock import AsyncMock, patch
+
+import uvicorn
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from redis.exceptions import RedisError
+from rest_framework_simplejwt.tokens import AccessToken
+
+from config.asgi import application
+from core import outbound, presence
+from core.models import Room, RoomMember
+from core.outbound import (
+    INTERNAL_ERROR_CLOSE_CODE,
+    SLOW_CONSUMER_CLOSE_CODE,
+    OutboundQueue,
+)
+from core.redis_client import get_redis
+
+User = get_user_model()
+
+
+class FakeConsumer:
+    """
+    Socket whose client reads its frames only when told to. Writes wait for the
+    client as they do under Uvicorn, see ServerBackpressureTestCase.
+    """
+
+    channel_name = "fake"
+
+    def __init__(self):
+        self.written = []
+        self.closed_with = None
+        self.reading = asyncio.Event()
+
+    async def write(self, text):
+        await self.reading.wait()
+        self.written.append(json.loads(text))
+
+    async def write_close(self, code, reason=None):
+        self.closed_with = code
+
+    async def encode_members_snapshot(self, room_id):
+        return json.dumps({"type": "update_members", "room": room_id})
+
+
+def presence_frame(room_id, username):
+    return json.dumps({"type": "members_delta", "room": room_id, "joined": [username]})
+
+
+def chat_frame(message_id):
+    return json.dumps({"type": "chat_message", "id": message_id})
+
+
+@override_settings(WEBSOCKET_SEND_QUEUE_SIZE=3)
+class OutboundQueueTestCase(SimpleTestCase):
+    async def read_all(self, consumer, queue):
+        consumer.reading.set()
+
+        while queue.items:
+            await asyncio.sleep(0)
+
+        # Lets the last write finish
+        await asyncio.sleep(0.01)
+        queue.stop()
+        return consumer.written
+
+    async def fill(self, queue):
+        # The first frame is taken by the writer, blocked on the client
+        queue.put(chat_frame(0))
+        await asyncio.sleep(0)
+        queue.put(presence_frame(1, "alice"), 1, presence=True)
+        queue.put(presence_frame(1, "bob"), 1, presence=True)
+        queue.put(chat_frame(1))
+
+    @override_settings(WEBSOCKET_SEND_QUEUE_POLICY="drop_presence")
+    async def test_drop_presence_drops_the_oldest_presence_frame(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer)
+        dropped = outbound.stats.dropped
+        await self.fill(queue)
+
+        queue.put(chat_frame(2))
+
+        self.assertEqual(outbound.stats.dropped, dropped + 1)
+        self.assertEqual(
+            [
+                frame.get("joined") or frame["id"]
+                for frame in await self.read_all(consumer, queue)
+            ],
+            [0, ["bob"], 1, 2],
+        )
+
+    @override_settings(WEBSOCKET_SEND_QUEUE_POLICY="collapse_presence")
+    async def test_collapse_presence_collapses_frames_into_a_snapshot(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer)
+        await self.fill(queue)
+
+        queue.put(chat_frame(2))
+
+        self.assertEqual(
+            [frame["type"] for frame in await self.read_all(consumer, queue)],
+            ["chat_message", "update_members", "chat_message", "chat_message"],
+        )
+
+    @override_settings(WEBSOCKET_SEND_QUEUE_POLICY="disconnect")
+    async def test_ephemeral_frames_are_dropped_first(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer)
+        queue.put(chat_frame(0))
+        await asyncio.sleep(0)
+        queue.put(chat_frame(1))
+        queue.put('{"type": "typing", "users": ["alice"]}', 1, ephemeral=True)
+        queue.put(chat_frame(2))
+
+        queue.put(chat_frame(3))
+
+        self.assertEqual(
+            [frame["id"] for frame in await self.read_all(consumer, queue)],
+            [0, 1, 2, 3],
+        )
+
+    @override_settings(WEBSOCKET_SEND_QUEUE_POLICY="disconnect")
+    async def test_full_queue_disconnects_the_socket(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer)
+        await self.fill(queue)
+
+        with self.assertLogs("core.outbound", "WARNING"):
+            queue.put(chat_frame(2))
+
+        # Frames queued after the disconnection are ignored
+        queue.put(chat_frame(3))
+
+        # The socket is closed without waiting for the frame being written
+        await asyncio.sleep(0)
+        self.assertEqual(consumer.closed_with, SLOW_CONSUMER_CLOSE_CODE)
+        self.assertEqual(await self.read_all(consumer, queue), [])
+
+    async def test_failed_write_closes_the_socket(self):
+        consumer = FakeConsumer()
+        consumer.write = AsyncMock(side_effect=ValueError)
+        queue = OutboundQueue(consumer)
+
+        with self.assertLogs("core.outbound", "ERROR"):
+            queue.put(chat_frame(1))
+            queue.put(chat_frame(2))
+            await asyncio.wait_for(queue.task, timeout=1)
+
+        consumer.write.assert_awaited_once()
+        self.assertEqual(consumer.closed_with, INTERNAL_ERROR_CLOSE_CODE)
+        queue.stop()
+
+    async def test_failed_stats_publish_is_logged(self):
+        with (
+            patch("core.outbound.get_async_redis", side_effect=RedisError),
+            self.assertLogs("core.outbound", "WARNING"),
+        ):
+            await outbound.stats.apublish(force=True)
+
+    async def test_stats_are_published(self):
+        consumer = FakeConsumer()
+        queue = OutboundQueue(consumer)
+        await self.fill(queue)
+
+        await outbound.stats.apublish(force=True)
+        self.addCleanup(get_redis().delete, outbound.stats.key)
+        stats = outbound.get_stats()
+
+        self.assertGreaterEqual(stats["depth"], 3)
+        self.assertGreaterEqual(stats["max_depth"], 3)
+        self.assertIn(
+            outbound.stats.key.removeprefix(outbound.STATS_KEY_PREFIX),
+            stats["processes"],
+        )
+
+        await self.read_all(consumer, queue)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    PRESENCE_COALESCE_WINDOW=0,
+    WEBSOCKET_SEND_QUEUE_SIZE=4,
+    WEBSOCKET_SEND_QUEUE_POLICY="disconnect",
+)
+class ServerBackpressureTestCase(TransactionTestCase):
+    """
+    Runs the sockets under Uvicorn, as in production, with a client that stops
+    reading its frames.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="slow", password="password")
+        self.room = Room.objects.create(name="Room", owner=self.user)
+        RoomMember.objects.create(user=self.user, room=self.room)
+        presence.clear(self.room.id)
+        self.addCleanup(presence.clear, self.room.id)
+
+    async def start_server(self):
+        server = uvicorn.Server(
+            uvicorn.Config(
+                application, port=0, ws="websockets", lifespan="off", log_level="error"
+            )
+        )
+        self.server_task = asyncio.create_task(server.serve())
+
+        while not server.started:
+            await asyncio.sleep(0.01)
+
+        self.server = server
+        return server.servers[0].sockets[0].getsockname()[1]
+
+    async def stop_server(self):
+        self.server.should_exit = True
+        await asyncio.wait_for(self.server_task, timeout=10)
+
+    async def connect_slow_client(self, port):
+        loop = asyncio.get_running_loop()
+        client = socket.socket()
+        # A small receive window fills up right away
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        client.setblocking(False)
+        await loop.sock_connect(client, ("127.0.0.1", port))
+        await loop.sock_sendall(
+            client,
+            (
+                f"GET /ws/rooms/{self.room.id}/?token={AccessToken.for_user(self.user)} "
+                "HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n"
+                "Connection: Upgrade\r\nSec-WebSocket-Version: 13\r\n"
+                f"Sec-WebSocket-Key: {base64.b64encode(os.urandom(16)).decode()}"
+                "\r\n\r\n"
+            ).encode(),
+        )
+        response = await asyncio.wait_for(loop.sock_recv(client, 1024), timeout=5)
+        self.assertTrue(response.startswith(b"HTTP/1.1 101"))
+        return client
+
+    async def test_client_that_stops_reading_is_disconnected(self):
+        client = await self.connect_slow_client(await self.start_server())
+
+        try:
+            await self.send_until_disconnected()
+        finally:
+            client.close()
+            await self.stop_server()
+
+    async def send_until_disconnected(self):
+        disconnected = outbound.stats.disconnected
+        channel_layer = get_channel_layer()
+        text = json.dumps({"type": "chat_message", "content": "x" * 65536})
+        deadline = time.monotonic() + 20
+
+        # Frames are sent until the writes wait for the client and the queue fills
+        with self.assertLogs("core.outbound", "WARNING"):
+            while outbound.stats.disconnected == disconnected:
+                self.assertLess(time.monotonic(), deadline)
+                await channel_layer.group_send(
+                    f"room_{self.room.id}",
+                    {"type": "chat_message", "room_id": self.room.id, "text": text},
+                )
+                await asyncio.sleep(0.001)
@@ -0,0 +1,135 @@
+from unittest.mock import AsyncMock, patch
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from core import prefilter
+from core.models import Message, Room
+from core.tasks import moderate_message, moderate_messages_batch
+from core.verdict_cache import verdict_cache
+
+User = get_user_model()
+
+
+class AhoCorasickTestCase(SimpleTestCase):
+    def test_finds_overlapping_patterns(self):
+        matcher = prefilter.AhoCorasick(["he", "she", "his", "hers"])
+
+        self.assertEqual(sorted(matcher.finditer("ushers")), [(1, 4), (2, 4), (2, 6)])
+
+
+@override_settings(
+    MODERATION_BLOCKLIST=["badword", "very bad phrase"],
+    MODERATION_ALLOWLIST=["ok", "thank you"],
+)
+class PrefilterTestCase(SimpleTestCase):
+    def test_blocked_contents_are_rejected(self):
+        self.assertIs(prefilter.classify("You BADWORD!"), False)
+        self.assertIs(prefilter.classify("what a  very bad   phrase"), False)
+
+    def test_blocked_words_inside_other_words_are_ignored(self):
+        self.assertIsNone(prefilter.classify("notbadwords here"))
+
+    def test_allowed_contents_are_approved(self):
+        self.assertIs(prefilter.classify("OK!"), True)
+        self.assertIs(prefilter.classify("Thank  you."), True)
+        self.assertIs(prefilter.classify("👍🏽 🎉"), True)
+        self.assertIs(prefilter.classify("👨‍👩‍👧"), True)
+        self.assertIs(prefilter.classify("❤️ 🇧🇷"), True)
+
+    def test_other_contents_are_undecided(self):
+        self.assertIsNone(prefilter.classify("ok, see you tomorrow"))
+        self.assertIsNone(prefilter.classify("👍 sure"))
+        self.assertIsNone(prefilter.classify("..."))
+
+    def test_emojis_hiding_characters_are_undecided(self):
+        # Combining marks, invisible and bidirectional formatting characters
+        self.assertIsNone(prefilter.classify("🎉\u0301\u0301"))
+        self.assertIsNone(prefilter.classify("🎉\u200b🎉"))
+        self.assertIsNone(prefilter.classify("🎉\u202e🎉"))
+        self.assertIsNone(prefilter.classify("🏴\U000e0062\U000e007f"))
+
+    def test_symbols_other_than_emojis_are_undecided(self):
+        # ASCII modifiers, arrows, box drawing and religious symbols
+        self.assertIsNone(prefilter.classify("^^"))
+        self.assertIsNone(prefilter.classify("`"))
+        self.assertIsNone(prefilter.classify("→ ←"))
+        self.assertIsNone(prefilter.classify("─┼─"))
+        self.assertIsNone(prefilter.classify("卍"))
+        self.assertIsNone(prefilter.classify("\u0fd5"))
+
+    def test_long_emoji_contents_are_undecided(self):
+        self.assertIs(prefilter.classify("🎉" * prefilter.EMOJI_MAX_LENGTH), True)
+        self.assertIsNone(prefilter.classify("🎉" * (prefilter.EMOJI_MAX_LENGTH + 1)))
+
+    @override_settings(MODERATION_PREFILTERS=[])
+    def test_prefilters_can_be_disabled(self):
+        self.assertIsNone(prefilter.classify("ok"))
+
+
+@override_settings(MODERATION_BLOCKLIST=["badword"], MODERATION_ALLOWLIST=["ok"])
+class PrefilterModerationTestCase(TestCase):
+    def setUp(self):
+        verdict_cache.clear()
+        self.addCleanup(verdict_cache.clear)
+
+        self.admin_user = User.objects.create_user(
+            username="admin", password="adminpass", is_staff=True
+        )
+        self.room = Room.objects.create(
+            name="Test Room", is_private=False, owner=self.admin_user
+        )
+
+    def create_message(self, content):
+        return Message.objects.create(
+            content=content,
+            room=self.room,
+            status=Message.Status.PENDING,
+            author=self.admin_user,
+        )
+
+    @patch("core.tasks.is_safe_content")
+    @patch("channels.layers.get_channel_layer")
+    def test_moderate_message_skips_the_model(
+        self, mock_channel_layer, mock_is_safe_content
+    ):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        allowed_message = self.create_message("ok")
+        blocked_message = self.create_message("badword")
+
+        moderate_message(allowed_message.id)
+        moderate_message(blocked_message.id)
+
+        mock_is_safe_content.assert_not_called()
+        mock_channel_layer.return_value.group_send.assert_called_once()
+
+        allowed_message.refresh_from_db()
+        blocked_message.refresh_from_db()
+        self.assertEqual(allowed_message.status, Message.Status.APPROVED)
+        self.assertEqual(blocked_message.status, Message.Status.REJECTED)
+
+    @patch("core.tasks.are_safe_contents", return_value=[False])
+    @patch("channels.layers.get_channel_layer")
+    def test_moderate_messages_batch_sends_only_undecided_contents(
+        self, mock_channel_layer, mock_are_safe_contents
+    ):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        messages = [
+            self.create_message("ok"),
+            self.create_message("badword"),
+            self.create_message("is this fine?"),
+        ]
+
+        moderate_messages_batch([message.id for message in messages])
+
+        mock_are_safe_contents.assert_called_once_with(["is this fine?"])
+
+        statuses = [Message.objects.get(id=message.id).status for message in messages]
+        self.assertEqual(
+            statuses,
+            [
+                Message.Status.APPROVED,
+                Message.Status.REJECTED,
+                Message.Status.REJECTED,
+            ],
+        )
@@ -0,0 +1,132 @@
+import asyncio
+import json
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+
+from core import presence
+from core.models import Room, RoomMember
+from core.tasks import snapshot_online_status
+
+User = get_user_model()
+
+
+class PresenceTestCase(TestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_user(
+            username="admin", password="adminpass", is_staff=True
+        )
+        self.regular_user = User.objects.create_user(
+            username="user", password="userpass"
+        )
+        self.room = Room.objects.create(
+            name="Test Room", is_private=False, owner=self.admin_user
+        )
+        self.admin_member = RoomMember.objects.create(
+            user=self.admin_user, room=self.room
+        )
+        self.regular_member = RoomMember.objects.create(
+            user=self.regular_user, room=self.room, is_online=True
+        )
+
+        presence.clear(self.room.id)
+        self.addCleanup(presence.clear, self.room.id)
+
+    async def test_user_stays_online_while_a_connection_is_open(self):
+        # Opens two connections (e.g. two tabs)
+        self.assertTrue(await presence.join(self.room.id, "tab-1", "admin"))
+        self.assertFalse(await presence.join(self.room.id, "tab-2", "admin"))
+        self.assertEqual(await presence.aget_online_members(self.room.id), ["admin"])
+
+        # A heartbeat doesn't count as a new connection
+        self.assertFalse(await presence.join(self.room.id, "tab-1", "admin"))
+
+        # Closes one of the two connections
+        self.assertFalse(await presence.leave(self.room.id, "tab-1"))
+        self.assertEqual(await presence.aget_online_members(self.room.id), ["admin"])
+
+        # Closing the same connection again has no effect
+        self.assertFalse(await presence.leave(self.room.id, "tab-1"))
+
+        # Closes the last connection
+        self.assertTrue(await presence.leave(self.room.id, "tab-2"))
+        self.assertEqual(await presence.aget_online_members(self.room.id), [])
+
+    async def test_online_rooms(self):
+        await presence.join(self.room.id, "tab-1", "admin")
+        self.assertEqual(presence.get_online_rooms().get(self.room.id), {"admin"})
+
+        await presence.leave(self.room.id, "tab-1")
+        self.assertNotIn(self.room.id, presence.get_online_rooms())
+
+    def test_expired_connections_are_reaped(self):
+        with self.settings(PRESENCE_TTL=-1):
+            async_to_sync(presence.join)(self.room.id, "crashed", "admin")
+
+        async_to_sync(presence.join)(self.room.id, "alive", "user")
+
+        self.assertEqual(
+            presence.reap_expired_connections().get(self.room.id), ["admin"]
+        )
+        self.assertEqual(presence.get_online_members(self.room.id), ["user"])
+
+    def test_snapshot_online_status(self):
+        async_to_sync(presence.join)(self.room.id, "tab-1", "admin")
+
+        snapshot_online_status()
+
+        self.admin_member.refresh_from_db()
+        self.regular_member.refresh_from_db()
+        self.assertTrue(self.admin_member.is_online)
+        self.assertFalse(self.regular_member.is_online)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    PRESENCE_COALESCE_WINDOW=100,
+)
+class PresenceCoalescerTestCase(TestCase):
+    async def subscribe(self):
+        self.channel_layer = get_channel_layer()
+        self.channel_name = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add("room_1", self.channel_name)
+
+    async def unsubscribe(self):
+        await self.channel_layer.group_discard("room_1", self.channel_name)
+
+    async def test_changes_are_sent_in_a_single_frame(self):
+        await self.subscribe()
+
+        await presence.publish_change(1, "alice", True)
+        await presence.publish_change(1, "bob", True)
+        await presence.publish_change(1, "carol", False)
+
+        event = await asyncio.wait_for(
+            self.channel_layer.receive(self.channel_name), timeout=1
+        )
+        self.assertEqual(event["type"], "members_delta")
+        self.assertEqual(
+            json.loads(event["text"]),
+            {"type": "members_delta", "joined": ["alice", "bob"], "left": ["carol"]},
+        )
+
+        await self.unsubscribe()
+
+    async def test_changes_within_the_window_cancel_out(self):
+        await self.subscribe()
+
+        await presence.publish_change(1, "alice", True)
+        await presence.publish_change(1, "alice", False)
+        await presence.publish_change(1, "bob", True)
+
+        event = await asyncio.wait_for(
+            self.channel_layer.receive(self.channel_name), timeout=1
+        )
+        self.assertEqual(
+            json.loads(event["text"]),
+            {"type": "members_delta", "joined": ["bob"], "left": []},
+        )
+
+        await self.unsubscribe()
@@ -0,0 +1,56 @@
+from django.test import SimpleTestCase, override_settings
+
+from core import rate_limit
+from core.models import Room
+
+ROOM_ID = 1_000_000
+
+
+@override_settings(
+    MESSAGE_USER_RATE=60,
+    MESSAGE_USER_BURST=2,
+    MESSAGE_ROOM_RATE=60,
+    MESSAGE_ROOM_BURST=3,
+)
+class RateLimitTestCase(SimpleTestCase):
+    def setUp(self):
+        rate_limit.clear(ROOM_ID)
+        self.addCleanup(rate_limit.clear, ROOM_ID)
+
+    async def take(self, user_id, room=None):
+        return await rate_limit.take(room or Room(id=ROOM_ID), user_id)
+
+    async def test_user_bucket(self):
+        self.assertEqual(await self.take(1), 0)
+        self.assertEqual(await self.take(1), 0)
+
+        # The burst is spent, a token is refilled each second
+        retry_after = await self.take(1)
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 1)
+
+        # Other users have buckets of their own
+        self.assertEqual(await self.take(2), 0)
+
+    async def test_room_bucket(self):
+        for user_id in range(3):
+            self.assertEqual(await self.take(user_id), 0)
+
+        # The room burst is spent by all the users together
+        self.assertGreater(await self.take(3), 0)
+
+    async def test_rejected_messages_take_no_tokens(self):
+        await self.take(1)
+        await self.take(1)
+        await self.take(1)
+
+        # The room bucket still has the token of the rejected message
+        self.assertEqual(await self.take(2), 0)
+
+    async def test_room_limits(self):
+        room = Room(id=ROOM_ID, user_message_rate=1, user_message_burst=1)
+
+        self.assertEqual(await self.take(1, room), 0)
+
+        # A token is refilled each minute
+        self.assertGreater(await self.take(1, room), 1)
@@ -0,0 +1,151 @@
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from pydantic_ai.models.test import TestModel
+
+from core import resilience
+from core.models import Message, Room
+from core.resilience import AdaptiveLimiter, ModerationUnavailable, breaker
+from core.tasks import moderate_message
+from core.utils import get_moderation_client, is_safe_content
+
+User = get_user_model()
+
+
+@override_settings(MODERATION_BREAKER_THRESHOLD=2, MODERATION_BREAKER_COOLDOWN=60)
+class CircuitBreakerTestCase(SimpleTestCase):
+    def setUp(self):
+        breaker.reset()
+        self.addCleanup(breaker.reset)
+
+    async def test_breaker_opens_after_consecutive_failures(self):
+        await breaker.record_failure()
+        await breaker.record_success()
+        await breaker.record_failure()
+        self.assertTrue(await breaker.allow())
+
+        with self.assertLogs("core.resilience", "WARNING"):
+            await breaker.record_failure()
+
+        self.assertFalse(await breaker.allow())
+        self.assertGreater(breaker.retry_after(), 0)
+
+        stats = resilience.get_stats()
+        self.assertEqual(stats["state"], "open")
+        self.assertEqual(stats["failed_calls"], 3)
+        self.assertEqual(stats["short_circuited"], 1)
+
+    async def test_half_open_breaker_lets_a_single_probe_through(self):
+        with self.assertLogs("core.resilience", "WARNING"):
+            await breaker.record_failure()
+            await breaker.record_failure()
+
+        with self.settings(MODERATION_BREAKER_COOLDOWN=0):
+            self.assertTrue(await breaker.allow())
+            self.assertFalse(await breaker.allow())
+
+            # The probe succeeds
+            await breaker.record_success()
+            self.assertTrue(await breaker.allow())
+            self.assertEqual(resilience.get_stats()["state"], "closed")
+
+    def test_open_breaker_skips_the_model(self):
+        with self.assertLogs("core.resilience", "WARNING"):
+            for _ in range(2):
+                get_moderation_client().run(breaker.record_failure())
+
+        agent = get_moderation_client().agent
+
+        with agent.override(model=TestModel(custom_output_args={"is_safe": True})):
+            with self.assertRaises(ModerationUnavailable):
+                is_safe_content("Hello, World!")
+
+
+@override_settings(MODERATION_CONCURRENCY=4, MODERATION_LATENCY_TARGET=60)
+class AdaptiveLimiterTestCase(SimpleTestCase):
+    async def test_limit_is_halved_on_failure_and_grows_back(self):
+        limiter = AdaptiveLimiter()
+
+        with self.assertRaises(TimeoutError):
+            async with limiter.acquire():
+                raise TimeoutError
+
+        self.assertEqual(limiter.limit, 2)
+
+        # Grows by about one after a limit-worth of successful requests
+        for _ in range(3):
+            async with limiter.acquire():
+                pass
+
+        self.assertGreaterEqual(limiter.limit, 3)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_limit_never_exceeds_the_maximum(self):
+        limiter = AdaptiveLimiter()
+
+        for _ in range(10):
+            async with limiter.acquire():
+                pass
+
+        self.assertEqual(limiter.limit, 4)
+
+
+@patch("core.tasks.is_safe_content", side_effect=ModerationUnavailable)
+class BreakerFallbackTestCase(TestCase):
+    def setUp(self):
+        self.staff_user = User.objects.create_user(
+            username="admin", password="adminpass", is_staff=True
+        )
+        self.regular_user = User.objects.create_user(
+            username="user", password="userpass"
+        )
+        self.room = Room.objects.create(
+            name="Test Room", is_private=False, owner=self.staff_user
+        )
+
+    def moderate(self, author):
+        message = Message.objects.create(
+            content="Is the provider down?", room=self.room, author=author
+        )
+
+        with (
+            patch("core.tasks.broadcast_messages"),
+            patch("core.tasks.moderate_messages_batch.apply_async") as mock_hold,
+        ):
+            moderate_message(message.id)
+
+        message.refresh_from_db()
+        return message, mock_hold
+
+    @override_settings(MODERATION_BREAKER_FALLBACK="fail_closed")
+    def test_fail_closed(self, mock_is_safe_content):
+        message, mock_hold = self.moderate(self.staff_user)
+
+        self.assertEqual(message.status, Message.Status.REJECTED)
+        mock_hold.assert_not_called()
+
+    @override_settings(MODERATION_BREAKER_FALLBACK="fail_open_trusted")
+    def test_fail_open_trusted(self, mock_is_safe_content):
+        staff_message, _ = self.moderate(self.staff_user)
+        self.assertEqual(staff_message.status, Message.Status.APPROVED)
+
+        with self.assertLogs("core.tasks", "WARNING"):
+            regular_message, mock_hold = self.moderate(self.regular_user)
+
+        self.assertEqual(regular_message.status, Message.Status.PENDING)
+        mock_hold.assert_called_once()
+        self.assertEqual(mock_hold.call_args.args[0], ([regular_message.id],))
+
+    @override_settings(
+        MODERATION_BREAKER_FALLBACK="hold", MODERATION_BREAKER_COOLDOWN=30
+    )
+    def test_hold(self, mock_is_safe_content):
+        with self.assertLogs("core.tasks", "WARNING"):
+            message, mock_hold = self.moderate(self.staff_user)
+
+        self.assertEqual(message.status, Message.Status.PENDING)
+        mock_hold.assert_called_once()
+
+        # Moderated again after a whole cooldown at least, with jitter
+        self.assertTrue(30 <= mock_hold.call_args.kwargs["countdown"] <= 45)
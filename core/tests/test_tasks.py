@@ -1,10 +1,23 @@
+import asyncio
+import json
+import time
+from datetime import timedelta
 from unittest.mock import AsyncMock, patch
 
+from celery.exceptions import Retry
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.db import DatabaseError, close_old_connections, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 
 from core.models import Message, Room
-from core.tasks import moderate_message
+from core.tasks import (
+    moderate_message,
+    moderate_messages_async,
+    moderate_messages_batch,
+    save_verdicts,
+)
+from core.verdict_cache import verdict_cache
 
 User = get_user_model()
 
@@ -18,6 +31,9 @@ class ModerateMessageTaskTestCase(TestCase):
         settings.CELERY_TASK_EAGER_PROPAGATES = True
 
     def setUp(self):
+        verdict_cache.clear()
+        self.addCleanup(verdict_cache.clear)
+
         # Create admin user
         self.admin_user = User.objects.create_user(
             username="admin", password="adminpass", is_staff=True
@@ -56,10 +72,19 @@ class ModerateMessageTaskTestCase(TestCase):
         # Assert the message was approved
         self.assertEqual(self.message.status, Message.Status.APPROVED)
 
-        # Assert the message was sent to the channel layer
-        mock_channel_layer.return_value.group_send.assert_called_once_with(
-            f"room_{self.room.id}",
-            {"type": "chat_message", "message_id": self.message.id},
+        # Assert the message was sent to the channel layer with its payload
+        mock_channel_layer.return_value.group_send.assert_called_once()
+        group_name, event = mock_channel_layer.return_value.group_send.call_args[0]
+        self.assertEqual(group_name, f"room_{self.room.id}")
+        self.assertEqual(event["type"], "chat_message")
+
+        payload = json.loads(event["text"])
+        self.assertEqual(payload["type"], "chat_message")
+        self.assertEqual(payload["id"], self.message.id)
+        self.assertEqual(payload["content"], self.message.content)
+        self.assertEqual(
+            payload["author"],
+            {"id": self.admin_user.id, "username": self.admin_user.username},
         )
 
     @patch("core.tasks.is_safe_content", return_value=False)
@@ -75,3 +100,402 @@ class ModerateMessageTaskTestCase(TestCase):
 
         # Assert the message was rejected
         self.assertEqual(self.message.status, Message.Status.REJECTED)
+
+    @patch("channels.layers.get_channel_layer")
+    def test_moderate_message_confirms_or_retracts_optimistic_messages(
+        self, mock_channel_layer
+    ):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        self.room.optimistic_delivery = True
+        self.room.save()
+
+        for is_safe, event_type, seq in [
+            (True, "message_confirmed", 1),
+            (False, "message_retracted", None),
+        ]:
+            with self.subTest(event_type=event_type):
+                verdict_cache.clear()
+                message = Message.objects.create(
+                    content=self.message.content,
+                    room=self.room,
+                    status=Message.Status.PENDING,
+                    author=self.admin_user,
+                )
+
+                with patch("core.tasks.is_safe_content", return_value=is_safe):
+                    moderate_message(message.id)
+
+                group_name, event = (
+                    mock_channel_layer.return_value.group_send.call_args.args
+                )
+                self.assertEqual(group_name, f"room_{self.room.id}")
+                self.assertEqual(event["type"], event_type)
+                self.assertEqual(
+                    json.loads(event["text"]),
+                    {"type": event_type, "id": message.id, "seq": seq},
+                )
+
+    @patch("core.tasks.are_safe_contents", return_value=[False])
+    def test_moderate_messages_batch_skips_moderated_messages(
+        self, mock_are_safe_contents
+    ):
+        moderated_message = Message.objects.create(
+            content="Already moderated",
+            room=self.room,
+            status=Message.Status.APPROVED,
+            author=self.admin_user,
+        )
+
+        moderate_messages_batch([self.message.id, moderated_message.id])
+
+        mock_are_safe_contents.assert_called_once_with([self.message.content])
+
+        self.message.refresh_from_db()
+        moderated_message.refresh_from_db()
+        self.assertEqual(self.message.status, Message.Status.REJECTED)
+        self.assertEqual(moderated_message.status, Message.Status.APPROVED)
+
+    @patch("core.tasks.are_safe_contents", return_value=[True, False])
+    @patch("channels.layers.get_channel_layer")
+    def test_moderate_messages_batch_pulls_pending_messages(
+        self, mock_channel_layer, mock_are_safe_contents
+    ):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        other_room = Room.objects.create(name="Other Room", owner=self.admin_user)
+        other_message = Message.objects.create(
+            content="Message in another room",
+            room=other_room,
+            status=Message.Status.PENDING,
+            author=self.admin_user,
+        )
+
+        moderate_messages_batch()
+
+        # Both messages are classified in a single call
+        mock_are_safe_contents.assert_called_once_with(
+            [self.message.content, other_message.content]
+        )
+
+        self.message.refresh_from_db()
+        other_message.refresh_from_db()
+        self.assertEqual(self.message.status, Message.Status.APPROVED)
+        self.assertEqual(other_message.status, Message.Status.REJECTED)
+
+        # Only the approved message is sent to its room
+        mock_channel_layer.return_value.group_send.assert_called_once()
+        group_name, _ = mock_channel_layer.return_value.group_send.call_args[0]
+        self.assertEqual(group_name, f"room_{self.room.id}")
+
+    @patch("core.tasks.is_safe_content", return_value=False)
+    def test_moderate_message_reuses_cached_verdict(self, mock_is_safe_content):
+        moderate_message(self.message.id)
+
+        # The same content, differing only in case and spacing
+        repeated_message = Message.objects.create(
+            content="  this is a TEST   message ",
+            room=self.room,
+            status=Message.Status.PENDING,
+            author=self.admin_user,
+        )
+        moderate_message(repeated_message.id)
+
+        mock_is_safe_content.assert_called_once_with(self.message.content)
+
+        repeated_message.refresh_from_db()
+        self.assertEqual(repeated_message.status, Message.Status.REJECTED)
+        self.assertEqual(verdict_cache.get_stats()["redis_hits"], 0)
+        self.assertEqual(verdict_cache.get_stats()["local_hits"], 1)
+        self.assertEqual(verdict_cache.get_stats()["misses"], 1)
+
+    @patch("core.tasks.are_safe_contents", return_value=[True])
+    def test_moderate_messages_batch_classifies_distinct_contents(
+        self, mock_are_safe_contents
+    ):
+        repeated_message = Message.objects.create(
+            content=self.message.content,
+            room=self.room,
+            status=Message.Status.PENDING,
+            author=self.admin_user,
+        )
+
+        with patch("channels.layers.get_channel_layer") as mock_channel_layer:
+            mock_channel_layer.return_value.group_send = AsyncMock()
+            moderate_messages_batch([self.message.id, repeated_message.id])
+
+        mock_are_safe_contents.assert_called_once_with([self.message.content])
+
+        repeated_message.refresh_from_db()
+        self.assertEqual(repeated_message.status, Message.Status.APPROVED)
+
+    @patch("core.tasks.are_safe_contents")
+    @patch("channels.layers.get_channel_layer")
+    def test_approved_messages_are_numbered_in_their_rooms(
+        self, mock_channel_layer, mock_are_safe_contents
+    ):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        mock_are_safe_contents.side_effect = lambda contents: [
+            content != "unsafe" for content in contents
+        ]
+        other_room = Room.objects.create(name="Other Room", owner=self.admin_user)
+        messages = [self.message] + [
+            Message.objects.create(content=content, room=room, author=self.admin_user)
+            for content, room in [
+                ("unsafe", self.room),
+                ("Second", self.room),
+                ("First in other room", other_room),
+            ]
+        ]
+
+        moderate_messages_batch()
+
+        for message in messages:
+            message.refresh_from_db()
+
+        self.assertEqual([message.seq for message in messages], [1, None, 2, 1])
+
+        # Numbering goes on from the last approved message
+        message = Message.objects.create(
+            content="Third", room=self.room, author=self.admin_user
+        )
+        moderate_messages_batch([message.id])
+
+        message.refresh_from_db()
+        self.room.refresh_from_db()
+        self.assertEqual(message.seq, 3)
+        self.assertEqual(self.room.last_seq, 3)
+
+    @patch("core.tasks.are_safe_contents")
+    @patch("channels.layers.get_channel_layer")
+    def test_moderate_messages_batch_classifies_outside_transactions(
+        self, mock_channel_layer, mock_are_safe_contents
+    ):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        atomic_blocks = len(connection.atomic_blocks)
+
+        def are_safe_contents(contents):
+            # The message is claimed, without any transaction left open
+            self.assertEqual(len(connection.atomic_blocks), atomic_blocks)
+            self.assertIsNotNone(Message.objects.get(id=self.message.id).claimed_until)
+            return [True]
+
+        mock_are_safe_contents.side_effect = are_safe_contents
+        moderate_messages_batch([self.message.id])
+
+        mock_are_safe_contents.assert_called_once()
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, Message.Status.APPROVED)
+        self.assertIsNone(self.message.claimed_until)
+
+    @patch("core.tasks.are_safe_contents", return_value=[True])
+    def test_moderate_messages_batch_skips_claimed_messages(
+        self, mock_are_safe_contents
+    ):
+        Message.objects.filter(id=self.message.id).update(
+            claimed_until=timezone.now() + timedelta(minutes=1)
+        )
+
+        moderate_messages_batch([self.message.id])
+
+        mock_are_safe_contents.assert_not_called()
+
+        # Expired claims are taken over
+        Message.objects.filter(id=self.message.id).update(
+            claimed_until=timezone.now() - timedelta(minutes=1)
+        )
+
+        with patch("channels.layers.get_channel_layer") as mock_channel_layer:
+            mock_channel_layer.return_value.group_send = AsyncMock()
+            moderate_messages_batch([self.message.id])
+
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, Message.Status.APPROVED)
+
+    @patch("core.tasks.moderate_messages_batch.apply_async")
+    @patch("core.tasks.are_safe_contents", side_effect=ValueError)
+    def test_failed_batch_is_retried(self, mock_are_safe_contents, mock_apply_async):
+        with self.assertLogs("core.tasks", "ERROR"):
+            moderate_messages_batch([self.message.id])
+
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, Message.Status.PENDING)
+        self.assertIsNone(self.message.claimed_until)
+
+        # Rescheduled with backoff, instead of retried by Celery at once
+        args, kwargs = mock_apply_async.call_args
+        self.assertEqual(args, (([self.message.id],), {"retries": 1}))
+        self.assertIn("countdown", kwargs)
+
+    def test_only_database_errors_are_retried_by_celery(self):
+        for error, retried in [(ValueError, False), (DatabaseError, True)]:
+            with (
+                self.subTest(error=error),
+                patch("core.tasks.claim_messages", side_effect=error),
+                patch.object(
+                    moderate_messages_batch, "retry", side_effect=Retry
+                ) as mock_retry,
+                self.assertRaises(Retry if retried else error),
+            ):
+                moderate_messages_batch([self.message.id])
+
+            self.assertEqual(mock_retry.called, retried)
+
+
+@override_settings(MODERATION_CONCURRENCY=2, MODERATION_ALLOWLIST=["ok"])
+class ModerateMessagesAsyncTaskTestCase(TransactionTestCase):
+    def setUp(self):
+        verdict_cache.clear()
+        self.addCleanup(verdict_cache.clear)
+
+        self.admin_user = User.objects.create_user(
+            username="admin", password="adminpass", is_staff=True
+        )
+        self.room = Room.objects.create(
+            name="Test Room", is_private=False, owner=self.admin_user
+        )
+
+    def create_message(self, content):
+        return Message.objects.create(
+            content=content,
+            room=self.room,
+            status=Message.Status.PENDING,
+            author=self.admin_user,
+        )
+
+    @patch("channels.layers.get_channel_layer")
+    def test_requests_run_concurrently_up_to_the_limit(self, mock_channel_layer):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        in_flight = 0
+        max_in_flight = 0
+
+        async def fake_ais_safe_content(content):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return content != "unsafe"
+
+        messages = [
+            self.create_message("first"),
+            self.create_message("unsafe"),
+            self.create_message("third"),
+            self.create_message("first"),
+            self.create_message("ok"),
+        ]
+
+        with patch("core.tasks.ais_safe_content", side_effect=fake_ais_safe_content):
+            moderate_messages_async([message.id for message in messages])
+
+        self.assertEqual(max_in_flight, 2)
+        self.assertEqual(
+            [Message.objects.get(id=message.id).status for message in messages],
+            [
+                Message.Status.APPROVED,
+                Message.Status.REJECTED,
+                Message.Status.APPROVED,
+                Message.Status.APPROVED,
+                Message.Status.APPROVED,
+            ],
+        )
+        self.assertEqual(mock_channel_layer.return_value.group_send.call_count, 4)
+
+    @override_settings(MODERATION_ASYNC_ENABLED=True, MODERATION_RETRY_BACKOFF=2)
+    @patch("core.tasks.moderate_messages_async.apply_async")
+    @patch("channels.layers.get_channel_layer")
+    def test_failed_requests_are_retried(self, mock_channel_layer, mock_apply_async):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        failed_message = self.create_message("failed")
+        message = self.create_message("safe")
+
+        async def fake_ais_safe_content(content):
+            if content == "failed":
+                raise TimeoutError
+
+            return True
+
+        with patch("core.tasks.ais_safe_content", side_effect=fake_ais_safe_content):
+            moderate_messages_async([failed_message.id, message.id])
+
+        failed_message.refresh_from_db()
+        message.refresh_from_db()
+        self.assertEqual(failed_message.status, Message.Status.PENDING)
+        self.assertIsNone(failed_message.claimed_until)
+        self.assertEqual(message.status, Message.Status.APPROVED)
+
+        # Retried after the backoff, with jitter
+        args, kwargs = mock_apply_async.call_args
+        self.assertEqual(args, (([failed_message.id],), {"retries": 1}))
+        self.assertTrue(1 <= kwargs["countdown"] <= 2)
+
+        with patch("core.tasks.ais_safe_content", return_value=True):
+            moderate_messages_async(*args[0], **args[1])
+
+        failed_message.refresh_from_db()
+        self.assertEqual(failed_message.status, Message.Status.APPROVED)
+
+    @override_settings(MODERATION_ASYNC_ENABLED=True, MODERATION_MAX_RETRIES=2)
+    @patch("core.tasks.moderate_messages_async.apply_async")
+    def test_failed_requests_are_retried_up_to_the_limit(self, mock_apply_async):
+        message = self.create_message("failed")
+
+        with (
+            patch("core.tasks.ais_safe_content", side_effect=TimeoutError),
+            self.assertLogs("core.tasks", "ERROR") as logs,
+        ):
+            moderate_messages_async([message.id], retries=2)
+
+        mock_apply_async.assert_not_called()
+        self.assertIn("Gave up moderating 1 messages after 2 retries.", logs.output[-1])
+
+    @patch("core.tasks.ais_safe_content", return_value=True)
+    @patch("channels.layers.get_channel_layer")
+    def test_traces_are_marked(self, mock_channel_layer, mock_ais_safe_content):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        messages = [self.create_message("ok"), self.create_message("Is it fast?")]
+        traces = [[["received", time.time()]] for _ in messages]
+
+        moderate_messages_async([message.id for message in messages], traces=traces)
+
+        # Both the locally decided and the classified messages are traced
+        for trace in traces:
+            self.assertEqual(
+                [stage for stage, _ in trace],
+                ["received", "dequeued", "classified", "updated", "sent"],
+            )
+
+    @patch("channels.layers.get_channel_layer")
+    def test_verdicts_are_saved_at_once(self, mock_channel_layer):
+        mock_channel_layer.return_value.group_send = AsyncMock()
+        messages = [self.create_message(f"Message {i}") for i in range(3)]
+
+        with (
+            patch("core.tasks.ais_safe_content", return_value=True),
+            patch("core.tasks.save_verdicts", wraps=save_verdicts) as mock_save,
+            patch(
+                "channels.db.close_old_connections", wraps=close_old_connections
+            ) as mock_close,
+        ):
+            moderate_messages_async([message.id for message in messages])
+
+        mock_save.assert_called_once()
+        # Before and after each call in the ORM thread
+        self.assertEqual(mock_close.call_count, 4)
+
+        for message in messages:
+            message.refresh_from_db()
+            self.assertEqual(message.status, Message.Status.APPROVED)
+            self.assertIsNone(message.claimed_until)
+
+    def test_claimed_messages_are_skipped(self):
+        message = self.create_message("claimed")
+        Message.objects.filter(id=message.id).update(
+            claimed_until=timezone.now() + timedelta(minutes=1)
+        )
+
+        with patch("core.tasks.ais_safe_content") as mock_ais_safe_content:
+            moderate_messages_async([message.id])
+            moderate_messages_async()
+
+        mock_ais_safe_content.assert_not_called()
+        message.refresh_from_db()
+        self.assertEqual(message.status, Message.Status.PENDING)
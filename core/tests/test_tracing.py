@@ -0,0 +1,166 @@
+from unittest.mock import patch
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+
+from config.asgi import application
+from core import presence, rate_limit, tracing
+from core.models import Room, RoomMember
+from core.tasks import moderate_message, moderate_messages_batch
+from core.verdict_cache import verdict_cache
+
+User = get_user_model()
+
+
+class TracingTestCase(SimpleTestCase):
+    def setUp(self):
+        tracing.clear()
+        self.addCleanup(tracing.clear)
+
+    def test_traces_are_sampled(self):
+        with self.settings(TRACING_SAMPLE_RATE=0):
+            self.assertIsNone(tracing.start())
+
+        with self.settings(TRACING_SAMPLE_RATE=1):
+            self.assertEqual(tracing.start()[0][0], "received")
+
+    def test_untraced_messages_are_ignored(self):
+        tracing.mark(None, "saved")
+        self.assertEqual(tracing.histograms.snapshot(), {})
+
+    def test_stages_are_recorded_and_flushed(self):
+        with self.settings(TRACING_SAMPLE_RATE=1):
+            trace = tracing.start()
+
+        trace[0][1] -= 0.15
+        tracing.mark(trace, "saved")
+        tracing.mark(trace, "delivered")
+
+        self.assertEqual(
+            [stage for stage, _ in trace], ["received", "saved", "delivered"]
+        )
+
+        tracing.flush(force=True)
+        stats = tracing.get_stats()
+        self.assertEqual(stats["saved"]["count"], 1)
+        self.assertEqual(stats["saved"]["p50"], 200)
+        self.assertEqual(stats["delivered"]["p99"], 1)
+        self.assertEqual(stats["total"]["p95"], 200)
+
+    def test_percentile(self):
+        # 90 latencies up to 1ms, 9 up to 10ms and 1 up to 100ms
+        counts = [90, 0, 0, 9, 0, 0, 1] + [0] * 9
+
+        self.assertEqual(tracing.percentile(counts, 0.5), 1)
+        self.assertEqual(tracing.percentile(counts, 0.95), 10)
+        self.assertEqual(tracing.percentile(counts, 0.99), 10)
+        self.assertEqual(tracing.percentile(counts, 1), 100)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    PRESENCE_COALESCE_WINDOW=0,
+    TRACING_SAMPLE_RATE=1,
+)
+class MessageTracingTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="password")
+        self.room = Room.objects.create(name="Test Room", owner=self.user)
+        RoomMember.objects.create(user=self.user, room=self.room)
+
+        presence.clear(self.room.id)
+        self.addCleanup(presence.clear, self.room.id)
+        rate_limit.clear(self.room.id)
+        self.addCleanup(rate_limit.clear, self.room.id)
+        tracing.clear()
+        self.addCleanup(tracing.clear)
+        verdict_cache.clear()
+        self.addCleanup(verdict_cache.clear)
+
+    @patch("core.tasks.is_safe_content", return_value=True)
+    @patch("core.consumers.moderate_message.delay")
+    async def test_message_is_traced_up_to_delivery(
+        self, mock_moderate_message, mock_is_safe_content
+    ):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.user
+
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        # Discards the online members sent on connection
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "Is it fast?"})
+        await communicator.receive_nothing()
+
+        # Runs the moderation task with the arguments it was queued with
+        args, kwargs = mock_moderate_message.call_args
+        await database_sync_to_async(moderate_message)(*args, **kwargs)
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["content"], "Is it fast?")
+
+        self.assertEqual(
+            set(tracing.histograms.snapshot()),
+            {
+                "saved",
+                "dequeued",
+                "classified",
+                "updated",
+                "sent",
+                "delivered",
+                "total",
+            },
+        )
+
+        await communicator.disconnect()
+
+    @override_settings(
+        MESSAGE_WRITE_BUFFER_ENABLED=True,
+        MESSAGE_WRITE_BUFFER_SIZE=1,
+        MODERATION_FAIR_QUEUE_ENABLED=False,
+    )
+    @patch("core.tasks.are_safe_contents", return_value=[True])
+    @patch("core.batching.moderate_messages_batch.delay")
+    async def test_buffered_message_is_traced_up_to_delivery(
+        self, mock_moderate_batch, mock_are_safe_contents
+    ):
+        communicator = WebsocketCommunicator(application, f"/ws/rooms/{self.room.id}/")
+        communicator.scope["user"] = self.user
+
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        # Discards the online members sent on connection
+        await communicator.receive_json_from()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "Is it fast?"})
+        await communicator.receive_nothing()
+
+        # Runs the batch task with the arguments it was queued with
+        args, kwargs = mock_moderate_batch.call_args
+        self.assertEqual(len(kwargs["traces"]), 1)
+        await database_sync_to_async(moderate_messages_batch)(*args, **kwargs)
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["content"], "Is it fast?")
+
+        self.assertEqual(
+            set(tracing.histograms.snapshot()),
+            {
+                "saved",
+                "dequeued",
+                "classified",
+                "updated",
+                "sent",
+                "delivered",
+                "total",
+            },
+        )
+
+        await communicator.disconnect()
@@ -0,0 +1,65 @@
+import asyncio
+import json
+
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, override_settings
+
+from core import typing_indicators
+
+User = get_user_model()
+
+ROOM_ID = 1_000_000
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    TYPING_COALESCE_WINDOW=100,
+)
+class TypingIndicatorsTestCase(SimpleTestCase):
+    def setUp(self):
+        typing_indicators.clear(ROOM_ID)
+        self.addCleanup(typing_indicators.clear, ROOM_ID)
+        self.alice = User(id=1, username="alice")
+        self.bob = User(id=2, username="bob")
+
+    async def subscribe(self):
+        self.channel_layer = get_channel_layer()
+        self.channel_name = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(f"room_{ROOM_ID}", self.channel_name)
+        self.addCleanup(self.channel_layer.flush)
+
+    async def receive(self):
+        return await asyncio.wait_for(
+            self.channel_layer.receive(self.channel_name), timeout=1
+        )
+
+    async def test_users_typing_are_sent_in_a_single_frame(self):
+        await self.subscribe()
+
+        self.assertTrue(await typing_indicators.publish(ROOM_ID, self.bob))
+        self.assertTrue(await typing_indicators.publish(ROOM_ID, self.alice))
+
+        event = await self.receive()
+        self.assertEqual(event["type"], "typing")
+        self.assertEqual(event["room_id"], ROOM_ID)
+        self.assertEqual(
+            json.loads(event["text"]), {"type": "typing", "users": ["alice", "bob"]}
+        )
+
+    @override_settings(TYPING_COALESCE_WINDOW=0)
+    async def test_users_are_throttled(self):
+        await self.subscribe()
+
+        self.assertTrue(await typing_indicators.publish(ROOM_ID, self.alice))
+        self.assertFalse(await typing_indicators.publish(ROOM_ID, self.alice))
+        self.assertTrue(await typing_indicators.publish(ROOM_ID, self.bob))
+
+        self.assertEqual(
+            [json.loads((await self.receive())["text"])["users"] for _ in range(2)],
+            [["alice"], ["bob"]],
+        )
+
+        # The throttle is per room
+        self.assertTrue(await typing_indicators.publish(ROOM_ID + 1, self.alice))
+        typing_indicators.clear(ROOM_ID + 1)
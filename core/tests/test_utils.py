@@ -0,0 +1,46 @@
+from django.test import SimpleTestCase
+from pydantic_ai.models.test import TestModel
+
+from core.resilience import breaker
+from core.utils import are_safe_contents, get_moderation_client, is_safe_content
+
+
+class ModerationClientTestCase(SimpleTestCase):
+    def setUp(self):
+        breaker.reset()
+        self.addCleanup(breaker.reset)
+
+    def test_client_is_built_once(self):
+        self.assertIs(get_moderation_client(), get_moderation_client())
+
+    def test_is_safe_content(self):
+        agent = get_moderation_client().agent
+
+        with agent.override(model=TestModel(custom_output_args={"is_safe": False})):
+            self.assertFalse(is_safe_content("Some unsafe content"))
+            self.assertFalse(is_safe_content("More unsafe content"))
+
+        with agent.override(model=TestModel(custom_output_args={"is_safe": True})):
+            self.assertTrue(is_safe_content("Hello, World!"))
+
+    def test_are_safe_contents(self):
+        agent = get_moderation_client().batch_agent
+        verdicts = [{"is_safe": True}, {"is_safe": False}]
+
+        with agent.override(model=TestModel(custom_output_args=verdicts)):
+            self.assertEqual(are_safe_contents(["Hello", "Unsafe"]), [True, False])
+
+    def test_are_safe_contents_falls_back_to_one_by_one(self):
+        client = get_moderation_client()
+
+        # The model keeps returning fewer verdicts than contents
+        with (
+            client.batch_agent.override(
+                model=TestModel(custom_output_args=[{"is_safe": False}])
+            ),
+            client.agent.override(
+                model=TestModel(custom_output_args={"is_safe": True})
+            ),
+            self.assertLogs("core.utils", "WARNING"),
+        ):
+            self.assertEqual(are_safe_contents(["Hello", "Hi"]), [True, True])
@@ -1,9 +1,15 @@
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
+from django.db import connection
 from django.test import TestCase
 from rest_framework import status
 from rest_framework.test import APIClient
 
+from core import history, presence
 from core.models import Message, Room
+from core.views import MessageViewSet
 
 User = get_user_model()
 
@@ -32,6 +38,10 @@ class RoomViewSetTestCase(TestCase):
         self.private_room.members.add(self.admin_user)
         self.private_room.members.add(self.regular_user)
 
+        for room in [self.public_room, self.private_room]:
+            history.clear(room.id)
+            self.addCleanup(history.clear, room.id)
+
         # Create messages
         self.message1 = Message.objects.create(
             content="Hello from admin",
@@ -78,7 +88,7 @@ class RoomViewSetTestCase(TestCase):
         self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
         response = self.client.get("/api/rooms/")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        room_names = [room["name"] for room in response.data]
+        room_names = [room["name"] for room in response.data["results"]]
         self.assertIn("Public Room", room_names)
         self.assertIn("Private Room", room_names)
 
@@ -96,18 +106,188 @@ class RoomViewSetTestCase(TestCase):
         self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.admin_token}")
         response = self.client.get("/api/rooms/")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        room_names = [room["name"] for room in response.data]
+        room_names = [room["name"] for room in response.data["results"]]
         self.assertIn("Public Room", room_names)
         self.assertIn("Private Room", room_names)
 
+    def test_regular_user_cannot_view_other_private_rooms(self):
+        other_room = Room.objects.create(
+            name="Other Room", is_private=True, owner=self.admin_user
+        )
+        other_room.members.add(self.admin_user)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+        response = self.client.get("/api/rooms/")
+        room_names = [room["name"] for room in response.data["results"]]
+        self.assertEqual(sorted(room_names), ["Private Room", "Public Room"])
+
+    def test_rooms_are_listed_with_counts_and_last_message(self):
+        presence.clear(self.private_room.id)
+        self.addCleanup(presence.clear, self.private_room.id)
+        async_to_sync(presence.join)(self.private_room.id, "tab-1", "admin")
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+
+        # The user is authenticated with a query, the rooms and their annotations
+        # are fetched with another
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/rooms/")
+
+        rooms = {room["name"]: room for room in response.data["results"]}
+        self.assertEqual(rooms["Private Room"]["member_count"], 2)
+        self.assertEqual(rooms["Private Room"]["online_count"], 1)
+        self.assertEqual(
+            rooms["Private Room"]["last_message"]["content"], "Hello from user"
+        )
+        self.assertEqual(rooms["Private Room"]["last_message"]["author"], "user")
+        self.assertEqual(rooms["Public Room"]["member_count"], 1)
+        self.assertIsNone(rooms["Public Room"]["last_message"])
+
+    def test_last_message_is_only_listed_to_members(self):
+        Message.objects.create(
+            content="Hello from admin",
+            author=self.admin_user,
+            room=self.public_room,
+            status=Message.Status.APPROVED,
+        )
+
+        # The user can't list the messages of the public room they haven't joined
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+        response = self.client.get("/api/rooms/")
+        rooms = {room["name"]: room for room in response.data["results"]}
+        self.assertIsNone(rooms["Public Room"]["last_message"])
+
+        response = self.client.get(f"/api/rooms/{self.public_room.id}/")
+        self.assertIsNone(response.data["last_message"])
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.admin_token}")
+        response = self.client.get(f"/api/rooms/{self.public_room.id}/")
+        self.assertEqual(response.data["last_message"]["content"], "Hello from admin")
+
+    def test_user_can_view_online_members(self):
+        presence.clear(self.private_room.id)
+        self.addCleanup(presence.clear, self.private_room.id)
+        async_to_sync(presence.join)(self.private_room.id, "tab-1", "admin")
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+        response = self.client.get(f"/api/rooms/{self.private_room.id}/online-members/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["members"], ["admin"])
+
+    def test_non_member_cannot_view_presence(self):
+        presence.clear(self.public_room.id)
+        self.addCleanup(presence.clear, self.public_room.id)
+        async_to_sync(presence.join)(self.public_room.id, "tab-1", "admin")
+
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+        response = self.client.get(f"/api/rooms/{self.public_room.id}/online-members/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        response = self.client.get(f"/api/rooms/{self.public_room.id}/")
+        self.assertIsNone(response.data["online_count"])
+
+        response = self.client.get("/api/rooms/")
+        rooms = {room["name"]: room for room in response.data["results"]}
+        self.assertIsNone(rooms["Public Room"]["online_count"])
+
     def test_room_member_can_list_messages(self):
         self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
         response = self.client.get(f"/api/rooms/{self.private_room.id}/messages/")
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        message_contents = [message["content"] for message in response.data]
+        message_contents = [message["content"] for message in response.data["results"]]
         self.assertIn("Hello from user", message_contents)
         self.assertIn("Hello from admin", message_contents)
 
+    def test_messages_are_paginated_by_cursor(self):
+        messages = [self.message1, self.message2] + [
+            Message.objects.create(
+                content=f"Message {i}",
+                author=self.admin_user,
+                room=self.private_room,
+                status=Message.Status.APPROVED,
+            )
+            for i in range(3)
+        ]
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+
+        # The latest messages, in chronological order
+        response = self.client.get(
+            f"/api/rooms/{self.private_room.id}/messages/", {"page_size": 2}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]],
+            [messages[3].id, messages[4].id],
+        )
+        self.assertIsNone(response.data["next"])
+
+        # Older messages
+        response = self.client.get(response.data["previous"])
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]],
+            [messages[1].id, messages[2].id],
+        )
+        response = self.client.get(response.data["previous"])
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]],
+            [messages[0].id],
+        )
+        self.assertIsNone(response.data["previous"])
+
+        # Catches up from the oldest message
+        response = self.client.get(response.data["next"])
+        self.assertEqual(
+            [message["id"] for message in response.data["results"]],
+            [messages[1].id, messages[2].id],
+        )
+        self.assertIsNotNone(response.data["next"])
+
+    def test_invalid_cursor(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+        response = self.client.get(
+            f"/api/rooms/{self.private_room.id}/messages/", {"before": "invalid"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_pending_messages_are_listed_only_with_optimistic_delivery(self):
+        Message.objects.create(
+            content="Pending message",
+            author=self.regular_user,
+            room=self.private_room,
+            status=Message.Status.PENDING,
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+
+        for optimistic_delivery in [False, True]:
+            with self.subTest(optimistic_delivery=optimistic_delivery):
+                self.private_room.optimistic_delivery = optimistic_delivery
+                self.private_room.save()
+
+                response = self.client.get(
+                    f"/api/rooms/{self.private_room.id}/messages/"
+                )
+                message_contents = [
+                    message["content"] for message in response.data["results"]
+                ]
+                self.assertEqual(
+                    "Pending message" in message_contents, optimistic_delivery
+                )
+
+    @skipUnless(connection.vendor == "sqlite", "Reads the SQLite query plan")
+    def test_pages_are_read_in_index_order(self):
+        for optimistic_delivery in [False, True]:
+            with self.subTest(optimistic_delivery=optimistic_delivery):
+                self.private_room.optimistic_delivery = optimistic_delivery
+                self.private_room.save()
+
+                view = MessageViewSet(kwargs={"room_id": self.private_room.id})
+                queryset = view.get_queryset().order_by("-created_at", "-id")
+                plan = queryset[:20].explain()
+
+                self.assertIn("USING INDEX", plan)
+                self.assertNotIn("TEMP B-TREE", plan)
+                self.assertNotIn("core_room", str(queryset.query))
+
     def test_non_member_cannot_list_messages(self):
         User.objects.create_user(username="nonmember", password="nonmemberpass")
         non_member_response = self.client.post(
@@ -119,3 +299,14 @@ class RoomViewSetTestCase(TestCase):
         self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {non_member_token}")
         response = self.client.get(f"/api/rooms/{self.private_room.id}/messages/")
         self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_admin_can_view_metrics(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.admin_token}")
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("verdict_cache", response.data)
+
+    def test_regular_user_cannot_view_metrics(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.user_token}")
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
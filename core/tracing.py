@@ -0,0 +1,189 @@
+"""
+Sampled latency tracing of the messages, from the socket receiving them to the
+sockets they are delivered to.
+
+A trace is a list of [stage, timestamp] pairs, started for TRACING_SAMPLE_RATE of
+the received messages and carried along with the message: in the moderation task
+arguments and in the channel layer event. Each stage marked on the trace records
+the time since the previous one in a latency histogram of the process, so the
+histograms show where the time goes (messages moderated through the fair
+moderation queue, which doesn't carry traces, aren't traced):
+
+- saved: the message insert, in the consumer;
+- dequeued: the wait in the Celery queue;
+- classified: the moderation (prefilters, cache or model);
+- updated: the status update;
+- sent: the frame encoding, up to the group send;
+- delivered: the channel layer fan-out, up to each socket;
+- total: from receive to each socket.
+
+The histograms are merged into Redis every TRACING_FLUSH_INTERVAL seconds, where
+the metrics endpoint reads them from.
+"""
+
+import bisect
+import random
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+
+from core.redis_client import get_async_redis, get_redis
+
+HISTOGRAMS_KEY = "tracing:histograms"
+
+# Upper bounds of the histogram buckets, in milliseconds. The last bucket has no
+# upper bound.
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000]
+
+
+def start(stage="received"):
+    """
+    Returns a new trace for TRACING_SAMPLE_RATE of the calls, None otherwise.
+    """
+    if random.random() >= settings.TRACING_SAMPLE_RATE:
+        return None
+
+    return [[stage, time.time()]]
+
+
+def mark(trace, stage):
+    """
+    Marks the stage as reached and records the time since the previous stage. Does
+    nothing if the message isn't traced.
+    """
+    if not trace:
+        return
+
+    now = time.time()
+    histograms.add(stage, now - trace[-1][1])
+    trace.append([stage, now])
+
+    if stage == "delivered":
+        histograms.add("total", now - trace[0][1])
+
+
+class LatencyHistograms:
+    """
+    Latency histograms of the process, one per stage, counting the latencies in
+    BUCKETS. The counts recorded since the last flush are added to the ones of
+    all the processes, in Redis.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+        self.pending = defaultdict(int)
+        self.flushed_at = time.monotonic()
+
+    def add(self, stage, seconds):
+        bucket = bisect.bisect_left(BUCKETS, seconds * 1000)
+
+        with self.lock:
+            self.counts[stage][bucket] += 1
+            self.pending[f"{stage}:{bucket}"] += 1
+
+    def take_pending(self, force=False):
+        """
+        Returns the counts to flush and resets them, if the flush is due.
+        """
+        with self.lock:
+            if not self.pending or (
+                not force
+                and time.monotonic() - self.flushed_at < settings.TRACING_FLUSH_INTERVAL
+            ):
+                return {}
+
+            pending, self.pending = self.pending, defaultdict(int)
+            self.flushed_at = time.monotonic()
+            return pending
+
+    def snapshot(self):
+        with self.lock:
+            return {stage: list(counts) for stage, counts in self.counts.items()}
+
+
+histograms = LatencyHistograms()
+
+
+def flush(force=False):
+    """
+    Adds the counts recorded by the process to the shared histograms, if the
+    flush is due or forced.
+    """
+    pending = histograms.take_pending(force)
+
+    if pending:
+        with get_redis().pipeline(transaction=False) as pipe:
+            for field, count in pending.items():
+                pipe.hincrby(HISTOGRAMS_KEY, field, count)
+            pipe.execute()
+
+
+async def aflush(force=False):
+    """
+    Adds the counts recorded by the process to the shared histograms, if the
+    flush is due or forced.
+    """
+    pending = histograms.take_pending(force)
+
+    if pending:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for field, count in pending.items():
+                pipe.hincrby(HISTOGRAMS_KEY, field, count)
+            await pipe.execute()
+
+
+def percentile(counts, fraction):
+    """
+    Returns the upper bound of the bucket holding the percentile, in milliseconds,
+    or None if it is in the last bucket.
+    """
+    target = fraction * sum(counts)
+    cumulative = 0
+
+    for bucket, count in enumerate(counts):
+        cumulative += count
+
+        if count and cumulative >= target:
+            return BUCKETS[bucket] if bucket < len(BUCKETS) else None
+
+    return None
+
+
+def summarize(counts_by_stage):
+    return {
+        stage: {
+            "count": sum(counts),
+            "p50": percentile(counts, 0.5),
+            "p95": percentile(counts, 0.95),
+            "p99": percentile(counts, 0.99),
+        }
+        for stage, counts in counts_by_stage.items()
+    }
+
+
+def get_stats():
+    """
+    Returns the count and percentiles (p50, p95 and p99, in milliseconds) of each
+    stage, for all the processes.
+    """
+    counts_by_stage = defaultdict(lambda: [0] * (len(BUCKETS) + 1))
+
+    for field, count in get_redis().hgetall(HISTOGRAMS_KEY).items():
+        stage, bucket = field.rsplit(":", 1)
+        counts_by_stage[stage][int(bucket)] = int(count)
+
+    return summarize(counts_by_stage)
+
+
+def clear():
+    """
+    Removes the histograms of the process and the shared ones.
+    """
+    get_redis().delete(HISTOGRAMS_KEY)
+
+    with histograms.lock:
+        histograms.counts.clear()
+        histograms.pending.clear()
@@ -0,0 +1,76 @@
+"""
+Typing indicators of the rooms, sent through the channel layer only: they are
+never saved nor moderated.
+
+Sockets send a typing frame while their user types. Each user is throttled to a
+typing event per room every TYPING_THROTTLE seconds, across the nodes, and the
+events of each room are coalesced within TYPING_COALESCE_WINDOW into a single
+typing frame with the users typing. Clients show a user as typing until
+TYPING_THROTTLE seconds after their last event or until their message arrives.
+"""
+
+import json
+
+from django.conf import settings
+
+from core.coalescing import RoomCoalescer
+from core.loop_local import LoopLocal
+from core.redis_client import get_async_redis, get_redis
+
+
+def throttle_key(room_id, user_id):
+    return f"typing:room:{room_id}:user:{user_id}"
+
+
+def encode_typing(usernames):
+    return json.dumps({"type": "typing", "users": sorted(usernames)})
+
+
+class TypingCoalescer(RoomCoalescer):
+    """
+    Buffers the users typing in each room and sends them to the room in a single
+    typing frame once the coalesce window is over.
+    """
+
+    event_type = "typing"
+    window_setting = "TYPING_COALESCE_WINDOW"
+
+    def merge(self, usernames, username):
+        return (usernames or set()) | {username}
+
+    def encode(self, usernames):
+        return encode_typing(usernames)
+
+
+_coalescers = LoopLocal(TypingCoalescer)
+
+
+def get_coalescer():
+    """
+    Returns the typing coalescer of the running event loop.
+    """
+    return _coalescers.get()
+
+
+async def publish(room_id, user):
+    """
+    Queues the user typing in the room to be sent to it, unless they already did
+    within TYPING_THROTTLE seconds. Returns True if queued.
+    """
+    throttled = not await get_async_redis().set(
+        throttle_key(room_id, user.id), 1, nx=True, ex=settings.TYPING_THROTTLE
+    )
+
+    if throttled:
+        return False
+
+    await get_coalescer().add(room_id, user.username)
+    return True
+
+
+def clear(room_id):
+    redis = get_redis()
+    keys = list(redis.scan_iter(match=throttle_key(room_id, "*"), count=1000))
+
+    if keys:
+        redis.delete(*keys)
@@ -1,26 +1,183 @@
+import asyncio
+import json
+import logging
+import threading
+import unicodedata
+
+import httpx
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import close_old_connections
 from pydantic import BaseModel
-from pydantic_ai import Agent
+from pydantic_ai import Agent, ModelRetry, RunContext
+from pydantic_ai.exceptions import UnexpectedModelBehavior
 from pydantic_ai.models.gemini import GeminiModel
 from pydantic_ai.providers.google_gla import GoogleGLAProvider
 
-model = GeminiModel(
-    settings.AI_MODEL, provider=GoogleGLAProvider(api_key=settings.AI_API_KEY)
+from core.resilience import AdaptiveLimiter, ModerationUnavailable, breaker
+
+logger = logging.getLogger(__name__)
+
+MODERATION_SYSTEM_PROMPT = "You are a content safety model. Your task is to determine if the content is safe or not."
+
+BATCH_MODERATION_SYSTEM_PROMPT = (
+    "You are a content safety model. You will receive a JSON list of contents. "
+    "Your task is to determine if each content is safe or not, returning one "
+    "verdict per content, in the same order."
 )
 
 
+def normalize_content(content):
+    """
+    Returns the content in NFKC form, casefolded and with its whitespace collapsed,
+    so equivalent contents compare equal.
+    """
+    return " ".join(unicodedata.normalize("NFKC", content).casefold().split())
+
+
+# Releases the connections of the thread running the async ORM queries, as
+# database_sync_to_async does around each call: back to the pool, if enabled, or
+# closed if they are obsolete or broken.
+release_connections = sync_to_async(close_old_connections)
+
+
 class ContentSafetyResponse(BaseModel):
     is_safe: bool
 
 
+class ModerationClient:
+    """
+    Content safety client backed by the AI model.
+
+    The agent, its system prompt and output schema are built once, and its HTTP
+    connection pool to the model provider is kept open between calls. As the pool
+    is bound to an event loop, the client owns one: synchronous calls and
+    coroutines passed to `run` are executed on it.
+
+    Requests go through the circuit breaker and the adaptive concurrency limiter,
+    see core.resilience.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.http_client = httpx.AsyncClient(timeout=settings.AI_REQUEST_TIMEOUT)
+        self.model = GeminiModel(
+            settings.AI_MODEL,
+            provider=GoogleGLAProvider(
+                api_key=settings.AI_API_KEY, http_client=self.http_client
+            ),
+        )
+        self.agent = Agent(
+            self.model,
+            output_type=ContentSafetyResponse,
+            system_prompt=MODERATION_SYSTEM_PROMPT,
+        )
+        self.batch_agent = Agent(
+            self.model,
+            output_type=list[ContentSafetyResponse],
+            system_prompt=BATCH_MODERATION_SYSTEM_PROMPT,
+            deps_type=int,
+            retries=2,
+        )
+        self.batch_agent.output_validator(self.validate_batch_output)
+        self.limiter = AdaptiveLimiter()
+
+    @staticmethod
+    def validate_batch_output(ctx: RunContext[int], output):
+        if len(output) != ctx.deps:
+            raise ModelRetry(f"Return exactly {ctx.deps} verdicts, one per content.")
+
+        return output
+
+    def run(self, coroutine):
+        """
+        Runs the coroutine on the client's event loop and returns its result.
+        """
+        return self.loop.run_until_complete(coroutine)
+
+    async def run_agent(self, agent, *args, **kwargs):
+        """
+        Runs the agent, unless the circuit breaker is open, within the concurrency
+        limit.
+        """
+        if not await breaker.allow():
+            raise ModerationUnavailable("The moderation model provider is unavailable.")
+
+        try:
+            async with self.limiter.acquire():
+                response = await agent.run(*args, **kwargs)
+        except UnexpectedModelBehavior:
+            # The provider is up, the model output is invalid
+            await breaker.record_success()
+            raise
+        except Exception:
+            await breaker.record_failure()
+            raise
+
+        await breaker.record_success()
+        return response
+
+    async def ais_safe_content(self, content):
+        response = await self.run_agent(self.agent, content)
+        return response.output.is_safe
+
+    def is_safe_content(self, content):
+        return self.run(self.ais_safe_content(content))
+
+    async def aare_safe_contents(self, contents):
+        try:
+            response = await self.run_agent(
+                self.batch_agent,
+                json.dumps(contents, ensure_ascii=False),
+                deps=len(contents),
+            )
+        except UnexpectedModelBehavior:
+            # The model didn't return one verdict per content
+            logger.warning(
+                f"Batch moderation of {len(contents)} contents failed, "
+                "moderating them one by one."
+            )
+            return [await self.ais_safe_content(content) for content in contents]
+
+        return [verdict.is_safe for verdict in response.output]
+
+    def are_safe_contents(self, contents):
+        return self.run(self.aare_safe_contents(contents))
+
+
+_local = threading.local()
+
+
+def get_moderation_client():
+    """
+    Returns the moderation client of the current thread, building it on the first
+    call. Each Celery worker process therefore builds a single client.
+    """
+    if not hasattr(_local, "client"):
+        _local.client = ModerationClient()
+
+    return _local.client
+
+
 def is_safe_content(content):
     """
     Returns a boolean indicating if the content is safe.
     """
-    agent = Agent(
-        model,
-        output_type=ContentSafetyResponse,
-        system_prompt="You are a content safety model. Your task is to determine if the content is safe or not.",
-    )
-    response = agent.run_sync(content)
-    return response.output.is_safe
+    return get_moderation_client().is_safe_content(content)
+
+
+def are_safe_contents(contents):
+    """
+    Returns a list of booleans indicating if each content is safe, classifying
+    all of them in a single model request.
+    """
+    return get_moderation_client().are_safe_contents(contents)
+
+
+async def ais_safe_content(content):
+    """
+    Returns a boolean indicating if the content is safe.
+
+    Must be awaited on the moderation client's event loop, see ModerationClient.run.
+    """
+    return await get_moderation_client().ais_safe_content(content)
@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from redis.exceptions import RedisError
+
+from core.redis_client import get_redis
+from core.utils import normalize_content
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "moderation:verdict:"
+STATS_KEY = "moderation:verdict_cache:stats"
+
+
+class VerdictCache:
+    """
+    Cache of moderation verdicts, keyed by the hash of the normalized content, so
+    repeated contents ("ok", "lol", greetings) don't reach the model again.
+
+    It has two tiers: an LRU dict local to the worker, holding up to
+    MODERATION_CACHE_SIZE verdicts, and Redis, shared by all the workers, where
+    verdicts expire after MODERATION_CACHE_TTL seconds. Hits and misses are
+    counted locally and in Redis, so they can be aggregated across workers.
+    """
+
+    def __init__(self):
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    @staticmethod
+    def key(content):
+        return hashlib.sha256(normalize_content(content).encode()).hexdigest()
+
+    def get_many(self, contents):
+        """
+        Returns the cached verdict of each content, or None when it isn't cached.
+        """
+        if not settings.MODERATION_CACHE_ENABLED:
+            return [None] * len(contents)
+
+        keys = [self.key(content) for content in contents]
+        verdicts = [None] * len(contents)
+        stats = dict.fromkeys(self.stats, 0)
+
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.local:
+                    self.local.move_to_end(key)
+                    verdicts[i] = self.local[key]
+                    stats["local_hits"] += 1
+
+        missing = [i for i, verdict in enumerate(verdicts) if verdict is None]
+
+        if missing:
+            try:
+                values = get_redis().mget([KEY_PREFIX + keys[i] for i in missing])
+            except RedisError:
+                logger.warning("Failed to read the moderation verdict cache.")
+                values = [None] * len(missing)
+
+            for i, value in zip(missing, values):
+                if value is None:
+                    stats["misses"] += 1
+                else:
+                    verdicts[i] = value == "1"
+                    stats["redis_hits"] += 1
+                    self.set_local(keys[i], verdicts[i])
+
+        self.record(stats)
+        return verdicts
+
+    def set_many(self, contents, verdicts):
+        """
+        Caches the verdicts of the contents.
+        """
+        if not settings.MODERATION_CACHE_ENABLED:
+            return
+
+        try:
+            with get_redis().pipeline(transaction=False) as pipe:
+                for content, verdict in zip(contents, verdicts):
+                    key = self.key(content)
+                    self.set_local(key, verdict)
+                    pipe.set(
+                        KEY_PREFIX + key,
+                        "1" if verdict else "0",
+                        ex=settings.MODERATION_CACHE_TTL,
+                    )
+                pipe.execute()
+        except RedisError:
+            logger.warning("Failed to write the moderation verdict cache.")
+
+    def set_local(self, key, verdict):
+        with self.lock:
+            self.local[key] = verdict
+            self.local.move_to_end(key)
+
+            while len(self.local) > settings.MODERATION_CACHE_SIZE:
+                self.local.popitem(last=False)
+
+    def record(self, stats):
+        with self.lock:
+            for name, count in stats.items():
+                self.stats[name] += count
+
+        try:
+            with get_redis().pipeline(transaction=False) as pipe:
+                for name, count in stats.items():
+                    if count:
+                        pipe.hincrby(STATS_KEY, name, count)
+                pipe.execute()
+        except RedisError:
+            logger.warning("Failed to record the moderation verdict cache stats.")
+
+    def get_stats(self):
+        """
+        Returns the hits and misses of all the workers and the resulting hit ratio.
+        """
+        stats = dict.fromkeys(self.stats, 0)
+        stats.update(
+            (name, int(count)) for name, count in get_redis().hgetall(STATS_KEY).items()
+        )
+        lookups = sum(stats.values())
+        stats["hit_ratio"] = (lookups - stats["misses"]) / lookups if lookups else 0
+        return stats
+
+    def clear(self):
+        """
+        Removes all the cached verdicts and resets the stats.
+        """
+        redis = get_redis()
+        keys = list(redis.scan_iter(match=f"{KEY_PREFIX}*", count=1000))
+
+        if keys:
+            redis.delete(*keys)
+
+        redis.delete(STATS_KEY)
+
+        with self.lock:
+            self.local.clear()
+            self.stats = dict.fromkeys(self.stats, 0)
+
+
+verdict_cache = VerdictCache()
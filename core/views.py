@@ -1,12 +1,20 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Q
+from django.db.models import Case, Count, Exists, OuterRef, Q, Subquery, When
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from rest_framework import mixins, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 
-from core.models import Message, Room
+from core import history, moderation_queue, outbound, presence, resilience, tracing
+from core.models import Message, Room, RoomMember
+from core.pagination import KeysetPagination
 from core.permissions import IsAdminUserOrReadOnly, IsRoomMember
 from core.serializers import MessageSerializer, RoomSerializer, UserSerializer
+from core.verdict_cache import verdict_cache
 
 User = get_user_model()
 
@@ -33,45 +41,167 @@ class RoomViewSet(viewsets.ModelViewSet):
 
     Only admin users (is_staff) can create, update or delete rooms.
     Regular users can only view rooms they are members of or public rooms.
+
+    Rooms are listed by pages (see KeysetPagination), with their member count,
+    online member count and last message. The presence and messages of a room are
+    only shown to its members.
     """
 
     queryset = Room.objects.all()
     serializer_class = RoomSerializer
     permission_classes = [IsAdminUserOrReadOnly]
-    pagination_class = None
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
+        memberships = RoomMember.objects.filter(room=OuterRef("pk")).order_by()
+        last_message = Message.objects.filter(
+            room=OuterRef("pk"), status=Message.Status.APPROVED
+        ).order_by("-created_at", "-id")
+        # EXISTS instead of joining the memberships, which would need a DISTINCT
+        queryset = self.queryset.annotate(
+            is_member=Exists(memberships.filter(user=self.request.user)),
+            member_count=Coalesce(
+                Subquery(
+                    memberships.values("room")
+                    .annotate(count=Count("*"))
+                    .values("count")
+                ),
+                0,
+            ),
+            last_message_content=self.if_member(last_message.values("content")[:1]),
+            last_message_created_at=self.if_member(
+                last_message.values("created_at")[:1]
+            ),
+            last_message_author=self.if_member(
+                last_message.values("author__username")[:1]
+            ),
+        )
+
         if self.request.user.is_staff:
-            return self.queryset.all()
+            return queryset
+
+        return queryset.filter(
+            Q(is_private=False) | Q(owner=self.request.user) | Q(is_member=True)
+        )
+
+    @staticmethod
+    def if_member(queryset):
+        """
+        Returns the subquery of the queryset, or NULL for the rooms the user isn't a
+        member of.
+        """
+        return Case(When(is_member=True, then=Subquery(queryset)))
+
+    def list(self, request, *args, **kwargs):
+        rooms = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        self.add_online_counts(rooms)
+        serializer = self.get_serializer(rooms, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        room = self.get_object()
+        self.add_online_counts([room])
+        return Response(self.get_serializer(room).data)
 
-        return self.queryset.filter(
-            Q(is_private=False)
-            | Q(owner=self.request.user)
-            | Q(members=self.request.user)
-        ).distinct()
+    @staticmethod
+    def add_online_counts(rooms):
+        member_rooms = [room for room in rooms if room.is_member]
+        online_counts = presence.count_online_members(
+            [room.id for room in member_rooms]
+        )
+
+        for room in member_rooms:
+            room.online_count = online_counts[room.id]
 
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
         serializer.instance.members.add(self.request.user)
         serializer.instance.save()
 
+    @action(detail=True, methods=["get"], url_path="online-members")
+    def online_members(self, request, pk=None):
+        """
+        Returns the usernames of the room members that are online.
+        Only members of the room can view them.
+        """
+        room = self.get_object()
+
+        if not room.is_member:
+            raise PermissionDenied()
+
+        return Response({"members": presence.get_online_members(room.id)})
+
 
 class MessageViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     """
-    API endpoint that allows messages to be listed.
+    API endpoint that allows messages to be listed, by pages of the latest
+    messages (see KeysetPagination). The first page is served from the room's
+    history buffer when possible (see core.history).
 
     Only members of the room can list messages.
     """
 
-    queryset = Message.objects.filter(status=Message.Status.APPROVED).prefetch_related(
-        "author"
-    )
+    queryset = Message.objects.prefetch_related("author")
     serializer_class = MessageSerializer
     permission_classes = [IsRoomMember]
-    pagination_class = None
+    pagination_class = KeysetPagination
     lookup_field = "room__id"
     lookup_url_kwarg = "room_id"
 
+    @cached_property
+    def optimistic_delivery(self):
+        room_id = self.kwargs.get(self.lookup_url_kwarg)
+        return Room.objects.filter(id=room_id, optimistic_delivery=True).exists()
+
     def get_queryset(self):
         room_id = self.kwargs.get(self.lookup_url_kwarg)
-        return self.queryset.filter(room__id=room_id)
+        queryset = self.queryset.filter(room__id=room_id)
+
+        # Rooms with optimistic delivery also show the messages still being
+        # moderated. Each filter has an index serving the order of the pages
+        if self.optimistic_delivery:
+            return queryset.filter(
+                status__in=[Message.Status.APPROVED, Message.Status.PENDING]
+            )
+        return queryset.filter(status=Message.Status.APPROVED)
+
+    def list(self, request, *args, **kwargs):
+        room_id = int(self.kwargs[self.lookup_url_kwarg])
+        paginator = self.paginator
+        is_first_page = not (
+            paginator.before_query_param in request.query_params
+            or paginator.after_query_param in request.query_params
+        )
+
+        # The buffer only holds approved messages, rooms with optimistic delivery
+        # also list the pending ones
+        if is_first_page and not self.optimistic_delivery:
+            messages = history.get_latest(room_id)
+            complete = len(messages) < settings.HISTORY_BUFFER_SIZE
+
+            if complete or len(messages) >= paginator.get_page_size(request):
+                page = paginator.paginate_serialized(messages, request, complete)
+                return paginator.get_paginated_response(page)
+
+        return super().list(request, *args, **kwargs)
+
+
+class MetricsViewSet(viewsets.ViewSet):
+    """
+    API endpoint that exposes the operational metrics of the chat.
+
+    Only admin users (is_staff) can view the metrics.
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def list(self, request):
+        return Response(
+            {
+                "verdict_cache": verdict_cache.get_stats(),
+                "moderation_queue": moderation_queue.get_stats(),
+                "moderation_provider": resilience.get_stats(),
+                "latency": tracing.get_stats(),
+                "outbound_queues": outbound.get_stats(),
+            }
+        )